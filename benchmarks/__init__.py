@@ -0,0 +1,13 @@
+"""
+Benchmark harness for the API.
+
+Runs the app under uvicorn against local stand-ins for Supabase, Stripe,
+Mastodon, Pixelfed, Lemmy and Bluesky, drives load through its endpoints
+and reports latency percentiles, throughput and event-loop lag.
+
+    python -m benchmarks.run --help
+
+Changes here stay inside benchmarks/. A bug a benchmark turns up in the
+app is fixed in its own change, so it can be reviewed and measured apart
+from the harness.
+"""
@@ -0,0 +1,471 @@
+"""
+Local stand-ins for every service the API calls, for benchmarks.
+
+Each fake answers just enough of the real API for the app's code paths to
+run end to end, with a configurable latency, jitter and failure rate. They
+all run in one process, one port each, starting at --base-port:
+
+    python -m benchmarks.fakes --latency-ms 40 --jitter-ms 20 --failure-rate 0.01
+
+Every fake also serves GET /__fake__/stats (calls per route) and
+POST /__fake__/reset, which bypass the injected latency and failures.
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, NamedTuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from PIL import Image
+
+SERVICES = ('supabase', 'stripe', 'mastodon', 'pixelfed', 'lemmy', 'bluesky')
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_BASE_PORT = 54320
+
+# Every user's storage folder holds the post media plus a tree of files for deletion
+MEDIA_FILES = ('photo.jpg', 'graphic.png')
+FOLDER_SIZE = 50  # Files per subfolder of the deletion tree
+
+# Column defaults of tables the generic PostgREST handler serves
+TABLE_DEFAULTS = {'scheduled_posts': {'status': 'scheduled', 'result': None},
+                  'stripe_events': {'status': 'pending', 'result': None}}
+
+# A well-formed CID, returned for every blob and record
+FAKE_CID = "bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy"
+
+
+class Faults(NamedTuple):
+    """
+    Latency and failures injected into every request to a fake.
+
+    The jitter is the mean of an exponentially distributed extra delay, which
+    gives the long tail real services have.
+    """
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    failure_rate: float = 0.0
+
+
+# End of Faults
+
+# --- Shared Plumbing ---
+def create_app(name: str, faults: Faults) -> FastAPI:
+    """A FastAPI app that counts calls per route and injects the given faults."""
+    app = FastAPI(title=f"fake {name}")
+    app.state.calls = Counter()
+
+    @app.middleware("http")
+    async def inject_faults(request: Request, call_next):
+        if request.url.path.startswith('/__fake__/'):
+            return await call_next(request)
+
+        delay = faults.latency_ms + (random.expovariate(1 / faults.jitter_ms) if faults.jitter_ms else 0)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if faults.failure_rate and random.random() < faults.failure_rate:
+            app.state.calls['injected failure'] += 1
+            return JSONResponse({'error': 'InternalServerError', 'message': 'Injected failure'}, status_code=503)
+
+        response = await call_next(request)
+        route = request.scope.get('route')
+        app.state.calls[f"{request.method} {route.path if route else request.url.path}"] += 1
+        return response
+
+    @app.get("/__fake__/stats")
+    async def stats():
+        return dict(app.state.calls)
+
+    @app.post("/__fake__/reset")
+    async def reset():
+        app.state.calls.clear()
+        return {}
+
+    return app
+# End of create_app
+
+
+def make_media() -> Dict[str, bytes]:
+    """A large noisy JPEG that has to be recompressed and a small flat-colour PNG."""
+    noise = Image.effect_noise((2400, 1600), 48)
+    photo = Image.merge('RGB', (noise, noise.rotate(180), Image.linear_gradient('L').resize(noise.size)))
+    graphic = Image.new('RGB', (1200, 800), (32, 96, 160))
+    graphic.paste((240, 240, 240), (100, 100, 1100, 300))
+
+    files = {}
+    for name, image, fmt in (('photo.jpg', photo, 'JPEG'), ('graphic.png', graphic, 'PNG')):
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, quality=95)
+        files[name] = buffer.getvalue()
+    return files
+# End of make_media
+
+
+# --- Supabase ---
+def supabase_app(faults: Faults, user_files: int, unique_media: bool) -> FastAPI:
+    """
+    Storage, PostgREST and Auth admin for any user id.
+
+    Every user has the post media at the top of their images folder and
+    user_files more files spread over subfolders. Removals are acknowledged
+    but nothing is deleted, so every run sees the same tree.
+    """
+    app = create_app('supabase', faults)
+    media = make_media()
+    folders = [f"d{i}" for i in range(math.ceil(user_files / FOLDER_SIZE))] if user_files else []
+    subscriptions: Dict[str, dict] = {}
+    tables: Dict[str, List[dict]] = {}
+    row_ids = itertools.count(1)
+
+    def listing(bucket: str, prefix: str) -> list:
+        parts = prefix.strip('/').split('/')
+        if bucket != 'images' or not parts[0]:
+            return []
+        if len(parts) == 1:
+            files = [{'name': name, 'metadata': {'size': len(media[name])}} for name in MEDIA_FILES]
+            return files + [{'name': folder, 'metadata': None} for folder in folders]
+        if len(parts) == 2 and parts[1] in folders:
+            start = folders.index(parts[1]) * FOLDER_SIZE
+            return [{'name': f"f{i}.jpg", 'metadata': {'size': 1024}}
+                    for i in range(start, min(start + FOLDER_SIZE, user_files))]
+        return []
+
+    @app.post("/storage/v1/object/list/{bucket}")
+    async def list_objects(bucket: str, request: Request):
+        body = await request.json()
+        offset, limit = body.get('offset', 0), body.get('limit', 100)
+        return listing(bucket, body.get('prefix', ''))[offset:offset + limit]
+
+    @app.get("/storage/v1/object/{bucket}/{path:path}")
+    @app.get("/storage/v1/object/authenticated/{bucket}/{path:path}")
+    async def download(bucket: str, path: str):
+        data = media.get(os.path.basename(path))
+        if data is None:
+            return JSONResponse({'error': 'not_found', 'message': 'Object not found'}, status_code=404)
+        if unique_media:
+            # Trailing bytes after the image change its hash but not its pixels
+            data += os.urandom(16)
+        return Response(data, media_type='application/octet-stream')
+
+    @app.delete("/storage/v1/object/{bucket}")
+    async def remove(bucket: str, request: Request):
+        body = await request.json()
+        return [{'name': prefix} for prefix in body.get('prefixes', [])]
+
+    @app.get("/rest/v1/subscriptions")
+    async def select_subscription(request: Request):
+        params = request.query_params
+        if 'user_id' in params:
+            user_id = params['user_id'].split('.', 1)[1]
+        elif 'stripe_customer_id' in params:
+            user_id = params['stripe_customer_id'].split('.', 1)[1].removeprefix('cus_')
+        else:
+            return []
+        row = subscriptions.get(user_id)
+        if row is None:
+            row = subscriptions[user_id] = {
+                'id': next(row_ids), 'user_id': user_id, 'stripe_customer_id': f"cus_{user_id}",
+                'email': f"{user_id}@example.com", 'plan_name': 'free',
+            }
+        return [row]
+
+    @app.patch("/rest/v1/subscriptions")
+    async def update_subscription(request: Request):
+        row_id = int(request.query_params.get('id', 'eq.0').split('.', 1)[1])
+        changes = await request.json()
+        rows = [row for row in subscriptions.values() if row['id'] == row_id]
+        for row in rows:
+            row.update(changes)
+        return rows
+
+    @app.post("/rest/v1/rpc/{function}")
+    async def rpc(function: str, request: Request):
+        body = await request.json()
+        if function == 'record_post_history':
+            return len(body.get('p_posts', []))
+        return 0
+
+    @app.delete("/auth/v1/admin/users/{user_id}")
+    async def delete_auth_user(user_id: str):
+        subscriptions.pop(user_id, None)
+        return {}
+
+    # Any other table, e.g. scheduled_posts, is a plain in-memory list of rows keyed by id
+    @app.api_route("/rest/v1/{table}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def table_rows(table: str, request: Request):
+        rows = tables.setdefault(table, [])
+        if request.method == "POST":
+            body = await request.json()
+            now = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+            inserted = [{'id': str(uuid.uuid4()), 'created_at': now, 'updated_at': now, 'received_at': now,
+                         **TABLE_DEFAULTS.get(table, {}), **row}
+                        for row in (body if isinstance(body, list) else [body])]
+            if 'ignore-duplicates' in request.headers.get('prefer', ''):
+                # An upsert that skips rows whose id is taken
+                taken = {row['id'] for row in rows}
+                inserted = [row for row in inserted if row['id'] not in taken]
+            rows.extend(inserted)
+            return inserted
+
+        matched = [row for row in rows if row_matches(row, request.query_params)]
+        if request.method == "PATCH":
+            changes = await request.json()
+            for row in matched:
+                row.update(changes)
+        elif request.method == "DELETE":
+            tables[table] = [row for row in rows if row not in matched]
+        elif 'order' in request.query_params:
+            column, _, direction = request.query_params['order'].partition('.')
+            matched.sort(key=lambda row: str(row.get(column)), reverse=direction == 'desc')
+        columns = request.query_params.get('select', '*')
+        if columns != '*':
+            names = [name.strip() for name in columns.split(',')]
+            return [{name: row.get(name) for name in names} for row in matched]
+        return matched
+
+    return app
+# End of supabase_app
+
+
+def _comparable(value):
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return str(value)
+# End of _comparable
+
+
+def row_matches(row: dict, params) -> bool:
+    """Apply PostgREST eq/neq/lt/gt/in filters from a query string to a row."""
+    for column, condition in params.items():
+        operator, _, expected = condition.partition('.')
+        if operator not in ('eq', 'neq', 'lt', 'gt', 'in') or column not in row and operator not in ('eq', 'in'):
+            continue
+        value = row.get(column)
+        if operator == 'in' and str(value) not in expected.strip('()').replace('"', '').split(','):
+            return False
+        if operator == 'eq' and str(value) != expected:
+            return False
+        if operator == 'neq' and str(value) == expected:
+            return False
+        if operator in ('lt', 'gt'):
+            left, right = _comparable(value), _comparable(expected)
+            if type(left) is not type(right) or (left >= right if operator == 'lt' else left <= right):
+                return False
+    return True
+# End of row_matches
+
+
+# --- Stripe ---
+def stripe_app(faults: Faults) -> FastAPI:
+    app = create_app('stripe', faults)
+
+    @app.post("/v1/customers")
+    async def create_customer():
+        return {'id': f"cus_{os.urandom(6).hex()}", 'object': 'customer'}
+
+    @app.delete("/v1/customers/{customer_id}")
+    async def delete_customer(customer_id: str):
+        return {'id': customer_id, 'object': 'customer', 'deleted': True}
+
+    return app
+# End of stripe_app
+
+
+# --- Mastodon and Pixelfed ---
+def mastodon_app(name: str, faults: Faults) -> FastAPI:
+    """The Mastodon API subset used by Mastodon.py and the video upload path."""
+    app = create_app(name, faults)
+    ids = itertools.count(1)
+
+    def media(media_id: str, request: Request, kind: str = 'image') -> dict:
+        return {'id': media_id, 'type': kind, 'url': f"{request.base_url}media/{media_id}",
+                'preview_url': f"{request.base_url}media/{media_id}/small", 'description': None}
+
+    @app.get("/api/v1/instance")
+    @app.get("/api/v1/instance/")
+    @app.get("/api/v2/instance")
+    @app.get("/api/v2/instance/")
+    async def instance(request: Request):
+        return {'uri': request.url.netloc, 'domain': request.url.netloc, 'title': f"fake {name}",
+                'version': '4.3.0', 'configuration': {}}
+
+    @app.post("/api/v1/media")
+    @app.post("/api/v2/media")
+    async def upload_media(request: Request):
+        body = await request.body()
+        kind = 'video' if b'Content-Type: video/' in body[:1024] else 'image'
+        return media(str(next(ids)), request, kind)
+
+    @app.get("/api/v1/media/{media_id}")
+    async def get_media(media_id: str, request: Request):
+        return media(media_id, request)
+
+    @app.post("/api/v1/statuses")
+    async def post_status(request: Request):
+        status_id = str(next(ids))
+        url = f"{request.base_url}@bench/{status_id}"
+        return {'id': status_id, 'uri': url, 'url': url, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'content': '', 'visibility': 'public', 'media_attachments': [],
+                'account': {'id': '1', 'username': 'bench', 'acct': 'bench'}}
+
+    return app
+# End of mastodon_app
+
+
+# --- Lemmy ---
+def lemmy_app(faults: Faults) -> FastAPI:
+    app = create_app('lemmy', faults)
+    ids = itertools.count(1)
+
+    @app.post("/api/v3/post")
+    async def create_post(request: Request):
+        body = await request.json()
+        post_id = next(ids)
+        return {'post_view': {'post': {'id': post_id, 'name': body.get('name'),
+                                       'community_id': body.get('community_id'),
+                                       'ap_id': f"{request.base_url}post/{post_id}"}}}
+
+    return app
+# End of lemmy_app
+
+
+# --- Bluesky ---
+def fake_jwt(did: str, scope: str, lifetime: int) -> str:
+    """An unsigned JWT; the client only reads its payload."""
+    def encode(value: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=').decode()
+
+    now = int(time.time())
+    return '.'.join((encode({'typ': 'JWT', 'alg': 'HS256'}),
+                     encode({'scope': scope, 'sub': did, 'iat': now, 'exp': now + lifetime}),
+                     encode({'signature': 'fake'})))
+# End of fake_jwt
+
+
+def bluesky_app(faults: Faults) -> FastAPI:
+    """The XRPC methods used to log in, upload blobs and create posts."""
+    app = create_app('bluesky', faults)
+    ids = itertools.count(1)
+
+    def session(handle: str) -> dict:
+        did = f"did:plc:{handle.split('.')[0]}"
+        return {'did': did, 'handle': handle, 'active': True,
+                'accessJwt': fake_jwt(did, 'com.atproto.appPass', 7200),
+                'refreshJwt': fake_jwt(did, 'com.atproto.refresh', 60 * 86400)}
+
+    @app.post("/xrpc/com.atproto.server.createSession")
+    async def create_session(request: Request):
+        body = await request.json()
+        return session(body['identifier'])
+
+    @app.post("/xrpc/com.atproto.server.refreshSession")
+    async def refresh_session(request: Request):
+        token = request.headers.get('authorization', '').split('.')[1]
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return session(payload['sub'].removeprefix('did:plc:') + '.bsky.social')
+
+    @app.get("/xrpc/app.bsky.actor.getProfile")
+    async def get_profile(actor: str):
+        return {'did': f"did:plc:{actor.split('.')[0]}", 'handle': actor}
+
+    @app.post("/xrpc/com.atproto.repo.uploadBlob")
+    async def upload_blob(request: Request):
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        return {'blob': {'$type': 'blob', 'ref': {'$link': FAKE_CID},
+                         'mimeType': request.headers.get('content-type', 'application/octet-stream'),
+                         'size': size}}
+
+    @app.post("/xrpc/com.atproto.repo.createRecord")
+    async def create_record(request: Request):
+        body = await request.json()
+        return {'uri': f"at://{body['repo']}/{body['collection']}/{next(ids)}", 'cid': FAKE_CID}
+
+    return app
+# End of bluesky_app
+
+
+# --- Runner ---
+class _Server(uvicorn.Server):
+    """A uvicorn server that leaves signal handling to serve_all."""
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+
+# End of _Server
+
+def build_apps(faults: Faults, user_files: int = 200, unique_media: bool = False) -> Dict[str, FastAPI]:
+    return {
+        'supabase': supabase_app(faults, user_files, unique_media),
+        'stripe': stripe_app(faults),
+        'mastodon': mastodon_app('mastodon', faults),
+        'pixelfed': mastodon_app('pixelfed', faults),
+        'lemmy': lemmy_app(faults),
+        'bluesky': bluesky_app(faults),
+    }
+# End of build_apps
+
+
+def service_urls(host: str = DEFAULT_HOST, base_port: int = DEFAULT_BASE_PORT) -> Dict[str, str]:
+    return {name: f"http://{host}:{base_port + index}" for index, name in enumerate(SERVICES)}
+# End of service_urls
+
+
+async def serve_all(apps: Dict[str, FastAPI], host: str = DEFAULT_HOST, base_port: int = DEFAULT_BASE_PORT) -> None:
+    """Serve every fake on its own port until SIGINT or SIGTERM."""
+    servers = [
+        _Server(uvicorn.Config(apps[name], host=host, port=base_port + index, lifespan='off',
+                               log_level='warning', access_log=False))
+        for index, name in enumerate(SERVICES)
+    ]
+
+    def shutdown() -> None:
+        for server in servers:
+            server.should_exit = True
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown)
+    await asyncio.gather(*(server.serve() for server in servers))
+# End of serve_all
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Fixed delay added to every call")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="Mean of an extra exponential delay")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of calls answered with a 503")
+    parser.add_argument('--user-files', type=int, default=200, help="Files in every user's storage tree")
+    parser.add_argument('--unique-media', action='store_true',
+                        help="Serve different bytes on every download, defeating content-hash caches")
+    args = parser.parse_args()
+
+    faults = Faults(args.latency_ms, args.jitter_ms, args.failure_rate)
+    apps = build_apps(faults, args.user_files, args.unique_media)
+    for name, url in service_urls(args.host, args.base_port).items():
+        print(f"{name:>9}: {url}", flush=True)
+    asyncio.run(serve_all(apps, args.host, args.base_port))
+# End of main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+
+from benchmarks.scenarios import Scenario
+from benchmarks.stats import summarize
+
+POLL_INTERVAL = 0.1  # Seconds between status checks of a background job
+JOB_TIMEOUT = 300.0
+# Final statuses of background jobs and scheduled posts
+DONE_STATUSES = {'done', 'published', 'partial'}
+FAILED_STATUSES = {'failed', 'cancelled'}
+
+
+class Outcome(NamedTuple):
+    """
+    One request's result.
+
+    degraded marks a request that succeeded over HTTP but reported a failure,
+    like a post that failed on some destinations.
+    completion is how long a background job took to finish, from submission.
+    """
+    latency: float
+    status: int
+    ok: bool
+    degraded: bool = False
+    completion: Optional[float] = None
+
+
+# End of Outcome
+
+class LoadResult(NamedTuple):
+    scenario: str
+    outcomes: List[Outcome]
+    elapsed: float
+    completion_elapsed: Optional[float] = None
+
+    def summary(self) -> Dict:
+        ok = [outcome for outcome in self.outcomes if outcome.ok]
+        completions = [outcome.completion for outcome in self.outcomes if outcome.completion is not None]
+        summary = {
+            'scenario': self.scenario,
+            'requests': len(self.outcomes),
+            'ok': len(ok),
+            'errors': len(self.outcomes) - len(ok),
+            'degraded': sum(outcome.degraded for outcome in self.outcomes),
+            'throughput_rps': round(len(self.outcomes) / self.elapsed, 2) if self.elapsed else 0.0,
+            'latency_ms': summarize((outcome.latency for outcome in self.outcomes), scale=1000),
+        }
+        if self.completion_elapsed is not None:
+            summary['completion_ms'] = summarize(completions, scale=1000)
+            summary['completed_per_s'] = (round(len(completions) / self.completion_elapsed, 2)
+                                          if self.completion_elapsed else 0.0)
+        return summary
+
+
+# End of LoadResult
+
+# --- Load Generation ---
+def is_degraded(body) -> bool:
+    """Whether a 2xx body reports a failure: a failed destination of a post, or an error status."""
+    if isinstance(body, list):
+        return any(result.get('status') != 'success' for result in body)
+    return isinstance(body, dict) and body.get('status') == 'error'
+# End of is_degraded
+
+
+async def wait_for_job(client: httpx.AsyncClient, status_url: str, submitted: float) -> Optional[float]:
+    """Poll a background job until it is done. Returns its completion time, or None if it failed."""
+    deadline = submitted + JOB_TIMEOUT
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+        response = await client.get(status_url)
+        status = response.json().get('status') if response.status_code == 200 else None
+        if status in DONE_STATUSES:
+            return time.perf_counter() - submitted
+        if status in FAILED_STATUSES:
+            return None
+    return None
+# End of wait_for_job
+
+
+async def run_load(client: httpx.AsyncClient, scenario: Scenario, urls: Dict[str, str],
+                   requests: int, concurrency: int, first: int = 0) -> LoadResult:
+    """
+    Send requests through a closed loop of concurrency workers.
+
+    Each worker sends its next request as soon as the previous one returns.
+    Background jobs are polled by separate tasks, so submissions keep going.
+
+    Args:
+        client: Client pointed at the app.
+        scenario: What to send.
+        urls: Fake service URLs, for the request builders.
+        requests: Total number of requests.
+        concurrency: Requests in flight at once.
+        first: Number of the first request, so warmup and measured runs differ.
+    """
+    numbers = iter(range(first, first + requests))
+    outcomes: List[Outcome] = []
+    jobs: List[asyncio.Task] = []
+
+    async def complete(index: int, status_url: str, submitted: float) -> None:
+        completion = await wait_for_job(client, status_url, submitted)
+        outcome = outcomes[index]
+        outcomes[index] = outcome._replace(ok=completion is not None, completion=completion)
+
+    async def worker() -> None:
+        for number in numbers:
+            request = scenario.build(number, urls)
+            started = time.perf_counter()
+            try:
+                response = await client.request(request.method, request.path, json=request.json,
+                                                content=request.content, headers=request.headers)
+                latency = time.perf_counter() - started
+                body = response.json() if response.headers.get('content-type') == 'application/json' else None
+                outcome = Outcome(latency, response.status_code, response.is_success, is_degraded(body))
+            except httpx.HTTPError:
+                outcomes.append(Outcome(time.perf_counter() - started, 0, False))
+                continue
+
+            outcomes.append(outcome)
+            if scenario.background and response.status_code == 202:
+                jobs.append(asyncio.create_task(complete(len(outcomes) - 1, body['status_url'], started)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    elapsed = time.perf_counter() - started
+
+    completion_elapsed = None
+    if scenario.background:
+        await asyncio.gather(*jobs)
+        completion_elapsed = time.perf_counter() - started
+
+    return LoadResult(scenario.name, outcomes, elapsed, completion_elapsed)
+# End of run_load
+
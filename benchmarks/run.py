@@ -0,0 +1,229 @@
+"""
+Run benchmark scenarios against the API and the local fake services.
+
+Starts benchmarks.fakes and the app (benchmarks.serve) under uvicorn in
+subprocesses, with every upstream pointed at the fakes and all state in a
+temporary directory, then runs each scenario after a short warmup:
+
+    python -m benchmarks.run text-post media-post stripe-webhook delete-user \\
+        --requests 200 --concurrency 16 --latency-ms 40 --jitter-ms 20
+
+Each scenario reports request latency percentiles, throughput, the app's
+event-loop lag and the calls it made to each fake. Pass --env to compare
+settings, e.g. --env MEDIA_CACHE_MAX_MB=0, and --json to keep the results.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks import fakes, scenarios
+from benchmarks.load import run_load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PORT = 54300
+STARTUP_TIMEOUT = 60.0
+
+
+# --- Processes ---
+def app_environment(urls: Dict[str, str], overrides: List[str]) -> Dict[str, str]:
+    """The app's environment, with every upstream pointed at the fakes."""
+    env = {
+        **os.environ,
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+        'SUPABASE_URL': urls['supabase'],
+        'SUPABASE_KEY': 'benchmark-service-key',
+        'STRIPE_API_KEY': 'sk_test_benchmark',
+        'STRIPE_API_BASE': urls['stripe'],
+        'STRIPE_WEBHOOK_SECRET': scenarios.WEBHOOK_SECRET,
+        'BLUESKY_BASE_URL': urls['bluesky'] + '/xrpc',
+        'LEMMY_SCHEME': 'http',
+    }
+    for override in overrides:
+        name, _, value = override.partition('=')
+        env[name] = value
+    return env
+# End of app_environment
+
+
+def start_process(args: List[str], cwd: str, env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    """Start a Python module in a subprocess, with its output going to log_path."""
+    with open(log_path, 'wb') as log:
+        return subprocess.Popen([sys.executable, *args], cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+# End of start_process
+
+
+def stop_process(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+# End of stop_process
+
+
+async def wait_until_ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen, name: str) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} exited with {process.returncode} during startup")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{name} did not start within {STARTUP_TIMEOUT:.0f}s")
+# End of wait_until_ready
+
+
+# --- Reporting ---
+def cache_delta(before: Dict[str, dict], after: Dict[str, dict]) -> Dict[str, dict]:
+    """Cache hits and misses during a scenario, from the app's cumulative counters."""
+    delta = {}
+    for name, stats in after.items():
+        hits = stats['hits'] - before.get(name, {}).get('hits', 0)
+        misses = stats['misses'] - before.get(name, {}).get('misses', 0)
+        delta[name] = {**stats, 'hits': hits, 'misses': misses,
+                       'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0}
+    return delta
+# End of cache_delta
+
+
+def print_report(results: List[dict]) -> None:
+    header = (f"{'scenario':<24}{'reqs':>6}{'ok':>6}{'err':>5}{'degr':>6}{'req/s':>9}"
+              f"{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'lag p99':>9}{'lag max':>9}")
+    print()
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        latency, lag = result['latency_ms'], result['app']['loop_lag_ms']
+        print(f"{result['scenario']:<24}{result['requests']:>6}{result['ok']:>6}{result['errors']:>5}"
+              f"{result['degraded']:>6}{result['throughput_rps']:>9.1f}"
+              f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}{latency['max']:>9.1f}"
+              f"{lag['p99']:>9.1f}{lag['max']:>9.1f}")
+        if 'completion_ms' in result:
+            completion = result['completion_ms']
+            print(f"{'  to completion':<24}{completion['count']:>6}{'':>17}{result['completed_per_s']:>9.1f}"
+                  f"{completion['p50']:>9.1f}{completion['p95']:>9.1f}{completion['p99']:>9.1f}"
+                  f"{completion['max']:>9.1f}")
+    print("\nLatencies and loop lag in ms.")
+
+    for result in results:
+        print(f"\n{result['scenario']} upstream calls:")
+        for service, calls in result['upstream'].items():
+            if calls:
+                print(f"  {service:<9} " + ', '.join(f"{route} x{count}" for route, count in sorted(calls.items())))
+        caches = ', '.join(f"{name} {stats['hits']}/{stats['hits'] + stats['misses']} hits"
+                           for name, stats in result['app']['caches'].items() if stats['hits'] + stats['misses'])
+        if caches:
+            print(f"  caches    {caches}")
+# End of print_report
+
+
+# --- Runner ---
+async def run(args: argparse.Namespace) -> List[dict]:
+    selected = scenarios.select(args.scenarios or list(scenarios.SCENARIOS))
+    urls = fakes.service_urls(args.host, args.fake_base_port)
+    app_url = f"http://{args.host}:{args.port}"
+    workdir = tempfile.mkdtemp(prefix='loftly-bench-')
+    # The app writes its log, job store, history spool and media cache relative to its working directory
+    os.makedirs(os.path.join(workdir, 'logs'))
+
+    fake_process = start_process(
+        ['-m', 'benchmarks.fakes', '--host', args.host, '--base-port', str(args.fake_base_port),
+         '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+         '--failure-rate', str(args.failure_rate), '--user-files', str(args.user_files),
+         *(['--unique-media'] if args.unique_media else [])],
+        cwd=ROOT, env={**os.environ}, log_path=os.path.join(workdir, 'fakes.log'))
+    app_process = start_process(
+        ['-m', 'uvicorn', 'benchmarks.serve:app', '--host', args.host, '--port', str(args.port),
+         '--log-level', 'warning', '--no-access-log'],
+        cwd=workdir, env=app_environment(urls, args.env), log_path=os.path.join(workdir, 'app.out'))
+
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    try:
+        async with httpx.AsyncClient(base_url=app_url, timeout=args.timeout, limits=limits) as client, \
+                httpx.AsyncClient(timeout=10) as control:
+            await wait_until_ready(control, f"{urls['supabase']}/__fake__/stats", fake_process, "The fake services")
+            await wait_until_ready(control, f"{app_url}/__bench__/stats", app_process, "The app")
+            print(f"App at {app_url}, fakes from {urls['supabase']}, state in {workdir}", flush=True)
+
+            for number, scenario in enumerate(selected):
+                print(f"Running {scenario.name}: {scenario.description}", flush=True)
+                first = number * 1_000_000
+                if args.warmup:
+                    await run_load(client, scenario, urls, args.warmup, args.concurrency, first)
+
+                await asyncio.gather(control.post(f"{app_url}/__bench__/reset"),
+                                     *(control.post(f"{url}/__fake__/reset") for url in urls.values()))
+                before = (await control.get(f"{app_url}/__bench__/stats")).json()
+                load = await run_load(client, scenario, urls, args.requests, args.concurrency,
+                                      first + args.warmup)
+                app_stats, *upstream = await asyncio.gather(
+                    control.get(f"{app_url}/__bench__/stats"),
+                    *(control.get(f"{url}/__fake__/stats") for url in urls.values()))
+
+                app_stats = app_stats.json()
+                app_stats['caches'] = cache_delta(before['caches'], app_stats['caches'])
+                results.append({
+                    **load.summary(),
+                    'app': app_stats,
+                    'upstream': {service: response.json() for service, response in zip(urls, upstream)},
+                })
+    finally:
+        stop_process(app_process)
+        stop_process(fake_process)
+        if args.keep_state:
+            print(f"State and logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+# End of run
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"Any of: {', '.join(scenarios.SCENARIOS)} (default: all)")
+    parser.add_argument('--requests', type=int, default=100, help="Measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=10, help="Unmeasured requests before each scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument('--latency-ms', type=float, default=30.0, help="Fixed delay of every upstream call")
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help="Mean extra exponential upstream delay")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of upstream calls that fail")
+    parser.add_argument('--user-files', type=int, default=200, help="Files in each deleted user's storage")
+    parser.add_argument('--unique-media', action='store_true', help="Defeat the media cache with unique bytes")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra environment for the app, repeatable")
+    parser.add_argument('--host', default=fakes.DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port of the app")
+    parser.add_argument('--fake-base-port', type=int, default=fakes.DEFAULT_BASE_PORT)
+    parser.add_argument('--json', metavar='PATH', help="Also write the full results as JSON")
+    parser.add_argument('--keep-state', action='store_true', help="Keep the app's logs and state directory")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run(args))
+    except ValueError as error:
+        parser.error(str(error))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+# End of main
+
+
+if __name__ == '__main__':
+    main()
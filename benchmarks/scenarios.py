@@ -0,0 +1,163 @@
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+WEBHOOK_SECRET = "whsec_benchmark"
+ACCOUNT_POOL = 16  # Distinct accounts per platform; requests cycle through them
+SUBSCRIPTION_POOL = 32  # Distinct subscriptions the webhook events update
+SCHEDULE_DELAY = 2.0  # Seconds ahead that scheduled posts are set to go out
+
+# Keeps event ids and user ids unique across runs against the same fakes
+RUN_ID = uuid.uuid4().hex[:8]
+
+
+class BenchRequest(NamedTuple):
+    method: str
+    path: str
+    json: Optional[Any] = None
+    content: Optional[bytes] = None
+    headers: Optional[Dict[str, str]] = None
+
+
+# End of BenchRequest
+
+class Scenario(NamedTuple):
+    """
+    One kind of request to drive at the app.
+
+    build turns a request number and the fake service URLs into the request.
+    Background scenarios get a 202 with a status_url, which is polled until
+    the job finishes.
+    """
+    name: str
+    description: str
+    build: Callable[[int, Dict[str, str]], BenchRequest]
+    background: bool = False
+
+
+# End of Scenario
+
+# --- Accounts ---
+def user_id(name: str) -> str:
+    """A stable UUID for a benchmark user, since Supabase Auth only accepts UUIDs."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"loftly-benchmark/{name}"))
+# End of user_id
+
+
+def mastodon_account(number: int, urls: Dict[str, str], platform: str = 'mastodon') -> dict:
+    index = number % ACCOUNT_POOL
+    return {'platform': platform, 'handle': f"bench{index}", 'instance': urls[platform],
+            'access_token': f"{platform}-token-{index}"}
+# End of mastodon_account
+
+
+def bluesky_account(number: int, urls: Dict[str, str]) -> dict:
+    index = number % ACCOUNT_POOL
+    return {'platform': 'bluesky', 'handle': f"bench{index}.bsky.social", 'app_password': f"app-password-{index}"}
+# End of bluesky_account
+
+
+def lemmy_account(number: int, urls: Dict[str, str]) -> dict:
+    # The app adds LEMMY_SCHEME itself, so the instance is host:port
+    index = number % ACCOUNT_POOL
+    instance = urlsplit(urls['lemmy']).netloc
+    return {'platform': 'lemmy', 'handle': f"bench{index}", 'instance': instance,
+            'access_token': f"lemmy-token-{index}",
+            'lemmy_communities': [{'instance': instance, 'community_name': f"bench{community}",
+                                   'community_id': community} for community in (1, 2)]}
+# End of lemmy_account
+
+
+# --- Request Builders ---
+def text_post(number: int, urls: Dict[str, str]) -> BenchRequest:
+    return BenchRequest('POST', '/create-post/', json={
+        'title': f"Benchmark post {number}",
+        'message': f"Benchmark post {number} from run {RUN_ID}",
+        'user_id': user_id(f"user-{number % ACCOUNT_POOL}"),
+        'connected_accounts': [mastodon_account(number, urls), bluesky_account(number, urls),
+                               lemmy_account(number, urls)],
+    })
+# End of text_post
+
+
+def scheduled_post(number: int, urls: Dict[str, str]) -> BenchRequest:
+    request = text_post(number, urls)
+    publish_at = datetime.now(timezone.utc) + timedelta(seconds=SCHEDULE_DELAY)
+    return request._replace(json={**request.json, 'publish_at': publish_at.isoformat()})
+# End of scheduled_post
+
+
+def media_post(number: int, urls: Dict[str, str], background: bool = False) -> BenchRequest:
+    return BenchRequest('POST', '/create-post/?background=true' if background else '/create-post/', json={
+        'message': f"Benchmark media post {number} from run {RUN_ID}",
+        'type': 'media',
+        'media_filenames': ['photo.jpg', 'graphic.png'],
+        'user_id': user_id(f"user-{number % ACCOUNT_POOL}"),
+        'connected_accounts': [mastodon_account(number, urls), mastodon_account(number, urls, 'pixelfed'),
+                               bluesky_account(number, urls)],
+    })
+# End of media_post
+
+
+def sign_webhook(payload: bytes, secret: str = WEBHOOK_SECRET) -> str:
+    """A Stripe-Signature header for the payload, as Stripe computes it."""
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+# End of sign_webhook
+
+
+def stripe_webhook(number: int, urls: Dict[str, str]) -> BenchRequest:
+    index = number % SUBSCRIPTION_POOL
+    now = int(time.time())
+    payload = json.dumps({
+        'id': f"evt_bench_{RUN_ID}_{number}",
+        'object': 'event',
+        'type': 'customer.subscription.updated',
+        'created': now,
+        'data': {'object': {
+            'id': f"sub_bench_{index}",
+            'object': 'subscription',
+            'customer': f"cus_{user_id(f'user-{index}')}",
+            'status': 'active',
+            'items': {'data': [{'price': {'id': 'price_bench_pro'}, 'current_period_end': now + 30 * 86400}]},
+            'plan': {'metadata': {'tier': 'pro'}},
+        }},
+    }).encode()
+    return BenchRequest('POST', '/webhook/stripe', content=payload,
+                        headers={'Content-Type': 'application/json', 'Stripe-Signature': sign_webhook(payload)})
+# End of stripe_webhook
+
+
+def delete_user(number: int, urls: Dict[str, str], background: bool = False) -> BenchRequest:
+    return BenchRequest('POST', '/delete-user?background=true' if background else '/delete-user',
+                        json={'user_id': user_id(f"delete-{RUN_ID}-{number}")})
+# End of delete_user
+
+
+SCENARIOS: Dict[str, Scenario] = {scenario.name: scenario for scenario in [
+    Scenario('text-post', "Text post to Mastodon, Bluesky and two Lemmy communities", text_post),
+    Scenario('scheduled-post', f"The text post, scheduled {SCHEDULE_DELAY:.0f}s ahead; timed until published",
+             scheduled_post, background=True),
+    Scenario('media-post', "Two images to Mastodon, Pixelfed and Bluesky", media_post),
+    Scenario('media-post-background', "The media post, queued; also times each job to completion",
+             lambda number, urls: media_post(number, urls, background=True), background=True),
+    Scenario('stripe-webhook', f"Signed subscription updates spread over {SUBSCRIPTION_POOL} subscriptions",
+             stripe_webhook),
+    Scenario('delete-user', "Delete a user with a storage tree and a Stripe customer", delete_user),
+    Scenario('delete-user-background', "The user deletion, queued; also times each job to completion",
+             lambda number, urls: delete_user(number, urls, background=True), background=True),
+]}
+
+
+def select(names: List[str]) -> List[Scenario]:
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(unknown)}. Choose from {', '.join(SCENARIOS)}")
+    return [SCENARIOS[name] for name in names]
+# End of select
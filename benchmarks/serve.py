@@ -0,0 +1,92 @@
+"""
+The API with an event-loop lag probe, for benchmarks.
+
+    uvicorn benchmarks.serve:app
+
+Adds GET /__bench__/stats, with loop lag since the last reset and the
+app's cache counters, and POST /__bench__/reset. benchmarks.run starts
+this app with every upstream pointed at benchmarks.fakes.
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from benchmarks.stats import summarize
+from main import app
+from platforms import bluesky
+from support import database
+from support.media_cache import cache as media_cache
+
+LAG_INTERVAL = 0.01  # Seconds between probe wakeups
+LAG_SAMPLES = 100_000
+
+
+# --- Loop Lag Probe ---
+class LoopLagProbe:
+    """
+    Measures how late the event loop wakes a task that sleeps LAG_INTERVAL.
+
+    Anything that blocks the loop, like CPU work or a blocking call outside
+    an executor, shows up as lag for every request being served.
+    """
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.samples = deque(maxlen=LAG_SAMPLES)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+
+# End of LoopLagProbe
+
+probe = LoopLagProbe()
+_app_lifespan = app.router.lifespan_context
+
+
+@asynccontextmanager
+async def lifespan(app):
+    async with _app_lifespan(app):
+        probe.start()
+        yield
+        await probe.stop()
+# End of lifespan
+
+
+app.router.lifespan_context = lifespan
+
+
+# --- Benchmark Endpoints ---
+@app.get("/__bench__/stats")
+async def bench_stats():
+    return {
+        'loop_lag_ms': summarize(probe.samples, scale=1000),
+        'caches': {
+            'media': media_cache.stats(),
+            'bluesky_sessions': bluesky.session_stats(),
+            **database.cache_stats(),
+        },
+    }
+# End of bench_stats
+
+
+@app.post("/__bench__/reset")
+async def bench_reset():
+    probe.samples.clear()
+    return {}
+# End of bench_reset
@@ -0,0 +1,34 @@
+import math
+from typing import Dict, Iterable
+
+
+# --- Summaries ---
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+# End of percentile
+
+
+def summarize(values: Iterable[float], scale: float = 1.0) -> Dict[str, float]:
+    """
+    Count, mean, p50/p95/p99 and max of a set of samples.
+
+    Args:
+        values: The samples, in any order.
+        scale: Multiplier applied to every figure, e.g. 1000 for seconds to ms.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * scale, 3),
+        'p50': round(percentile(ordered, 0.50) * scale, 3),
+        'p95': round(percentile(ordered, 0.95) * scale, 3),
+        'p99': round(percentile(ordered, 0.99) * scale, 3),
+        'max': round(ordered[-1] * scale, 3),
+    }
+# End of summarize
@@ -1,20 +1,65 @@
 import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 
-from support import database, models, stripe_api
+from support import (database, history, image_handler, jobs, metrics, models, profiling, publisher, scheduler,
+                     stripe_api, video_handler)
 from support.logger_config import logger
-from platforms import mastodonapi, bluesky, lemmyapi, pixelfedapi
+from platforms import bluesky, lemmyapi, mastodon_pool
 
 # --- Constants ---
 allowed_image_types = {"image/png", "image/jpeg", "image/jpg", "image/webp"}
 allowed_video_types = {"video/mp4", "video/webm"}
 
+job_queue: Optional[jobs.JobQueue] = None
+
+
+# Start and stop shared resources with the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_queue
+    metrics.loop_lag.start()
+    if profiling.watchdog is not None:
+        profiling.watchdog.start()
+    image_handler.start_executor()
+    await database.connect()
+    await history.start_writer()
+    job_queue = jobs.JobQueue(jobs.create_store())
+    job_queue.register('publish_post', publisher.run_publish_job)
+    job_queue.register('stripe_subscription', stripe_api.run_subscription_job)
+    job_queue.register('delete_user', database.run_delete_user_job)
+    app.state.job_queue = job_queue
+    await job_queue.start()
+    stripe_api.start_sweeper(job_queue)
+    await scheduler.start_scheduler()
+    yield
+    await stripe_api.stop_sweeper()
+    # Posts in flight on either path get their grace period at the same time
+    await asyncio.gather(scheduler.stop_scheduler(), job_queue.stop())
+    await history.stop_writer()
+    await image_handler.shutdown_executor()
+    await video_handler.close()
+    await lemmyapi.close()
+    await bluesky.close()
+    mastodon_pool.close()
+    await database.close()
+    await metrics.loop_lag.stop()
+    if profiling.watchdog is not None:
+        await profiling.watchdog.stop()
+# End of lifespan
+
+
 # Initialize the API and CORS
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(stripe_api.stripe_router)
 app.add_middleware(
     CORSMiddleware,
@@ -25,46 +70,166 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500  # What the client gets when call_next raises
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template, not the raw path, so ids do not each become a series
+        route = request.scope.get('route')
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            request.method, route.path if route is not None else 'unmatched', status,
+        ).observe(time.perf_counter() - started)
+# End of record_request_metrics
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # Opt-in: an admin X-Profile header, or PROFILE_SAMPLE_RATE
+    if profiling.should_profile(request):
+        return await profiling.profile_request(request, call_next)
+    return await call_next(request)
+# End of profile_requests
+
+
 # --- API Endpoints ---
+@app.get("/health")
+async def health():
+    return {'status': 'ok'}
+# End of health
+
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    # Only scrapers holding METRICS_TOKEN; without one set, the endpoint does not exist
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not metrics.is_authorized(request.headers.get('Authorization')):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+# End of prometheus_metrics
+
+
 @app.post("/create-post/")
-async def text_post(metadata: models.Post):
-    try:
-        if metadata.media_filenames:
-            metadata.media_filenames = \
-                await database.load_images(metadata.media_filenames, metadata.user_id)
-
-        response = []
-        if metadata.connected_accounts:
-            tasks = []
-            for account in metadata.connected_accounts:
-                if account.platform == 'bluesky':
-                    tasks.append(bluesky.create_post(metadata, account))
-                elif account.platform == 'mastodon':
-                    tasks.append(mastodonapi.create_post(metadata, account))
-                elif account.platform == 'lemmy':
-                    tasks.append(lemmyapi.create_post(metadata, account))
-                elif account.platform == 'pixelfed':
-                    tasks.append(pixelfedapi.create_post(metadata, account))
-
-            if tasks:
-                response = await asyncio.gather(*tasks, return_exceptions=True)
-
-        if metadata.media_filenames:
-            database.delete_images(metadata.media_filenames)
-
-        database.upload_post_history(metadata, response)
+async def text_post(metadata: models.Post, background: bool = False):
+    if metadata.publish_at is not None:
+        publish_at = metadata.publish_at
+        if publish_at.tzinfo is None:
+            publish_at = publish_at.replace(tzinfo=timezone.utc)
+        if publish_at > datetime.now(timezone.utc):
+            return await schedule_post(metadata)
 
-        return response
+    if background:
+        if not metadata.connected_accounts:
+            raise HTTPException(status_code=400, detail="No connected accounts to post to")
+        try:
+            job = await job_queue.submit('publish_post', metadata.model_dump(mode='json'))
+        except Exception as error:
+            logger.error(f"Error queueing post: {error}")
+            raise HTTPException(status_code=500, detail="Error queueing post")
+        return JSONResponse(status_code=202, content={
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f"/posts/{job.id}/status",
+        })
+
+    try:
+        return await publisher.publish_post(metadata)
     except Exception as error:
         logger.error(f"Error creating post: {error}")
         raise HTTPException(status_code=500, detail="Error creating post")
 # End of text_post
 
+
+async def schedule_post(metadata: models.Post) -> JSONResponse:
+    if not metadata.connected_accounts or not metadata.user_id:
+        raise HTTPException(status_code=400, detail="A scheduled post needs a user and connected accounts")
+    try:
+        row = await scheduler.get_scheduler().schedule(metadata)
+    except Exception as error:
+        logger.error(f"Error scheduling post: {error}")
+        raise HTTPException(status_code=500, detail="Error scheduling post")
+    return JSONResponse(status_code=202, content={
+        'schedule_id': row['id'],
+        'status': row['status'],
+        'publish_at': row['publish_at'],
+        'status_url': f"/scheduled-posts/{row['id']}",
+    })
+# End of schedule_post
+
+
+@app.get("/scheduled-posts/{post_id}")
+async def scheduled_post_status(post_id: str):
+    try:
+        post = await database.get_scheduled_post(post_id)
+    except Exception as error:
+        logger.error(f"Error fetching scheduled post {post_id}: {error}")
+        raise HTTPException(status_code=500, detail="Error fetching scheduled post")
+    if post is None:
+        raise HTTPException(status_code=404, detail="Scheduled post not found")
+    return post
+# End of scheduled_post_status
+
+
+@app.delete("/scheduled-posts/{post_id}")
+async def cancel_scheduled_post(post_id: str):
+    post = await scheduled_post_status(post_id)
+    if not await scheduler.get_scheduler().cancel(post_id):
+        raise HTTPException(status_code=409, detail=f"Post is already {post['status']}")
+    return {'schedule_id': post_id, 'status': 'cancelled'}
+# End of cancel_scheduled_post
+
+
+@app.get("/posts/{job_id}/status")
+async def post_status(job_id: str):
+    job = await job_queue.store.get(job_id)
+    if job is None or job.kind != 'publish_post':
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'stage': job.progress.get('stage'),
+        'platforms': job.progress.get('platforms', []),
+        'result': job.result,
+    }
+# End of post_status
+
+
 @app.post("/delete-user")
-async def delete_user(request: models.DeleteUserRequest):
+async def delete_user(request: models.DeleteUserRequest, background: bool = False):
+    if background:
+        try:
+            job = await job_queue.submit('delete_user', {'user_id': request.user_id})
+        except Exception as error:
+            logger.error(f"Error queueing user deletion: {error}")
+            raise HTTPException(status_code=500, detail="Error queueing user deletion")
+        return JSONResponse(status_code=202, content={
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f"/delete-user/{job.id}/status",
+        })
+
     try:
-        return database.delete_user(request.user_id)
+        return await database.delete_user(request.user_id)
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"Error deleting user")
-# End of delete_user
\ No newline at end of file
+# End of delete_user
+
+
+@app.get("/delete-user/{job_id}/status")
+async def delete_user_status(job_id: str):
+    job = await job_queue.store.get(job_id)
+    if job is None or job.kind != 'delete_user':
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'result': job.result,
+    }
+# End of delete_user_status
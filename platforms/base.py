@@ -0,0 +1,278 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+from abc import ABC, abstractmethod
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, FrozenSet, List, NamedTuple, Optional
+
+from support import image_handler, metrics, models, resilience, video_handler
+from support.cache import TTLCache
+from support.logger_config import logger
+
+IMAGE_FORMATS = frozenset({"image/jpeg", "image/png", "image/webp"})
+
+# Platform references to uploaded images, keyed by platform, account and image hash
+MEDIA_ID_CACHE_SIZE = int(os.getenv("MEDIA_ID_CACHE_SIZE", "1024"))
+_media_ids = TTLCache(MEDIA_ID_CACHE_SIZE, 3600)
+metrics.register_cache("media_ids", _media_ids.stats)
+
+
+# --- Capabilities ---
+class Capabilities(NamedTuple):
+    """What a platform accepts in a single post."""
+    max_images: int = 0
+    max_image_kb: int = 0
+    formats: FrozenSet[str] = frozenset()
+    requires_media: bool = False
+    max_video_kb: int = 0
+    video_formats: FrozenSet[str] = video_handler.VIDEO_FORMATS
+
+    @property
+    def media_profile(self) -> Optional[image_handler.MediaProfile]:
+        """The compression target shared by every platform with the same limits."""
+        if self.max_images <= 0:
+            return None
+        return image_handler.MediaProfile(target_size_kb=self.max_image_kb, max_images=self.max_images,
+                                          formats=self.formats or IMAGE_FORMATS)
+
+    @property
+    def video_profile(self) -> Optional[video_handler.VideoProfile]:
+        """The video limits, or None for platforms that don't take video."""
+        if self.max_video_kb <= 0:
+            return None
+        return video_handler.VideoProfile(max_size_kb=self.max_video_kb, formats=self.video_formats)
+
+
+# End of Capabilities
+
+class PlatformError(Exception):
+    """A failure that should be reported to the user with this message."""
+
+
+# End of PlatformError
+
+class PublishContext:
+    """State for one account's post, handed through every lifecycle step."""
+
+    def __init__(self, metadata: models.Post, account: models.ConnectedAccount,
+                 media: Optional[List[image_handler.PreparedImage]] = None,
+                 deadline: Optional[resilience.Deadline] = None,
+                 video: Optional[video_handler.PreparedVideo] = None,
+                 previous: Optional[List[Dict]] = None):
+        self.metadata = metadata
+        self.account = account
+        self.media = media or []
+        self.video = video
+        self.previous = previous or []  # Results of an interrupted attempt, one per destination
+        self.deadline = deadline or resilience.Deadline()
+        self.client: Any = None
+        self.uploaded: List[Any] = []
+        self.media_refs: List[tuple] = []  # (media id cache key, reference, reused from the cache)
+
+
+# End of PublishContext
+
+def account_key(account: models.ConnectedAccount) -> str:
+    """
+    Identify the account a platform reference belongs to.
+
+    Handles may be missing, so the key hashes the account's credential along
+    with its DID or handle; accounts without a handle never share uploads.
+    """
+    credential = account.access_token or account.app_password or ''
+    return hashlib.sha256(f"{account.did or account.handle}\0{credential}".encode()).hexdigest()
+# End of account_key
+
+
+# --- Adapter Interface ---
+class PlatformAdapter(ABC):
+    """
+    One social platform, driven through a fixed lifecycle:
+    prepare_media, authenticate, upload_media, publish.
+
+    Steps raise PlatformError with a user-facing message, and run turns that
+    (or any unexpected error) into a BuildPostResponse. Results are always a
+    list, since some platforms publish to several destinations per account.
+
+    Network calls go through call(), which bounds them by the adapter's
+    timeout and the post's deadline, retries transient failures under
+    retry_policy, and trips a circuit breaker per instance host.
+    """
+
+    name: str = ""
+    display_name: str = ""
+    capabilities: Capabilities = Capabilities()
+    timeout: float = 30.0
+    retry_policy: resilience.RetryPolicy = resilience.NO_RETRY
+    media_id_ttl: float = 0  # Seconds an uploaded image's reference may be reused; 0 disables
+    media_ids_single_use: bool = True  # Whether a reference is spent once a post uses it
+    unpublished_media_id_ttl: Optional[float] = None  # Reuse window for a failed run's uploads; None keeps media_id_ttl
+
+    def host(self, context: PublishContext) -> str:
+        """The host whose circuit breaker guards this account's calls."""
+        return context.account.instance or self.name
+
+    def is_transient(self, error: BaseException) -> bool:
+        """Whether an error is worth retrying and counts against the host's breaker."""
+        return False
+
+    async def call(self, context: PublishContext, func: Callable[..., Awaitable], *args,
+                   retry: bool = True, host: Optional[str] = None, timeout: Optional[float] = None,
+                   retry_timeouts: bool = True, **kwargs):
+        return await resilience.call(
+            func, *args,
+            deadline=context.deadline,
+            timeout=timeout or self.timeout,
+            policy=self.retry_policy if retry else resilience.NO_RETRY,
+            breaker=resilience.breaker_for(host or self.host(context)),
+            is_transient=self.is_transient,
+            target=self.name,
+            retry_timeouts=retry_timeouts,
+            **kwargs)
+
+    async def upload_cached(self, context: PublishContext, data: bytes, upload: Callable[[], Awaitable]) -> Any:
+        """
+        Run upload(), unless the same bytes were uploaded for this account recently.
+
+        A retry after a failed publish, or a repeat post, then reuses the
+        platform's reference instead of sending the image again.
+        """
+        if not self.media_id_ttl:
+            return await upload()
+
+        key = (self.name, self.host(context), account_key(context.account), hashlib.sha256(data).hexdigest())
+        reference = _media_ids.get(key)
+        if reference is not None:
+            context.media_refs.append((key, reference, True))
+            return reference
+
+        reference = await upload()
+        _media_ids.set(key, reference, ttl=self.media_id_ttl)
+        context.media_refs.append((key, reference, False))
+        return reference
+
+    def _release_media_refs(self, context: PublishContext, published: bool) -> None:
+        for key, reference, reused in context.media_refs:
+            # Spent references go, and so do reused ones after a failure, since they may be the cause
+            if (published and self.media_ids_single_use) or (not published and reused):
+                _media_ids.pop(key)
+            elif published:
+                # A post now references the upload, so a window shortened by a failed run no longer applies
+                _media_ids.set(key, reference, ttl=self.media_id_ttl)
+            elif self.unpublished_media_id_ttl is not None:
+                # Uploads no post references may be discarded by the platform well before media_id_ttl
+                _media_ids.set(key, reference, ttl=min(self.media_id_ttl, self.unpublished_media_id_ttl))
+
+    def prepare_media(self, context: PublishContext) -> None:
+        """Check the images or video prepared for this platform before anything is sent."""
+        if context.video is not None:
+            if context.video.error is not None:
+                raise PlatformError(f"Failed to process video {context.video.name}")
+            # A post carries either a video or images, never both
+            context.media = []
+            return
+        context.media = context.media[:self.capabilities.max_images]
+        if self.capabilities.requires_media and not context.media:
+            raise PlatformError(f"{self.display_name} requires at least one image.")
+        for image in context.media:
+            if image.error is not None:
+                raise PlatformError(f"Failed to compress image {image.name}")
+
+    def session(self, context: PublishContext) -> AsyncContextManager:
+        """Held for the whole post, for platforms that must serialize per account."""
+        return contextlib.nullcontext()
+
+    @abstractmethod
+    async def authenticate(self, context: PublishContext) -> Any:
+        """Return a ready API client for the account."""
+
+    async def upload_media(self, context: PublishContext) -> List[Any]:
+        """Upload context.media and return platform references, in order."""
+        return []
+
+    async def upload_video(self, context: PublishContext) -> Any:
+        """Upload context.video and return the platform's reference to it."""
+        raise PlatformError(f"{self.display_name} does not support video")
+
+    @abstractmethod
+    async def publish(self, context: PublishContext) -> List[Dict]:
+        """Create the post and return a BuildPostResponse per destination."""
+
+    def on_failure(self, context: PublishContext, error: BaseException) -> None:
+        """Called with the error after any failed step, e.g. to drop a cached session it spoiled."""
+
+    def _timer(self, phase: str):
+        return metrics.timer(metrics.PLATFORM_PHASE_SECONDS, outcome=True, platform=self.name, phase=phase)
+
+    def _failed(self, context: PublishContext, error: BaseException) -> None:
+        self._release_media_refs(context, published=False)
+        self.on_failure(context, error)
+
+    async def run(self, metadata: models.Post, account: models.ConnectedAccount,
+                  media: Optional[List[image_handler.PreparedImage]] = None,
+                  deadline: Optional[resilience.Deadline] = None,
+                  video: Optional[video_handler.PreparedVideo] = None,
+                  previous: Optional[List[Dict]] = None) -> List[Dict]:
+        context = PublishContext(metadata, account, media, deadline, video, previous)
+        try:
+            self.prepare_media(context)
+        except PlatformError as error:
+            return [models.BuildPostResponse(account, 'error', str(error))]
+
+        step = 'initialize'
+        try:
+            # Nothing, including waiting for the session, may outlive the deadline
+            async with asyncio.timeout(context.deadline.remaining()), self.session(context):
+                with self._timer('authenticate'):
+                    context.client = await self.authenticate(context)
+                step = 'upload media'
+                if context.video is not None:
+                    with self._timer('upload_video'):
+                        context.uploaded = [await self.upload_video(context)]
+                elif context.media:
+                    with self._timer('upload_media'):
+                        context.uploaded = await self.upload_media(context)
+                step = 'publish'
+                with self._timer('publish'):
+                    results = await self.publish(context)
+            self._release_media_refs(context, published=True)
+            return results
+        except PlatformError as error:
+            self._failed(context, error)
+            return [models.BuildPostResponse(account, 'error', str(error))]
+        except resilience.CircuitOpenError as error:
+            self._failed(context, error)
+            logger.warning(f'{self.display_name} skipped at {step}: {error}')
+            return [models.BuildPostResponse(
+                account, 'error', f'{self.display_name} ({error.host}) is unavailable, try again later')]
+        except TimeoutError as error:
+            self._failed(context, error)
+            logger.error(f'{self.display_name} timed out during {step}')
+            return [models.BuildPostResponse(account, 'error', f'Timed out posting to {self.display_name}')]
+        except Exception as error:
+            self._failed(context, error)
+            logger.error(f'{self.display_name} failed to {step}: {type(error).__name__}: {error}')
+            return [models.BuildPostResponse(
+                account, 'error', f'Failed to post: {metadata.message} to {self.display_name}')]
+
+
+# End of PlatformAdapter
+
+# --- Registry ---
+_adapters: Dict[str, PlatformAdapter] = {}
+
+
+def register(adapter: PlatformAdapter) -> PlatformAdapter:
+    _adapters[adapter.name] = adapter
+    return adapter
+# End of register
+
+
+def get_adapter(name: Optional[str]) -> Optional[PlatformAdapter]:
+    return _adapters.get(name)
+# End of get_adapter
+
+
+def adapters() -> List[PlatformAdapter]:
+    return list(_adapters.values())
+# End of adapters
@@ -1,86 +1,241 @@
 import asyncio
-import mimetypes
-from typing import List
+import hashlib
+import os
+import time
+from typing import List, Optional
 
-from atproto import Client
-from atproto_client.models.app.bsky import embed
+import httpx
+from atproto import AsyncClient, Session, SessionEvent, models as atproto_models
+from atproto_client.exceptions import (BadRequestError, LoginRequiredError, NetworkError, RequestException,
+                                       UnauthorizedError)
+from atproto_client.models.utils import get_response_model
+from atproto_client.request import AsyncRequest
 
-from support import image_handler, models
+from platforms.base import Capabilities, IMAGE_FORMATS, PlatformAdapter, PlatformError, PublishContext, register
+from support import image_handler, metrics, models, resilience, video_handler
+from support.cache import KeyedLock, TTLCache
+from support.concurrency import gather_limited
 from support.logger_config import logger
 
-client = Client()
+# Bluesky accepts up to 4 images of at most 976 KB each, or one video
+CAPABILITIES = Capabilities(max_images=4, max_image_kb=976, formats=IMAGE_FORMATS,
+                            max_video_kb=int(os.getenv("BLUESKY_MAX_VIDEO_KB", "51200")),
+                            video_formats=frozenset({"video/mp4", "video/webm", "video/quicktime"}))
+UPLOAD_CONCURRENCY = int(os.getenv("BLUESKY_UPLOAD_CONCURRENCY", "4"))
+BLUESKY_TIMEOUT = float(os.getenv("BLUESKY_TIMEOUT", "20"))
+BLUESKY_HOST = "bsky.social"
+BLUESKY_BASE_URL = os.getenv("BLUESKY_BASE_URL") or None  # XRPC endpoint, the SDK's default when unset
+# Blobs stay in the repo while a post references them, so they can back repeat posts
+BLUESKY_BLOB_TTL = float(os.getenv("BLUESKY_BLOB_TTL", "3600"))
+# Blobs no post references are garbage collected by the PDS within minutes, so a failed post's go sooner
+BLUESKY_UNPUBLISHED_BLOB_TTL = float(os.getenv("BLUESKY_UNPUBLISHED_BLOB_TTL", "120"))
+# XRPC error names a PDS answers with when the session itself is no longer valid
+SESSION_ERRORS = frozenset({"ExpiredToken", "InvalidToken", "AuthenticationRequired", "AccountTakedown"})
 
+# Logged-in clients are reused per account until their refresh token runs out
+BLUESKY_SESSION_CACHE_SIZE = int(os.getenv("BLUESKY_SESSION_CACHE_SIZE", "256"))
+BLUESKY_SESSION_TTL = float(os.getenv("BLUESKY_SESSION_TTL", "86400"))
+REFRESH_MARGIN = 300  # Seconds before refresh token expiry to stop reusing a session
 
-# --- Upload Functions ---
-async def create_post(metadata: models.Post, account: models.ConnectedAccount) -> dict:
-    """
-    Create and upload a post with optional images to Bluesky.
+# Shared by every client: loading the CA bundle for each new one blocked the event loop for 20-180 ms
+SSL_CONTEXT = httpx.create_ssl_context()
 
-    Args:
-        metadata: Post metadata including message and media filenames.
-        account: ConnectedAccount with handle and app_password.
 
-    Returns:
-        BuildPostResponse with status and details.
-    """
-    try:
-        client.login(account.handle, account.app_password)
-    except Exception as error:
-        logger.error(f'Failed to initialize Bluesky client: {error}')
-        return models.BuildPostResponse(
-            account, 'error', "Failed to initialize Bluesky client")
-
-    # Create the message
-    image_responses: List = []
-    local_paths: List[str] = []
-
-    # Download and compress any images
-    if metadata.media_filenames and len(metadata.media_filenames) > 0:
-        local_paths = metadata.media_filenames
-
-        # Compress Images
-        for i, path in enumerate(local_paths[:4]):
-            mime_type, _ = mimetypes.guess_type(path)
-            try:
-                image_bytes = image_handler.compress_image(path, mime_type)
-            except Exception as error:
-                logger.error(f'Failed to compress image {path}: {error}')
-                return models.BuildPostResponse(
-                    account, 'error', f"Failed to compress image {path}")
-
-            for attempt in range(2):
-                try:
-                    response = client.com.atproto.repo.upload_blob(image_bytes)
-                    image_responses.append(response)
-                    break
-                except Exception as error:
-                    logger.warning(f'Attempt {attempt + 1} failed uploading {path}: {type(error).__name__}: {error}')
-                    await asyncio.sleep(1)
-            else:
-                logger.error(f"Upload failed for {path}")
-                return models.BuildPostResponse(
-                    account, 'error', f"Upload failed for {path}")
-
-    # Upload the post
+class CachedClient:
+    """A logged-in client and the credentials it was created with."""
+
+    def __init__(self, client: AsyncClient, password_digest: str):
+        self.client = client
+        self.password_digest = password_digest
+        self.session: Optional[Session] = None
+        client.on_session_change(self._on_session_change)
+
+    def _on_session_change(self, event: SessionEvent, session: Session) -> None:
+        self.session = session
+
+    def ttl(self) -> float:
+        if self.session is None:
+            return BLUESKY_SESSION_TTL
+        expires_in = self.session.refresh_jwt_payload.exp - time.time() - REFRESH_MARGIN
+        return max(0.0, min(BLUESKY_SESSION_TTL, expires_in))
+
+
+# End of CachedClient
+
+def _close_client(key, cached: CachedClient) -> None:
     try:
-        if len(image_responses) > 0:
-            # Upload Images
+        asyncio.get_running_loop().create_task(cached.client.request.close())
+    except RuntimeError:
+        pass  # No running loop, the client is simply dropped
+# End of _close_client
+
+
+_sessions = TTLCache(BLUESKY_SESSION_CACHE_SIZE, BLUESKY_SESSION_TTL, on_evict=_close_client)
+metrics.register_cache("bluesky_sessions", _sessions.stats)
+_session_locks = KeyedLock()
+
+
+# --- Session Cache ---
+def session_key(account: models.ConnectedAccount) -> str:
+    return account.did or account.handle
+# End of session_key
+
+
+async def get_client(account: models.ConnectedAccount) -> AsyncClient:
+    """
+    Return a logged-in client for the account, logging in only on a cache miss.
+
+    The caller must hold the account's lock from _session_locks. The access
+    token is refreshed by the client itself, so a cached session stays usable
+    until its refresh token is close to expiring.
+    """
+    key = session_key(account)
+    password_digest = hashlib.sha256((account.app_password or '').encode()).hexdigest()
+
+    cached = _sessions.get(key)
+    if cached is not None and cached.password_digest == password_digest:
+        return cached.client
+
+    cached = CachedClient(AsyncClient(BLUESKY_BASE_URL, request=AsyncRequest(verify=SSL_CONTEXT)), password_digest)
+    # The profile fetch sets client.me, which send_post takes the repo DID from, so it must not be skipped
+    await cached.client.login(account.handle, account.app_password, fetch_bsky_profile=True)
+    _sessions.set(key, cached, ttl=cached.ttl())
+    return cached.client
+# End of get_client
+
+
+def is_session_error(error: Optional[BaseException]) -> bool:
+    """Whether an error, or one it was raised from, means the account's session is unusable."""
+    while error is not None:
+        if isinstance(error, (UnauthorizedError, LoginRequiredError)):
+            return True
+        if isinstance(error, BadRequestError) and error.response is not None:
+            if getattr(error.response.content, 'error', None) in SESSION_ERRORS:
+                return True
+        error = error.__cause__
+    return False
+# End of is_session_error
+
+
+def session_stats() -> dict:
+    """Hit/miss counts and hit rate of the session cache."""
+    return _sessions.stats()
+# End of session_stats
+
+
+async def close() -> None:
+    """Drop every cached session and close its HTTP client."""
+    clients = [cached.client for cached in _sessions.drain()]
+    await asyncio.gather(*(client.request.close() for client in clients), return_exceptions=True)
+# End of close
+
+
+# --- Adapter ---
+class BlueskyAdapter(PlatformAdapter):
+    """Posts to Bluesky with an app password, with up to 4 images."""
+
+    name = 'bluesky'
+    display_name = 'Bluesky'
+    capabilities = CAPABILITIES
+
+    timeout = BLUESKY_TIMEOUT
+    media_id_ttl = BLUESKY_BLOB_TTL
+    media_ids_single_use = False
+    unpublished_media_id_ttl = BLUESKY_UNPUBLISHED_BLOB_TTL
+    retry_policy = resilience.RetryPolicy(retries=2, base_delay=0.5)
+
+    def host(self, context: PublishContext) -> str:
+        return BLUESKY_HOST
+
+    def is_transient(self, error: BaseException) -> bool:
+        if isinstance(error, NetworkError):
+            return True
+        response = getattr(error, 'response', None)
+        return isinstance(error, RequestException) and response is not None and response.status_code >= 500
+
+    def session(self, context: PublishContext):
+        # One post at a time per account, so concurrent posts never share a session mid-refresh
+        return _session_locks(session_key(context.account))
+
+    async def authenticate(self, context: PublishContext) -> AsyncClient:
+        try:
+            return await self.call(context, get_client, context.account)
+        except (TimeoutError, resilience.CircuitOpenError):
+            raise
+        except Exception as error:
+            logger.error(f'Failed to initialize Bluesky client: {error}')
+            raise PlatformError("Failed to initialize Bluesky client") from error
+
+    async def upload_media(self, context: PublishContext) -> List:
+        # Upload concurrently, keeping the images in order
+        try:
+            return await gather_limited(
+                [self._upload_image(context, image) for image in context.media], UPLOAD_CONCURRENCY)
+        except image_handler.MediaUploadError as error:
+            raise PlatformError(f"Upload failed for {error.name}")
+
+    async def _upload_image(self, context: PublishContext, image: image_handler.PreparedImage):
+        try:
+            return await self.upload_cached(
+                context, image.data,
+                lambda: self.call(context, context.client.com.atproto.repo.upload_blob, image.data))
+        except (TimeoutError, resilience.CircuitOpenError):
+            raise
+        except Exception as error:
+            logger.error(f"Upload failed for {image.name}: {type(error).__name__}: {error}")
+            raise image_handler.MediaUploadError(image.name) from error
+
+    async def upload_video(self, context: PublishContext):
+        video = context.video
+
+        async def send():
+            # A fresh stream per attempt, read from disk chunk by chunk. upload_blob would hand a
+            # non-JSON body to httpx as data=, so the raw body goes in as content= instead
+            response = await context.client.invoke_procedure(
+                'com.atproto.repo.uploadBlob', content=video_handler.read_chunks(video.path),
+                headers={'Content-Type': video.mime_type, 'Content-Length': str(video.size)},
+                output_encoding='application/json')
+            return get_response_model(response, atproto_models.ComAtprotoRepoUploadBlob.Response)
+
+        try:
+            response = await self.call(context, send, timeout=video_handler.VIDEO_UPLOAD_TIMEOUT)
+            return response.blob
+        except (TimeoutError, resilience.CircuitOpenError):
+            raise
+        except Exception as error:
+            logger.error(f"Upload failed for {video.name}: {type(error).__name__}: {error}")
+            raise PlatformError(f"Upload failed for {video.name}")
+
+    async def publish(self, context: PublishContext) -> List[dict]:
+        metadata = context.metadata
+        if context.video is not None:
+            video_embed = atproto_models.AppBskyEmbedVideo.Main(
+                video=context.uploaded[0], alt=context.video.name or "video")
+            post = await self.call(context, context.client.send_post,
+                                   text=metadata.message, embed=video_embed, retry=False)
+        elif context.uploaded:
             images = [
-                embed.images.Image(
-                    alt=local_paths[i] or "image",
-                    image=image_responses[i].blob
-                ) for i in range(len(image_responses))
+                atproto_models.AppBskyEmbedImages.Image(
+                    alt=image.name or "image",
+                    image=response.blob
+                ) for image, response in zip(context.media, context.uploaded)
             ]
-            image_embed = embed.images.Main(images=images)
-            post = client.send_post(text=metadata.message, embed=image_embed)
+            image_embed = atproto_models.AppBskyEmbedImages.Main(images=images)
+            post = await self.call(context, context.client.send_post,
+                                   text=metadata.message, embed=image_embed, retry=False)
         else:
             # Or a plain text message
-            post = client.send_post(text=metadata.message)
-
-        return models.BuildPostResponse(
-            account, 'success', 'Successfully posted', post.uri, post.cid)
-    except Exception as error:
-        logger.error(f'Failed to post {metadata.message}: {error}')
-        return models.BuildPostResponse(
-            account, 'error', f'Failed to post: {metadata.message} to Bluesky')
-# End of create_post
\ No newline at end of file
+            post = await self.call(context, context.client.send_post, text=metadata.message, retry=False)
+
+        return [models.BuildPostResponse(
+            context.account, 'success', 'Successfully posted', post.uri, post.cid)]
+
+    def on_failure(self, context: PublishContext, error: BaseException) -> None:
+        # Only a session the PDS rejected is dropped; timeouts and outages leave it usable
+        if is_session_error(error):
+            _sessions.pop(session_key(context.account))
+
+
+# End of BlueskyAdapter
+
+adapter = register(BlueskyAdapter())
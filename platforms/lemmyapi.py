@@ -1,35 +1,93 @@
+import asyncio
+import os
 from urllib.parse import urljoin
-from typing import List
+from typing import Dict, List
 
-import requests
+import httpx
 
-from support import models
-from support.models import Post, ConnectedAccount
+from platforms.base import Capabilities, PlatformAdapter, PublishContext, register
+from support import models, resilience
+from support.models import LemmyCommunity
 from support.logger_config import logger
 
+# Connection settings, shared by every Lemmy instance
+LEMMY_SCHEME = os.getenv("LEMMY_SCHEME", "https")  # http only for local stand-in servers
+LEMMY_TIMEOUT = float(os.getenv("LEMMY_TIMEOUT", "10"))
+LEMMY_CONNECT_TIMEOUT = float(os.getenv("LEMMY_CONNECT_TIMEOUT", "5"))
+LEMMY_MAX_CONNECTIONS = int(os.getenv("LEMMY_MAX_CONNECTIONS", "10"))
+LEMMY_CONCURRENCY = int(os.getenv("LEMMY_CONCURRENCY", "4"))  # Posts in flight per instance
 
-# -- LEMMY POST CREATION --
-async def create_post(metadata: Post, account: ConnectedAccount) -> List[models.BuildPostResponse]:
-    """
-    Create and upload a post to Lemmy.
+# One pooled client and concurrency limit per instance, kept for the app's lifetime
+_clients: Dict[str, httpx.AsyncClient] = {}
+_instance_slots: Dict[str, asyncio.Semaphore] = {}
+
+
+# -- CLIENT POOL --
+def get_client(instance: str) -> httpx.AsyncClient:
+    """Return the keep-alive client for a Lemmy instance, creating it on first use."""
+    client = _clients.get(instance)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=f'{LEMMY_SCHEME}://{instance}',
+            timeout=httpx.Timeout(LEMMY_TIMEOUT, connect=LEMMY_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=LEMMY_MAX_CONNECTIONS,
+                                max_keepalive_connections=LEMMY_MAX_CONNECTIONS),
+        )
+        _clients[instance] = client
+        _instance_slots[instance] = asyncio.Semaphore(LEMMY_CONCURRENCY)
+    return client
+# End of get_client
+
+
+async def close() -> None:
+    """Close every pooled Lemmy client."""
+    clients = list(_clients.values())
+    _clients.clear()
+    _instance_slots.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+# End of close
 
-    Args:
-        metadata: Post metadata including title, message, and media filenames.
-        account: ConnectedAccount with access_token and communities.
 
-    Returns:
-        List of BuildPostResponse objects for each community.
+# -- LEMMY ADAPTER --
+class LemmyAdapter(PlatformAdapter):
     """
-    headers = {
-        'Authorization': f'Bearer {account.access_token}',
-        'Content-Type': 'application/json'
-    }
+    Creates a link/text post in every community linked to the account.
+
+    Posts go out concurrently, with at most LEMMY_CONCURRENCY requests in
+    flight per instance, and each community gets its own result.
+    """
+
+    name = 'lemmy'
+    display_name = 'Lemmy'
+    capabilities = Capabilities()
+    timeout = LEMMY_TIMEOUT
+
+    async def authenticate(self, context: PublishContext) -> dict:
+        return {
+            'Authorization': f'Bearer {context.account.access_token}',
+            'Content-Type': 'application/json'
+        }
+
+    def is_transient(self, error: BaseException) -> bool:
+        if isinstance(error, httpx.TransportError):
+            return True
+        return isinstance(error, httpx.HTTPStatusError) and error.response.status_code >= 500
+
+    async def publish(self, context: PublishContext) -> List[models.BuildPostResponse]:
+        async def post(index: int, community: LemmyCommunity) -> models.BuildPostResponse:
+            # A resumed post keeps the communities an earlier attempt already posted to
+            if index < len(context.previous) and context.previous[index].get('status') == 'success':
+                return context.previous[index]
+            return await self.post_to_community(context, community)
 
-    results = []
+        communities = context.account.lemmy_communities or []
+        return list(await asyncio.gather(*(post(index, community) for index, community in enumerate(communities))))
 
-    for community in account.lemmy_communities:
-        base_url = 'https://' + community.instance
-        endpoint = urljoin(base_url, '/api/v3/post')
+    async def post_to_community(self, context: PublishContext,
+                                community: LemmyCommunity) -> models.BuildPostResponse:
+        metadata, account = context.metadata, context.account
+        base_url = f'{LEMMY_SCHEME}://{community.instance}'
+        client = get_client(community.instance)
 
         post_data = {
             'name': metadata.title or 'Untitled Post',
@@ -40,26 +98,35 @@ async def create_post(metadata: Post, account: ConnectedAccount) -> List[models.
             'url': metadata.lemmy_image_url or None,
         }
 
-        try:
-            response = requests.post(endpoint, headers=headers, json=post_data)
+        async def send() -> dict:
+            async with _instance_slots[community.instance]:
+                response = await client.post('/api/v3/post', headers=context.client, json=post_data)
             response.raise_for_status()
-            post_info = response.json()
+            return response.json()
+
+        try:
+            # Creating a post is not idempotent, so it is never retried
+            post_info = await self.call(context, send, retry=False, host=community.instance)
 
             post_id = post_info['post_view']['post']['id']
             post_url = urljoin(base_url, f"post/{post_id}")
 
-            results.append(
-                models.BuildPostResponse(
-                    account, 'success', f'Successfully posted to {community.community_name}', post_url, post_id))
-        except requests.HTTPError as error:
-            logger.error(f'Failed to post to {community.community_name}: {error}')
-            results.append(
-                models.BuildPostResponse(
-                    account, 'error', f'Failed to post to {community.community_name}'))
+            return models.BuildPostResponse(
+                account, 'success', f'Successfully posted to {community.community_name}', post_url, post_id)
+        except resilience.CircuitOpenError as error:
+            logger.warning(f'Skipped {community.community_name}: {error}')
+            return models.BuildPostResponse(
+                account, 'error', f'{community.instance} is unavailable, try again later')
+        except TimeoutError:
+            logger.error(f'Timed out posting to {community.community_name}')
+            return models.BuildPostResponse(
+                account, 'error', f'Timed out posting to {community.community_name}')
         except Exception as error:
             logger.error(f'Failed to post to {community.community_name}: {error}')
-            results.append(
-                models.BuildPostResponse(
-                    account, 'error', f'Failed to post to {community.community_name}'))
+            return models.BuildPostResponse(
+                account, 'error', f'Failed to post to {community.community_name}')
+
+
+# End of LemmyAdapter
 
-    return results
+adapter = register(LemmyAdapter())
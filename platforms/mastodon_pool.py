@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import os
+from functools import partial
+from typing import Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from mastodon import Mastodon
+
+from support.cache import TTLCache
+
+# Shared by Mastodon and Pixelfed, which both speak the Mastodon API
+MASTODON_POOL_SIZE = int(os.getenv("MASTODON_POOL_SIZE", "10"))  # Connections kept per instance host
+MASTODON_MAX_HOSTS = int(os.getenv("MASTODON_MAX_HOSTS", "64"))
+MASTODON_CLIENT_CACHE_SIZE = int(os.getenv("MASTODON_CLIENT_CACHE_SIZE", "512"))
+MASTODON_IDLE_TTL = float(os.getenv("MASTODON_IDLE_TTL", "600"))
+MASTODON_TIMEOUT = float(os.getenv("MASTODON_TIMEOUT", "30"))
+
+
+def _close_session(host: str, session: requests.Session) -> None:
+    session.close()
+# End of _close_session
+
+
+# One pooled requests session per host, and one client per (instance, token)
+_sessions = TTLCache(MASTODON_MAX_HOSTS, MASTODON_IDLE_TTL, on_evict=_close_session, sliding=True)
+_clients = TTLCache(MASTODON_CLIENT_CACHE_SIZE, MASTODON_IDLE_TTL, sliding=True)
+
+
+# --- Client Factory ---
+def instance_host(instance: str) -> str:
+    return instance.split("://", 1)[-1].strip("/").lower()
+# End of instance_host
+
+
+def get_session(host: str) -> requests.Session:
+    """Return the keep-alive session for an instance host, creating it on first use."""
+    session = _sessions.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MASTODON_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions.set(host, session)
+    return session
+# End of get_session
+
+
+def get_client(instance: str, access_token: str) -> Mastodon:
+    """
+    Return a Mastodon API client for an account, reusing cached ones.
+
+    Clients for the same host share one pooled session, so statuses to a busy
+    instance reuse its open connections instead of handshaking every time.
+    A client whose session has since been evicted, and closed, is rebuilt
+    on the host's current one.
+    """
+    host = instance_host(instance)
+    key = (host, hashlib.sha256((access_token or "").encode()).hexdigest())
+
+    session = get_session(host)  # Also keeps the shared session from idling out under a busy client
+    client = _clients.get(key)
+    if client is None or client.session is not session:
+        client = Mastodon(
+            access_token=access_token,
+            api_base_url=instance,
+            request_timeout=MASTODON_TIMEOUT,
+            ratelimit_method='throw',  # Rate limits are retried with backoff inside the post deadline
+            session=session,
+        )
+        _clients.set(key, client)
+    return client
+# End of get_client
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Run a blocking Mastodon.py call on a worker thread."""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+# End of run_blocking
+
+
+def stats() -> dict:
+    return {'clients': _clients.stats(), 'sessions': _sessions.stats()}
+# End of stats
+
+
+def close() -> None:
+    """Close every pooled session."""
+    _clients.clear()
+    _sessions.clear()
+# End of close
@@ -1,70 +1,134 @@
-import mimetypes
+import asyncio
 import os
+from typing import List
 
-from mastodon import Mastodon, MastodonError
+import httpx
+from mastodon import Mastodon, MastodonError, MastodonNetworkError, MastodonRatelimitError, MastodonServerError
 
-from support import image_handler, models
+from platforms import mastodon_pool
+from platforms.base import Capabilities, IMAGE_FORMATS, PlatformAdapter, PlatformError, PublishContext, register
+from support import image_handler, models, resilience, video_handler
+from support.concurrency import gather_limited
 from support.logger_config import logger
 
+# Mastodon accepts up to 4 images or one video per status
+CAPABILITIES = Capabilities(max_images=4, max_image_kb=976, formats=IMAGE_FORMATS,
+                            max_video_kb=int(os.getenv("MASTODON_MAX_VIDEO_KB", "40960")))
+UPLOAD_CONCURRENCY = int(os.getenv("MASTODON_UPLOAD_CONCURRENCY", "4"))
+# Unattached media is only removed by the instance after a day, so a retry can reuse it
+MEDIA_ID_TTL = float(os.getenv("MASTODON_MEDIA_ID_TTL", "3600"))
 
-# --- Upload Functions ---
-async def create_post(metadata: models.Post, account: models.ConnectedAccount) -> dict:
-    """
-    Create and upload a post to Mastodon, with optional images.
-
-    Args:
-        metadata: Post metadata including message and media filenames.
-        account: ConnectedAccount with access_token and instance.
-
-    Returns:
-        BuildPostResponse with status and details.
-    """
-    try:
-        mastodon = Mastodon(
-            access_token=account.access_token,
-            api_base_url=account.instance,
-        )
-    except Exception as error:
-        logger.error(f'Failed to initialize Mastodon client: {error}')
-        return models.BuildPostResponse(
-            account, 'error', f"Failed to initialize Mastodon client")
-
-    message = metadata.message or ""
-    media_ids = []
-
-    # Download and upload media (max 4 images)
-    if metadata.media_filenames and len(metadata.media_filenames) > 0:
-        local_paths = metadata.media_filenames
-
-        for i, file in enumerate(local_paths[:4]):
-            mime_type, _ = mimetypes.guess_type(file)
-
-            try:
-                image_bytes = image_handler.compress_image(file, mime_type)
-            except Exception as error:
-                logger.error(f'Failed to compress image {file}: {error}')
-                return models.BuildPostResponse(
-                    account, 'error', f"Failed to compress image {file}")
-
-            try:
-                media = mastodon.media_post(
-                    media_file=image_bytes,
-                    mime_type=mime_type,
-                    description=os.path.basename(file) or "Image"
-                )
-                media_ids.append(media['id'])
-            except MastodonError as error:
-                logger.error(f'Failed to upload image {file}: {error}')
-                return models.BuildPostResponse(
-                    account, 'error', f"Upload failed for {file}")
-
-    # Try to post
-    try:
-        post = mastodon.status_post(status=message, media_ids=media_ids or None)
-
-        return models.BuildPostResponse(
-            account, 'success', 'Successfully posted', post.url, post.id)
-    except MastodonError as error:
-        logger.error(f'Failed to post: {metadata.message} to Mastodon: {error}')
-        return models.BuildPostResponse(
-            account, 'error', f'Failed to post: {metadata.message} to Mastodon')
+
+# --- Adapter ---
+class MastodonAdapter(PlatformAdapter):
+    """Posts a status with optional images through the Mastodon API."""
+
+    name = 'mastodon'
+    display_name = 'Mastodon'
+    capabilities = CAPABILITIES
+    upload_concurrency = UPLOAD_CONCURRENCY
+    media_endpoint = '/api/v2/media'  # Asynchronous processing, polled until ready
+    timeout = mastodon_pool.MASTODON_TIMEOUT
+    media_id_ttl = MEDIA_ID_TTL  # Ids are single use: a status can't reuse attached media
+    retry_policy = resilience.RetryPolicy(retries=2, base_delay=0.5)
+
+    def host(self, context: PublishContext) -> str:
+        return mastodon_pool.instance_host(context.account.instance or '')
+
+    def is_transient(self, error: BaseException) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500 or error.response.status_code == 429
+        return isinstance(error, (MastodonNetworkError, MastodonServerError, MastodonRatelimitError,
+                                  httpx.TransportError))
+
+    async def authenticate(self, context: PublishContext) -> Mastodon:
+        try:
+            return mastodon_pool.get_client(context.account.instance, context.account.access_token)
+        except Exception as error:
+            logger.error(f'Failed to initialize {self.display_name} client: {error}')
+            raise PlatformError(f"Failed to initialize {self.display_name} client")
+
+    async def upload_media(self, context: PublishContext) -> List:
+        # Upload concurrently, keeping the media ids in order
+        try:
+            return await gather_limited(
+                [self._upload_image(context, image) for image in context.media], self.upload_concurrency)
+        except image_handler.MediaUploadError as error:
+            raise PlatformError(self.upload_error(error.name))
+
+    def upload_error(self, name: str) -> str:
+        return f"Upload failed for {name}"
+
+    async def _upload_image(self, context: PublishContext, image: image_handler.PreparedImage):
+        async def upload():
+            # A timed-out upload carries on in its thread, so a retry would send a second copy
+            uploaded = await self.call(
+                context, mastodon_pool.run_blocking,
+                context.client.media_post,
+                media_file=image.data,
+                mime_type=image.mime_type,
+                description=os.path.basename(image.name) or "Image",
+                retry_timeouts=False
+            )
+            return uploaded['id']
+
+        try:
+            return await self.upload_cached(context, image.data, upload)
+        except MastodonError as error:
+            logger.error(f'Failed to upload image {image.name} to {self.display_name}: {error}')
+            raise image_handler.MediaUploadError(image.name) from error
+
+    async def upload_video(self, context: PublishContext) -> str:
+        """
+        Stream the video to the instance and wait until it has been processed.
+
+        Mastodon.py would read the whole file into a multipart body, so the
+        upload goes through httpx, with the file streamed from disk.
+        """
+        video = context.video
+        http = video_handler.get_http_client()
+        base_url = context.client.api_base_url.rstrip('/')
+        headers = {'Authorization': f'Bearer {context.account.access_token}'}
+
+        async def send() -> dict:
+            # A fresh body per attempt
+            form_headers, body = video_handler.multipart_body(
+                video, 'file', {'description': os.path.basename(video.name) or "Video"})
+            response = await http.post(base_url + self.media_endpoint, headers={**headers, **form_headers},
+                                       content=body)
+            response.raise_for_status()
+            return response.json()
+
+        async def poll(media_id: str) -> dict:
+            response = await http.get(f'{base_url}/api/v1/media/{media_id}', headers=headers)
+            response.raise_for_status()
+            return response.json()
+
+        try:
+            media = await self.call(context, send, timeout=video_handler.VIDEO_UPLOAD_TIMEOUT)
+            # The url stays empty until the instance has finished transcoding
+            while media.get('url') is None:
+                await asyncio.sleep(video_handler.VIDEO_POLL_INTERVAL)
+                media = await self.call(context, poll, media['id'])
+            return media['id']
+        except (TimeoutError, resilience.CircuitOpenError):
+            raise
+        except Exception as error:
+            logger.error(f'Failed to upload video {video.name} to {self.display_name}: {error}')
+            raise PlatformError(self.upload_error(video.name))
+
+    async def publish(self, context: PublishContext) -> List[dict]:
+        post = await self.call(
+            context, mastodon_pool.run_blocking,
+            context.client.status_post,
+            status=context.metadata.message or "",
+            media_ids=context.uploaded or None,
+            retry=False)
+
+        return [models.BuildPostResponse(
+            context.account, 'success', 'Successfully posted', post.url, post.id)]
+
+
+# End of MastodonAdapter
+
+adapter = register(MastodonAdapter())
@@ -1,75 +1,47 @@
-import mimetypes
 import os
-
-from mastodon import Mastodon, MastodonError
-
-from support import image_handler, models
-from support.logger_config import logger
-
-
-# --- Upload to Pixelfed ---
-async def create_post(metadata: models.Post, account: models.ConnectedAccount) -> dict:
-    """
-    Create and upload a post to Pixelfed, with required images.
-
-    Args:
-        metadata: Post metadata including message and media filenames.
-        account: ConnectedAccount with access_token and instance.
-
-    Returns:
-        BuildPostResponse with status and details.
-    """
-    try:
-        mastodon = Mastodon(
-            access_token=account.access_token,
-            api_base_url=account.instance,
+from typing import List
+
+from platforms import mastodon_pool
+from platforms.base import Capabilities, PublishContext, register
+from platforms.mastodonapi import MastodonAdapter
+from support import models
+
+# Pixelfed accepts up to 10 images or one video per post, and needs at least one.
+# WebP is not in Pixelfed's default MEDIA_TYPES, so only JPEG and PNG are sent
+CAPABILITIES = Capabilities(max_images=10, max_image_kb=976, formats=frozenset({"image/jpeg", "image/png"}),
+                            requires_media=True,
+                            max_video_kb=int(os.getenv("PIXELFED_MAX_VIDEO_KB", "15000")),
+                            video_formats=frozenset({"video/mp4"}))
+UPLOAD_CONCURRENCY = int(os.getenv("PIXELFED_UPLOAD_CONCURRENCY", "4"))
+
+
+# --- Adapter ---
+class PixelfedAdapter(MastodonAdapter):
+    """Pixelfed speaks the Mastodon API, but every post needs images and is public."""
+
+    name = 'pixelfed'
+    display_name = 'Pixelfed'
+    capabilities = CAPABILITIES
+    upload_concurrency = UPLOAD_CONCURRENCY
+    media_endpoint = '/api/v1/media'
+
+    def upload_error(self, name: str) -> str:
+        return f"Failed to upload image {name} to Pixelfed"
+
+    async def publish(self, context: PublishContext) -> List[dict]:
+        post = await self.call(
+            context, mastodon_pool.run_blocking,
+            context.client.status_post,
+            status=context.metadata.message or "",
+            media_ids=context.uploaded,
+            visibility='public',
+            retry=False
         )
-    except Exception as error:
-        logger.error(f'Failed to initialize Pixelfed client: {error}')
-        return models.BuildPostResponse(
-            account, 'error', f"Failed to initialize Pixelfed client")
-
-    message = metadata.message or ""
-    local_paths = metadata.media_filenames or []
-    media_ids = []
-
-    if not local_paths:
-        logger.error(f'No media filenames provided.')
-        return models.BuildPostResponse(
-            account, 'error', "Pixelfed requires at least one image.")
 
-    for i, path in enumerate(local_paths[:10]):
-        mime_type, _ = mimetypes.guess_type(path)
+        return [models.BuildPostResponse(
+            context.account, 'success', 'Successfully posted', post.url, post.id)]
 
-        try:
-            image_bytes = image_handler.compress_image(path, mime_type)
-        except Exception as error:
-            logger.error(f"Image compression failed for {path}: {error}")
-            return models.BuildPostResponse(
-                account, 'error', f"Image compression failed for {path}: {error}")
 
-        try:
-            media = mastodon.media_post(
-                media_file=image_bytes,
-                mime_type=mime_type,
-                description=os.path.basename(path) or "Image"
-            )
-            media_ids.append(media['id'])
-        except MastodonError as error:
-            logger.error(f"Failed to upload image {path} to Pixelfed: {error}")
-            return models.BuildPostResponse(
-                account, 'error', f"Failed to upload image {path} to Pixelfed")
-
-    try:
-        post = mastodon.status_post(
-            status=message,
-            media_ids=media_ids,
-            visibility='public'
-        )
+# End of PixelfedAdapter
 
-        return models.BuildPostResponse(
-            account, 'success', 'Successfully posted', post.url, post.id)
-    except MastodonError as error:
-        logger.error(f"Failed to post: {metadata.message} to Pixelfed: {error}")
-        return models.BuildPostResponse(
-            account, 'error', f'Failed to post: {metadata.message} to Pixelfed')
+adapter = register(PixelfedAdapter())
@@ -0,0 +1,38 @@
+-- Disable a user's linked accounts that exceed their plan's account limit.
+--
+-- Accounts are ranked enabled first, then oldest first (id breaks ties), so
+-- the accounts a user already had switched on are the ones that survive a
+-- downgrade. Only rows that actually flip from enabled to disabled are
+-- written. Returns the number of accounts that were disabled.
+create or replace function public.enforce_account_limit(p_user_id uuid, p_plan text default 'free')
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_limit integer;
+    v_disabled integer;
+begin
+    select account_limit into strict v_limit from plans where name = p_plan;
+
+    with ranked as (
+        select id,
+               row_number() over (order by enabled desc, created_at, id) as position
+        from linked_accounts
+        where user_id = p_user_id
+    )
+    update linked_accounts la
+    set enabled = false
+    from ranked
+    where la.id = ranked.id
+      and la.enabled
+      and ranked.position > v_limit;
+
+    get diagnostics v_disabled = row_count;
+    return v_disabled;
+end;
+$$;
+
+revoke execute on function public.enforce_account_limit(uuid, text) from public, anon, authenticated;
+grant execute on function public.enforce_account_limit(uuid, text) to service_role;
@@ -0,0 +1,11 @@
+-- Stripe webhook events that have already been accepted, so retried
+-- deliveries of the same event are acknowledged without being processed again.
+create table if not exists public.stripe_events (
+    id text primary key,
+    type text not null,
+    received_at timestamptz not null default now()
+);
+
+create index if not exists stripe_events_received_at on public.stripe_events (received_at);
+
+alter table public.stripe_events enable row level security;
@@ -0,0 +1,46 @@
+-- Batched post history writes.
+--
+-- Each element of p_posts is one post: its posts columns plus an "accounts"
+-- array of account_posts rows. Posts carry a client-generated history_id so
+-- a batch that is replayed after a crash is not stored twice. Returns the
+-- number of posts that were inserted.
+alter table public.posts add column if not exists history_id uuid unique;
+
+create or replace function public.record_post_history(p_posts jsonb)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_inserted integer;
+begin
+    with incoming as (
+        select value as post
+        from jsonb_array_elements(p_posts)
+    ),
+    inserted as (
+        insert into posts (history_id, user_id, content, status)
+        select p.history_id, p.user_id, p.content, p.status
+        from incoming, jsonb_populate_record(null::posts, incoming.post) p
+        on conflict (history_id) do nothing
+        returning id, history_id
+    ),
+    accounts as (
+        insert into account_posts (post_id, user_id, platform, instance, handle, status,
+                                   message, post_url, external_post_id)
+        select inserted.id, a.user_id, a.platform, a.instance, a.handle, a.status,
+               a.message, a.post_url, a.external_post_id
+        from inserted
+        join incoming on (incoming.post ->> 'history_id')::uuid = inserted.history_id
+        cross join lateral jsonb_populate_recordset(null::account_posts, incoming.post -> 'accounts') a
+        returning 1
+    )
+    select count(*) into v_inserted from inserted;
+
+    return v_inserted;
+end;
+$$;
+
+revoke execute on function public.record_post_history(jsonb) from public, anon, authenticated;
+grant execute on function public.record_post_history(jsonb) to service_role;
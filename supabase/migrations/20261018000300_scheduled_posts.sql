@@ -0,0 +1,48 @@
+-- Posts scheduled for later publishing.
+--
+-- The API keeps the next SCHEDULER_HORIZON of rows in an in-memory timer
+-- wheel and claims each one by flipping status from 'scheduled' to
+-- 'publishing', so a post is only ever dispatched by one machine. The
+-- payload is the models.Post JSON, credentials included, and is cleared once
+-- the post is finished or cancelled.
+create table if not exists public.scheduled_posts (
+    id uuid primary key default gen_random_uuid(),
+    user_id uuid not null,
+    publish_at timestamptz not null,
+    status text not null default 'scheduled'
+        check (status in ('scheduled', 'publishing', 'published', 'partial', 'failed', 'cancelled')),
+    payload jsonb not null,
+    result jsonb,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+-- The horizon query and the wake-up check only ever look at pending rows
+create index if not exists scheduled_posts_due
+    on public.scheduled_posts (publish_at)
+    where status = 'scheduled';
+
+create index if not exists scheduled_posts_user
+    on public.scheduled_posts (user_id, publish_at);
+
+-- Only the API, with the service role, reads or writes the table
+alter table public.scheduled_posts enable row level security;
+
+-- Fly stops the machine when it is idle, and a stopped machine has no timers.
+-- While a post is due within the next five minutes, ping the API every minute:
+-- the request starts the machine, and the traffic keeps it up until the post
+-- has gone out.
+create extension if not exists pg_cron;
+create extension if not exists pg_net;
+
+select cron.schedule(
+    'wake-post-scheduler',
+    '* * * * *',
+    $$
+    select net.http_get('https://loftlyapi.fly.dev/health')
+    where exists (
+        select 1 from public.scheduled_posts
+        where status = 'scheduled' and publish_at < now() + interval '5 minutes'
+    )
+    $$
+);
@@ -0,0 +1,6 @@
+-- Timestamp of the Stripe event last applied to each subscription. The
+-- webhook worker only writes a row when its event is at least this new, so
+-- an older event delivered or retried late cannot overwrite a newer state,
+-- whatever happened to the process in between.
+alter table public.subscriptions
+    add column if not exists stripe_event_created bigint;
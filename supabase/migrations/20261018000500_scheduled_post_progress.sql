@@ -0,0 +1,22 @@
+-- Accounts a publishing post has already gone out to, with their results.
+--
+-- A machine stopped mid-post leaves the row in 'publishing'. Once it is
+-- rescheduled, the machine that claims it again skips the accounts recorded
+-- here instead of posting to them twice. Cleared when the post is finished.
+alter table public.scheduled_posts add column if not exists progress jsonb;
+
+-- Keep waking the machine while a post is publishing, too: Fly would
+-- otherwise stop an idle machine in the middle of a post, and nothing would
+-- be left running to pick the post up again.
+select cron.schedule(
+    'wake-post-scheduler',
+    '* * * * *',
+    $$
+    select net.http_get('https://loftlyapi.fly.dev/health')
+    where exists (
+        select 1 from public.scheduled_posts
+        where (status = 'scheduled' and publish_at < now() + interval '5 minutes')
+           or status = 'publishing'
+    )
+    $$
+);
@@ -0,0 +1,38 @@
+-- Stripe events are processed from this table, not only deduplicated.
+--
+-- The webhook stores each subscription event as 'pending' with the state it
+-- carries before acknowledging it, so the work survives a machine that is
+-- stopped or replaced. The API applies the newest pending state of each
+-- subscription and marks the subscription's pending events 'done'. Rows
+-- from before this migration were already processed.
+alter table public.stripe_events
+    add column if not exists subscription_id text,
+    add column if not exists created bigint,
+    add column if not exists payload jsonb,
+    add column if not exists status text not null default 'done'
+        check (status in ('pending', 'done')),
+    add column if not exists result text,
+    add column if not exists processed_at timestamptz;
+
+alter table public.stripe_events alter column status set default 'pending';
+
+create index if not exists stripe_events_pending
+    on public.stripe_events (subscription_id, created)
+    where status = 'pending';
+
+-- Also wake the machine while Stripe events are waiting to be applied
+select cron.schedule(
+    'wake-post-scheduler',
+    '* * * * *',
+    $$
+    select net.http_get('https://loftlyapi.fly.dev/health')
+    where exists (
+        select 1 from public.scheduled_posts
+        where (status = 'scheduled' and publish_at < now() + interval '5 minutes')
+           or status = 'publishing'
+    )
+    or exists (
+        select 1 from public.stripe_events where status = 'pending'
+    )
+    $$
+);
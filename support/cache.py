@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+# --- LRU + TTL Cache ---
+class TTLCache:
+    """
+    A small in-process cache with LRU eviction and per-entry expiry.
+
+    Entries expire after ``ttl`` seconds (or a per-entry ttl passed to set),
+    and the least recently used entry is dropped once ``max_size`` is reached.
+    With ``sliding=True`` every hit pushes the expiry back, so ttl becomes an
+    idle timeout. Hits and misses are counted so callers can report a hit rate.
+    """
+
+    def __init__(self, max_size: int, ttl: float, on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 sliding: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.sliding = sliding
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._evict(key)
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        if self.sliding:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        while len(self._entries) > self.max_size:
+            self._evict(next(iter(self._entries)))
+
+    def pop(self, key: Hashable) -> None:
+        """Invalidate a single entry."""
+        if key in self._entries:
+            self._evict(key)
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self._evict(key)
+
+    def drain(self) -> list:
+        """Remove every entry without calling on_evict, returning the values."""
+        values = self.values()
+        self._entries.clear()
+        return values
+
+    def purge_expired(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            self._evict(key)
+
+    def values(self) -> list:
+        return [value for value, _ in self._entries.values()]
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def _evict(self, key: Hashable) -> None:
+        value, _ = self._entries.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# End of TTLCache
+
+# --- Per-Key Locking ---
+class KeyedLock:
+    """asyncio locks handed out per key, dropped again once nobody holds or waits on them."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, list] = {}  # key -> [lock, users]
+
+    def __call__(self, key: Hashable) -> "_KeyedLockContext":
+        return _KeyedLockContext(self, key)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+# End of KeyedLock
+
+class _KeyedLockContext:
+    def __init__(self, owner: KeyedLock, key: Hashable):
+        self.owner = owner
+        self.key = key
+
+    async def __aenter__(self):
+        entry = self.owner._locks.setdefault(self.key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release_user(entry)
+            raise
+
+    async def __aexit__(self, *exc_info):
+        entry = self.owner._locks[self.key]
+        entry[0].release()
+        self._release_user(entry)
+
+    def _release_user(self, entry: list) -> None:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.owner._locks[self.key]
+
+
+# End of _KeyedLockContext
@@ -0,0 +1,38 @@
+import asyncio
+from typing import Awaitable, Iterable, List, TypeVar
+
+T = TypeVar("T")
+
+
+# --- Bounded Fan-Out ---
+async def gather_limited(awaitables: Iterable[Awaitable[T]], limit: int) -> List[T]:
+    """
+    Run awaitables concurrently, at most ``limit`` at a time.
+
+    Results come back in the order the awaitables were given. The first
+    failure cancels everything still running or waiting, and that exception
+    is raised to the caller.
+    """
+    slots = asyncio.Semaphore(max(1, limit))
+
+    async def run(awaitable: Awaitable[T]) -> T:
+        try:
+            await slots.acquire()
+        except asyncio.CancelledError:
+            # Cancelled while queued, so the coroutine never started
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        try:
+            return await awaitable
+        finally:
+            slots.release()
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(run(awaitable)) for awaitable in awaitables]
+    except BaseExceptionGroup as errors:
+        raise errors.exceptions[0]
+
+    return [task.result() for task in tasks]
+# End of gather_limited
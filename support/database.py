@@ -1,175 +1,411 @@
+import asyncio
 import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
 
 import aiofiles
 import stripe
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient
 
-from support import models
+from support import image_handler, metrics, video_handler
+from support.cache import TTLCache
+from support.jobs import ProgressCallback
 from support.logger_config import logger
 
 
 url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+supabase: Optional[AsyncClient] = None
+
+MEDIA_FETCH_CONCURRENCY = int(os.getenv("MEDIA_FETCH_CONCURRENCY", "4"))
+MEDIA_SPOOL_THRESHOLD_KB = int(os.getenv("MEDIA_SPOOL_THRESHOLD_KB", "8192"))
+TEMP_IMAGES_DIR = "../temp_images"
+
+# Storage deletion: list calls in flight, page size and files per remove call
+STORAGE_LIST_CONCURRENCY = int(os.getenv("STORAGE_LIST_CONCURRENCY", "8"))
+STORAGE_LIST_PAGE_SIZE = int(os.getenv("STORAGE_LIST_PAGE_SIZE", "1000"))
+STORAGE_REMOVE_BATCH = int(os.getenv("STORAGE_REMOVE_BATCH", "1000"))
+USER_BUCKETS = ("images", "videos")
+
+# Subscription rows, keyed by ('customer', stripe_customer_id) and ('user', user_id)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "1024"))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+_subscriptions = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+metrics.register_cache("subscriptions", _subscriptions.stats)
+_subscription_epoch = 0  # Bumped on every invalidation so in-flight reads don't re-cache stale rows
 
 stripe.api_key = os.getenv("STRIPE_API_KEY")
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
+
+
+# --- Client Lifecycle ---
+async def connect() -> AsyncClient:
+    """Create the shared async Supabase client on first use."""
+    global supabase
+    if supabase is None:
+        supabase = await acreate_client(url, key)
+    return supabase
+# End of connect
+
+
+async def close() -> None:
+    """Close the shared client's HTTP sessions."""
+    global supabase
+    if supabase is None:
+        return
+    client, supabase = supabase, None
+    await client.postgrest.aclose()
+# End of close
+
+
+@metrics.timed_database_call
+async def load_images(img_list: list[str], folder_path: str, remove: bool = True,
+                      spool_threshold_kb: int = MEDIA_SPOOL_THRESHOLD_KB) -> list[image_handler.MediaFile]:
+    """
+    Fetch a post's images from Supabase Storage and remove the remote copies.
+
+    Downloads run concurrently and the bytes stay in memory, unless a file is
+    larger than spool_threshold_kb, in which case it is spooled to disk.
 
-async def load_images(img_list: list[str], folder_path: str):
-    os.makedirs("../temp_images", exist_ok=True)
-    paths = []
+    Args:
+        img_list: File names to fetch, in post order.
+        folder_path: The user's folder in the images bucket.
+        remove: Delete the remote copies once downloaded. Scheduled posts keep
+            them until they are published, see remove_media.
+        spool_threshold_kb: Largest file kept in memory; 0 spools every file.
 
-    # List all files in the given folder
-    files = supabase.storage.from_('images').list(folder_path)
+    Returns:
+        MediaFile objects for every image that was found, in post order.
+    """
+    supabase = await connect()
+    bucket = supabase.storage.from_('images')
+
+    # Index the folder listing by name
+    files = {f['name']: f for f in await bucket.list(folder_path)}
 
+    remote_paths = []
     for img_name in img_list:
-        # Look for a file with the given base name and any extension
-        match = next((f for f in files if f['name'] == img_name), None)
-        if not match:
+        if img_name not in files:
             logger.warn(f"❌ No file found in '{'images'}/{folder_path}' starting with '{img_name}'")
             continue
+        remote_paths.append(os.path.join(folder_path, img_name))
 
-        # Construct full remote path and local path
-        remote_path = os.path.join(folder_path, match['name'])
-        local_path = os.path.join('../temp_images', match['name'])
+    slots = asyncio.Semaphore(MEDIA_FETCH_CONCURRENCY)
 
-        # Download image
+    async def fetch(remote_path: str) -> Optional[image_handler.MediaFile]:
+        name = os.path.basename(remote_path)
         try:
-            response = supabase.storage.from_('images').download(remote_path)
-            async with aiofiles.open(local_path, "wb") as f:
-                await f.write(response)
-            paths.append(local_path)
+            async with slots:
+                data = await bucket.download(remote_path)
+        except Exception as error:
+            logger.error(f'Failed to download image {remote_path}: {error}')
+            return None
+
+        if len(data) <= spool_threshold_kb * 1024:
+            return image_handler.MediaFile(name, data=data)
+
+        # Large files wait for compression on disk instead of in memory
+        os.makedirs(TEMP_IMAGES_DIR, exist_ok=True)
+        fd, local_path = tempfile.mkstemp(dir=TEMP_IMAGES_DIR, suffix=f"-{name}")
+        os.close(fd)
+        async with aiofiles.open(local_path, "wb") as f:
+            await f.write(data)
+        return image_handler.MediaFile(name, path=local_path)
 
-            # Delete the Image
-            supabase.storage.from_('images').remove([remote_path])
+    results = await asyncio.gather(*(fetch(path) for path in remote_paths))
+    fetched = [path for path, media in zip(remote_paths, results) if media is not None]
+
+    # Delete the downloaded images in one call
+    if remove and fetched:
+        try:
+            await bucket.remove(fetched)
         except Exception as error:
             logger.error(f'Failed to delete image: {error}')
-            continue
 
-    return paths
+    return [media for media in results if media is not None]
+# End of load_images
 
 
-def delete_images(local_paths: list[str]) -> None:
-    if len(local_paths) == 0:
-        return
-    for x in range(min(len(local_paths), 4)):
+@metrics.timed_database_call
+async def load_video(file_name: str, folder_path: str, remove: bool = True) -> Optional[video_handler.VideoFile]:
+    """
+    Stream a post's video from Supabase Storage to a local temp file and remove the remote copy.
+
+    The download is written chunk by chunk, so the video never has to fit in
+    memory. With remove=False the remote copy is kept, as for load_images.
+
+    Returns:
+        The spooled VideoFile, or None if the download failed.
+    """
+    supabase = await connect()
+    remote_path = f"{folder_path}/{file_name}"
+    local_path = video_handler.temp_path(file_name)
+    headers = {"apikey": key, "Authorization": f"Bearer {key}"}
+
+    try:
+        http = video_handler.get_http_client()
+        async with http.stream("GET", f"{url}/storage/v1/object/videos/{remote_path}", headers=headers) as response:
+            response.raise_for_status()
+            async with aiofiles.open(local_path, "wb") as f:
+                async for chunk in response.aiter_bytes(video_handler.VIDEO_CHUNK_SIZE):
+                    await f.write(chunk)
+    except Exception as error:
+        logger.error(f'Failed to download video {remote_path}: {error}')
+        video_handler.delete_files([video_handler.VideoFile(file_name, local_path, "", 0)])
+        return None
+
+    if remove:
         try:
-            os.remove(local_paths[x])
+            await supabase.storage.from_('videos').remove([remote_path])
         except Exception as error:
-            logger.error(f"Warning: Could not delete {local_paths[x]}: {error}")
+            logger.error(f'Failed to delete video: {error}')
+
+    return video_handler.VideoFile(file_name, local_path, video_handler.guess_mime_type(file_name),
+                                   os.path.getsize(local_path))
+# End of load_video
 
 
-def upload_post_history(metadata: models.Post, platforms):
+@metrics.timed_database_call
+async def remove_media(bucket_name: str, folder_path: str, names: list[str]) -> None:
+    """Delete a post's files from a storage bucket, once they are no longer needed."""
+    if not names:
+        return
+    supabase = await connect()
     try:
-        result = supabase.table('posts').insert({
-            'user_id': metadata.user_id,
-            'content': metadata.message,
-            'status': 'Success',
-        }).execute()
-
-        post_id = result.data[0]['id']
-
-        if all(p.get('status') == 'success' for p in platforms):
-            overall_status = 'Success'
-        elif any(p.get('status') == 'success' for p in platforms):
-            overall_status = 'Partial'
-        else:
-            overall_status = 'Failed'
-
-        rows = []
-        for platform in platforms:
-            row = {
-                'post_id': post_id,
-                'user_id': metadata.user_id,
-                'platform': platform.get('platform'),
-                'instance': platform.get('instance'),
-                'handle': platform.get('handle'),
-                'status': overall_status,
-                'message': platform.get('message'),
-                'post_url': platform.get('post_url'),
-                'external_post_id': str(platform.get('external_post_id')) if platform.get('external_post_id') else None,
-            }
-            rows.append(row)
-
-        # Insert all rows in one call
-        response = supabase.table('account_posts').insert(rows).execute()
-        return response
+        await supabase.storage.from_(bucket_name).remove([f"{folder_path}/{name}" for name in names])
     except Exception as error:
-        logger.error(f'Failed to upload post history: {error}')
-        return {"status": "error", "message": "Failed to upload post history"}
+        logger.error(f'Failed to delete {bucket_name} of {folder_path}: {error}')
+# End of remove_media
+
+
+def delete_images(media: list[image_handler.MediaFile]) -> None:
+    for item in media:
+        if item.path is None:
+            continue
+        try:
+            os.remove(item.path)
+        except Exception as error:
+            logger.error(f"Warning: Could not delete {item.path}: {error}")
+# End of delete_images
+
+
+@metrics.timed_database_call
+async def record_post_history(records: list) -> int:
+    """
+    Store a batch of history records (see support.history) in one round-trip.
+
+    The record_post_history Postgres function inserts the posts and their
+    account_posts rows together and skips records it has already stored.
+
+    Returns:
+        The number of posts that were newly inserted.
+    """
+    supabase = await connect()
+    res = await supabase.rpc("record_post_history", {"p_posts": records}).execute()
+    return res.data or 0
+
+
+# End of record_post_history
+
+# --- Subscription Cache ---
+async def _cached_subscription(column: str, value: str, kind: str, fresh: bool = False) -> Optional[dict]:
+    """
+    Return the subscriptions row where column == value, served from the cache when possible.
+
+    The cache is per process, so other machines' writes are not seen until it
+    expires. fresh=True reads the table for paths that must not act on a
+    stale row, and caches the result.
+    """
+    row = None if fresh else _subscriptions.get((kind, value))
+    if row is not None:
+        return row
+
+    epoch = _subscription_epoch
+    supabase = await connect()
+    res = await supabase.table("subscriptions").select().eq(column, value).execute()
+    row = res.data[0] if res.data else None
+    if row is not None and epoch == _subscription_epoch:
+        _cache_subscription(row)
+    return row
+# End of _cached_subscription
+
+
+def _cache_subscription(row: dict) -> None:
+    if row.get("stripe_customer_id"):
+        _subscriptions.set(("customer", row["stripe_customer_id"]), row)
+    if row.get("user_id"):
+        _subscriptions.set(("user", row["user_id"]), row)
+# End of _cache_subscription
+
+
+def invalidate_subscription(rows: list) -> None:
+    """Drop cached subscriptions for the given rows, e.g. after they were written."""
+    global _subscription_epoch
+    _subscription_epoch += 1
+    for row in rows:
+        _subscriptions.pop(("customer", row.get("stripe_customer_id")))
+        _subscriptions.pop(("user", row.get("user_id")))
+# End of invalidate_subscription
+
+
+def cache_stats() -> Dict[str, dict]:
+    """Hit/miss counters for the database caches."""
+    return {"subscriptions": _subscriptions.stats()}
+# End of cache_stats
+
+
+@metrics.timed_database_call
+async def get_subscription_by_customer(customer_id: str) -> Optional[dict]:
+    """Return the subscriptions row for a Stripe customer, or None."""
+    return await _cached_subscription("stripe_customer_id", customer_id, "customer")
+# End of get_subscription_by_customer
 
 
-# End of upload_post_history
+@metrics.timed_database_call
+async def get_subscription_by_user(user_id: str, fresh: bool = False) -> Optional[dict]:
+    """Return the subscriptions row for a user, or None. fresh=True skips the cache."""
+    return await _cached_subscription("user_id", user_id, "user", fresh)
+# End of get_subscription_by_user
 
-def update_subscription(row_id, plan, status, price_id, ends_at_datetime):
-    supabase.table("subscriptions").update({
+
+@metrics.timed_database_call
+async def update_subscription(row_id, plan, status, price_id, ends_at_datetime,
+                              event_created: Optional[int] = None) -> bool:
+    """
+    Write a subscription's state.
+
+    With event_created, the Stripe event's timestamp, the row is only
+    written if no newer event was applied to it, even across restarts.
+
+    Returns:
+        False if a newer event had already been applied.
+    """
+    changes = {
         "plan_name": plan,
         "subscription_status": status,
         "subscription_price_id": price_id,
         "subscription_ends_at": ends_at_datetime.isoformat() if ends_at_datetime else None
-    }).eq("id", row_id).execute()
+    }
+    supabase = await connect()
+    query = supabase.table("subscriptions").update(
+        {**changes, "stripe_event_created": event_created} if event_created is not None else changes
+    ).eq("id", row_id)
+    if event_created is not None:
+        query = query.or_(f"stripe_event_created.is.null,stripe_event_created.lte.{event_created}")
+    res = await query.execute()
+    invalidate_subscription(res.data)
+    return bool(res.data)
 # End of update_subscription
 
-def update_user_limits(user_id: str, plan: str = "free"):
-    try:
-        # Step 1: Get all users and their plan/account_limit
-        account_limit = (supabase.table("plans")
-                         .select("account_limit")
-                         .eq("name", plan)
-                         .single()
-                         .execute()
-                         .data)['account_limit']
-
-        # Step 2: Get all connected accounts (enabled ones first)
-        accounts = (supabase.table("linked_accounts")
-                    .select()
-                    .eq("user_id", user_id)
-                    .execute()
-                    .data)
+@metrics.timed_database_call
+async def record_stripe_event(event_id: str, event_type: str, update: dict) -> bool:
+    """
+    Store a Stripe webhook event as pending, with the subscription state it carries.
 
-        count: int = 0
-        for account in accounts:
-            count += 1
-            if account['enabled'] and count > account_limit:
-                account['enabled'] = False
-        # End of for loop
+    The row is the durable record of the work: it stays pending until
+    finish_stripe_events marks it, whatever happens to the local job queue.
 
-        # Step 3: Update the accounts in Supabase
-        for account in accounts:
-            (supabase.table("linked_accounts")
-             .update({"enabled": account['enabled']})
-             .eq("id", account['id'])
-             .execute())
-        # End of for loop
+    Returns:
+        True if the event is new, False if it was already recorded.
+    """
+    supabase = await connect()
+    res = await (supabase.table("stripe_events")
+                 .upsert({"id": event_id, "type": event_type, "subscription_id": update["subscription_id"],
+                          "created": update["created"], "payload": update, "status": "pending"},
+                         on_conflict="id", ignore_duplicates=True)
+                 .execute())
+    return bool(res.data)
+# End of record_stripe_event
+
+
+@metrics.timed_database_call
+async def get_pending_stripe_events(subscription_id: str) -> list:
+    """A subscription's events not yet applied, oldest first."""
+    supabase = await connect()
+    res = await (supabase.table("stripe_events")
+                 .select("id, created, payload")
+                 .eq("subscription_id", subscription_id)
+                 .eq("status", "pending")
+                 .order("created")
+                 .execute())
+    return res.data
+# End of get_pending_stripe_events
+
+
+@metrics.timed_database_call
+async def get_pending_stripe_subscriptions(received_before: datetime) -> List[str]:
+    """Subscriptions with events received before the given time that are still pending."""
+    supabase = await connect()
+    res = await (supabase.table("stripe_events")
+                 .select("subscription_id")
+                 .eq("status", "pending")
+                 .lt("received_at", received_before.isoformat())
+                 .execute())
+    return list(dict.fromkeys(row["subscription_id"] for row in res.data))
+# End of get_pending_stripe_subscriptions
+
+
+@metrics.timed_database_call
+async def finish_stripe_events(event_ids: List[str], result: str) -> None:
+    """Mark events as processed, with the outcome of the state that was applied for them."""
+    supabase = await connect()
+    await (supabase.table("stripe_events")
+           .update({"status": "done", "result": result, "payload": None,
+                    "processed_at": datetime.now(timezone.utc).isoformat()})
+           .in_("id", event_ids)
+           .eq("status", "pending")
+           .execute())
+# End of finish_stripe_events
+
+
+@metrics.timed_database_call
+async def update_user_limits(user_id: str, plan: str = "free"):
+    """
+    Disable the user's linked accounts that exceed the plan's account limit.
 
-        return {"status": "User downgraded successfully", "plan": plan}
+    Runs as a single statement in the enforce_account_limit Postgres function
+    (supabase/migrations), which keeps enabled accounts first, oldest first,
+    and only writes rows whose enabled flag actually changes.
+    """
+    try:
+        supabase = await connect()
+        disabled = (await supabase.rpc("enforce_account_limit",
+                                       {"p_user_id": user_id, "p_plan": plan})
+                    .execute()
+                    ).data
+        logger.info(f"Applied {plan} account limit for {user_id}: {disabled} account(s) disabled")
+
+        return {"status": "User downgraded successfully", "plan": plan, "disabled": disabled}
 
     except Exception as error:
         logger.error(f"Error updating user limits: {error}")
         return {"status": "error", "message": "Failed to update user limits"}
 # End of downgrade_user
 
-def create_or_fetch_customer(user_id):
+@metrics.timed_database_call
+async def create_or_fetch_customer(user_id):
     # Lookup user from Supabase
     try:
-        user = (supabase.table("subscriptions")
-                .select("stripe_customer_id", "email")
-                .eq("user_id", user_id)
-                .single()
-                .execute()
-                .data)
+        supabase = await connect()
+        user = await get_subscription_by_user(user_id)
+        if not (user and user["stripe_customer_id"]):
+            # Another machine may have created the customer since this one cached the row
+            user = await get_subscription_by_user(user_id, fresh=True)
 
         if user and user["stripe_customer_id"]:
             return user["stripe_customer_id"]
 
         # If no customer yet, create it in Stripe
-        customer = stripe.Customer.create(email=user["email"], metadata={"user_id": user_id})
+        customer = await stripe.Customer.create_async(email=user["email"], metadata={"user_id": user_id})
         # Store the customer ID in Supabase
-        (supabase.table("subscriptions")
-         .update({
-            "stripe_customer_id": customer.id
-        })
-         .eq("user_id", user_id)
-         .execute())
+        res = await (supabase.table("subscriptions")
+                     .update({
+                        "stripe_customer_id": customer.id
+                     })
+                     .eq("user_id", user_id)
+                     .execute())
+        invalidate_subscription(res.data)
 
         return customer.id
     except Exception as e:
@@ -178,66 +414,236 @@ def create_or_fetch_customer(user_id):
 # End of create_or_fetch_customer
 
 
-def delete_user(user_id: str):
+@metrics.timed_database_call
+async def delete_user(user_id: str):
+    """
+    Delete a user's storage folders, Stripe customer and Supabase Auth user.
+
+    The storage buckets and the Stripe customer are deleted concurrently.
+    The Auth user goes last, and only once everything else succeeded, so a
+    failed deletion can be retried with the same user id. A retry finds the
+    customer already gone when only the storage deletes failed, which counts
+    as deleted.
+    """
+    supabase = await connect()
+
+    async def delete_customer() -> None:
+        # Not from the cache, which may predate the customer
+        user = await get_subscription_by_user(user_id, fresh=True)
+        if user and user["stripe_customer_id"]:
+            try:
+                await stripe.Customer.delete_async(user["stripe_customer_id"])
+            except stripe.InvalidRequestError as error:
+                if error.code != "resource_missing":
+                    raise
+        invalidate_subscription([user] if user else [])
+
+    *folders, customer = await asyncio.gather(
+        *(delete_folder(bucket, user_id) for bucket in USER_BUCKETS),
+        delete_customer(),
+        return_exceptions=True)
+
     # Delete user files from Supabase Storage
-    try:
-        delete_folder("images", user_id)
-        delete_folder("videos", user_id)
-    except Exception as error:
-        logger.error(f"Failed to delete user {user_id} folders: {error}")
+    folder_errors = [error for error in folders if isinstance(error, BaseException)]
+    if folder_errors:
+        logger.error(f"Failed to delete user {user_id} folders: {folder_errors[0]}")
         return {"status": "error", "message": "Failed to delete user folders"}
 
     # Delete user from Stripe
-    try:
-
-        user = (supabase.table("subscriptions")
-                .select("stripe_customer_id", "email")
-                .eq("user_id", user_id)
-                .single()
-                .execute()
-                .data)
-        if user and user["stripe_customer_id"]:
-            stripe.Customer.delete(user["stripe_customer_id"])
-    except Exception as error:
-        logger.error(f"Error deleting user {user_id}: {error}")
+    if isinstance(customer, BaseException):
+        logger.error(f"Error deleting user {user_id}: {customer}")
         return {"status": "error", "message": "Failed to delete user"}
 
     # Delete user from Supabase Auth
     try:
-        supabase.auth.admin.delete_user(user_id)
+        await supabase.auth.admin.delete_user(user_id)
     except Exception as error:
         logger.error(f"Failed to delete user {user_id} from Supabase Auth: {error}")
         return {"status": "error", "message": "Failed to delete user from Supabase Auth"}
 
-    return {"status": "User deleted successfully"}
+    return {"status": "User deleted successfully", "files_deleted": sum(folders)}
 # End of delete_user
 
-def delete_folder(bucket_name: str, folder_path: str):
+
+async def run_delete_user_job(payload: Dict[str, Any], progress: ProgressCallback,
+                              resumed: Dict[str, Any]) -> dict:
+    """Job handler for background user deletion."""
+    result = await delete_user(payload["user_id"])
+    if result.get("status") == "error":
+        raise RuntimeError(result["message"])
+    return result
+# End of run_delete_user_job
+
+
+@metrics.timed_database_call
+async def delete_folder(bucket_name: str, folder_path: str) -> int:
     """
     Recursively delete all files under a given folder path in Supabase Storage.
+
+    Subfolders are listed concurrently, at most STORAGE_LIST_CONCURRENCY calls
+    at a time, with each folder read page by page. Files found anywhere in the
+    tree are removed in batches of up to STORAGE_REMOVE_BATCH paths, once the
+    folder holding them and every folder above it have been listed in full.
+
+    Returns:
+        The number of files removed.
+    """
+    supabase = await connect()
+    bucket = supabase.storage.from_(bucket_name)
+    root = folder_path.strip("/")
+    slots = asyncio.Semaphore(max(1, STORAGE_LIST_CONCURRENCY))
+    pending: List[str] = []
+    removed = 0
+
+    async def remove(batch: List[str]) -> None:
+        nonlocal removed
+        async with slots:
+            await bucket.remove(batch)
+        removed += len(batch)
+
+    def take_batch() -> List[str]:
+        batch = pending[:STORAGE_REMOVE_BATCH]
+        del pending[:STORAGE_REMOVE_BATCH]
+        return batch
+
+    async def walk(path: str, group: asyncio.TaskGroup, parent_listed: asyncio.Event) -> None:
+        # Emptying a folder removes it from its parent's listing, so nothing is removed
+        # until every listing it appears under is done; deletions can't shift later pages
+        listed = asyncio.Event()
+        files = []
+        offset = 0
+        while True:
+            async with slots:
+                page = await bucket.list(path, {"limit": STORAGE_LIST_PAGE_SIZE, "offset": offset})
+            for item in page:
+                item_path = f"{path}/{item['name']}"
+                if item.get("metadata") is None:
+                    # This is a subfolder
+                    group.create_task(walk(item_path, group, listed))
+                else:
+                    files.append(item_path)
+            if len(page) < STORAGE_LIST_PAGE_SIZE:
+                break
+            offset += STORAGE_LIST_PAGE_SIZE
+
+        await parent_listed.wait()
+        listed.set()
+        pending.extend(files)
+        while len(pending) >= STORAGE_REMOVE_BATCH:
+            group.create_task(remove(take_batch()))
+
+    above_root = asyncio.Event()
+    above_root.set()
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(walk(root, group, above_root))
+        # Whatever is left over once the walk is done
+        async with asyncio.TaskGroup() as group:
+            while pending:
+                group.create_task(remove(take_batch()))
+    except BaseExceptionGroup as errors:
+        raise errors.exceptions[0]
+
+    logger.info(f"Deleted {removed} files from {bucket_name}/{root}")
+    return removed
+# End of delete_folder
+
+
+# --- Scheduled Posts ---
+@metrics.timed_database_call
+async def create_scheduled_post(user_id: str, publish_at: datetime, payload: dict) -> dict:
+    """Store a post to be published at publish_at and return its row."""
+    supabase = await connect()
+    res = await supabase.table("scheduled_posts").insert({
+        "user_id": user_id,
+        "publish_at": publish_at.isoformat(),
+        "payload": payload,
+    }).execute()
+    return res.data[0]
+# End of create_scheduled_post
+
+
+@metrics.timed_database_call
+async def get_scheduled_post(post_id: str) -> Optional[dict]:
+    """Return a scheduled post without its payload, or None."""
+    supabase = await connect()
+    res = await (supabase.table("scheduled_posts")
+                 .select("id, user_id, publish_at, status, result, created_at, updated_at")
+                 .eq("id", post_id)
+                 .execute())
+    return res.data[0] if res.data else None
+# End of get_scheduled_post
+
+
+@metrics.timed_database_call
+async def get_upcoming_scheduled_posts(before: datetime) -> list:
+    """Every post still waiting to be published before the given time, overdue ones included."""
+    supabase = await connect()
+    res = await (supabase.table("scheduled_posts")
+                 .select("id, publish_at, payload")
+                 .eq("status", "scheduled")
+                 .lt("publish_at", before.isoformat())
+                 .order("publish_at")
+                 .execute())
+    return res.data
+# End of get_upcoming_scheduled_posts
+
+
+async def _set_scheduled_status(post_id: str, status: str, expected: str, **changes) -> list:
+    """Move a post from the expected status to a new one. Returns the updated rows, if any."""
+    supabase = await connect()
+    res = await (supabase.table("scheduled_posts")
+                 .update({"status": status, "updated_at": datetime.now(timezone.utc).isoformat(), **changes})
+                 .eq("id", post_id)
+                 .eq("status", expected)
+                 .execute())
+    return res.data
+# End of _set_scheduled_status
+
+
+@metrics.timed_database_call
+async def claim_scheduled_post(post_id: str) -> Optional[dict]:
+    """
+    Atomically mark a scheduled post as publishing.
+
+    Returns:
+        The row with its payload, or None if the post was cancelled or
+        another machine claimed it first.
     """
-    # Ensure folder path ends with slash
-    if not folder_path.endswith("/"):
-        folder_path += "/"
-
-    # Recursive helper
-    def delete_recursive(path):
-        items = supabase.storage.from_(bucket_name).list(path=path)
-        files_to_delete = []
-
-        for item in items:
-            if item["metadata"] is None:
-                # This is a subfolder
-                delete_recursive(f"{path}{item['name']}")
-            else:
-                # This is a file
-                files_to_delete.append(f"{path}{item['name']}")
-
-        # Bulk delete files in this folder
-        if files_to_delete:
-            supabase.storage.from_(bucket_name).remove(files_to_delete)
-            logger.info(f"Successfully deleted {len(files_to_delete)} files from {folder_path}")
-
-    delete_recursive(folder_path)
-    logger.info(f"Folder '{folder_path}' deleted (if it contained any files).")
-# End of delete_folder
\ No newline at end of file
+    rows = await _set_scheduled_status(post_id, "publishing", "scheduled")
+    return rows[0] if rows else None
+# End of claim_scheduled_post
+
+
+@metrics.timed_database_call
+async def save_scheduled_progress(post_id: str, progress: dict) -> None:
+    """Store how far a publishing post got, so a machine that picks it up again can resume it."""
+    await _set_scheduled_status(post_id, "publishing", "publishing", progress=progress)
+# End of save_scheduled_progress
+
+
+@metrics.timed_database_call
+async def finish_scheduled_post(post_id: str, status: str, result: Any) -> None:
+    # The payload holds account credentials, so it is not kept once the post is out
+    await _set_scheduled_status(post_id, status, "publishing", result=result, payload={}, progress=None)
+# End of finish_scheduled_post
+
+
+@metrics.timed_database_call
+async def cancel_scheduled_post(post_id: str) -> bool:
+    """Cancel a post that has not started publishing. Returns False if it was too late."""
+    return bool(await _set_scheduled_status(post_id, "cancelled", "scheduled", payload={}))
+# End of cancel_scheduled_post
+
+
+@metrics.timed_database_call
+async def requeue_stale_scheduled_posts(older_than: datetime) -> int:
+    """Put posts left publishing by a machine that stopped mid-post back on the schedule."""
+    supabase = await connect()
+    res = await (supabase.table("scheduled_posts")
+                 .update({"status": "scheduled", "updated_at": datetime.now(timezone.utc).isoformat()})
+                 .eq("status", "publishing")
+                 .lt("updated_at", older_than.isoformat())
+                 .execute())
+    return len(res.data)
+# End of requeue_stale_scheduled_posts
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import Any, Dict, List, Optional
+
+from support import database, models
+from support.logger_config import logger
+
+# The default is on the machine's root filesystem, which Fly resets whenever a machine is stopped or
+# redeployed: the spool covers crashes and restarts in place, not that. Point it at a mounted volume
+# to keep records that could not be flushed across a stop.
+HISTORY_SPOOL_PATH = os.getenv("HISTORY_SPOOL_PATH", "data/history.jsonl")
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+
+
+# --- Records ---
+def build_record(metadata: models.Post, platforms: List[dict], history_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Turn a finished post and its per-platform results into one history record.
+
+    The history_id lets record_post_history skip records it has already
+    stored, so replaying the spool after a crash never duplicates a post.
+    A resumed post passes the id of its first attempt for the same reason.
+    """
+    if all(p.get('status') == 'success' for p in platforms):
+        overall_status = 'Success'
+    elif any(p.get('status') == 'success' for p in platforms):
+        overall_status = 'Partial'
+    else:
+        overall_status = 'Failed'
+
+    return {
+        'history_id': history_id or str(uuid.uuid4()),
+        'user_id': metadata.user_id,
+        'content': metadata.message,
+        'status': 'Success',
+        'accounts': [{
+            'user_id': metadata.user_id,
+            'platform': platform.get('platform'),
+            'instance': platform.get('instance'),
+            'handle': platform.get('handle'),
+            'status': overall_status,
+            'message': platform.get('message'),
+            'post_url': platform.get('post_url'),
+            'external_post_id': str(platform.get('external_post_id')) if platform.get('external_post_id') else None,
+        } for platform in platforms],
+    }
+# End of build_record
+
+
+# --- Write-Behind Buffer ---
+class HistoryWriter:
+    """
+    Buffers post history and writes it to Supabase in batches.
+
+    Every record is appended to a local spool file before it is buffered, and
+    the spool is only rewritten once a batch has been stored, so history that
+    was not flushed yet survives a crash and is replayed on the next start.
+    A flush runs once HISTORY_BATCH_SIZE records are waiting, every
+    HISTORY_FLUSH_INTERVAL seconds, and on stop.
+    """
+
+    def __init__(self, spool_path: str = HISTORY_SPOOL_PATH, batch_size: int = HISTORY_BATCH_SIZE,
+                 interval: float = HISTORY_FLUSH_INTERVAL):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._records: List[Dict[str, Any]] = []
+        self._io = asyncio.Lock()
+        self._flushing = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    async def start(self) -> None:
+        if os.path.dirname(self.spool_path):
+            os.makedirs(os.path.dirname(self.spool_path), exist_ok=True)
+        self._records = await asyncio.to_thread(self._read_spool)
+        if self._records:
+            logger.warning(f"Replaying {len(self._records)} unsaved post history records")
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush loop and write out what is left. Anything that fails stays spooled."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not await self.flush():
+            logger.error(f"{len(self._records)} post history records left in {self.spool_path}, "
+                         f"lost unless it is on a volume")
+
+    async def add(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=str)
+        async with self._io:
+            await asyncio.to_thread(self._append, line)
+            self._records.append(record)
+        if len(self._records) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """
+        Store every buffered record, one batch per RPC call.
+
+        Returns:
+            True if the buffer was emptied, False if a batch failed.
+        """
+        async with self._flushing:
+            while self._records:
+                batch = self._records[:self.batch_size]
+                try:
+                    await database.record_post_history(batch)
+                except Exception as error:
+                    logger.error(f"Failed to write {len(batch)} post history records, will retry: {error}")
+                    return False
+
+                async with self._io:
+                    del self._records[:len(batch)]
+                    await asyncio.to_thread(self._rewrite_spool, list(self._records))
+            return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    # Spool file access, run in worker threads
+    def _append(self, line: str) -> None:
+        with open(self.spool_path, 'a', encoding='utf-8') as spool:
+            spool.write(line + '\n')
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    def _rewrite_spool(self, records: List[Dict[str, Any]]) -> None:
+        temp_path = self.spool_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as spool:
+            spool.writelines(json.dumps(record, default=str) + '\n' for record in records)
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(temp_path, self.spool_path)
+
+    def _read_spool(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.spool_path):
+            return []
+        records = []
+        with open(self.spool_path, encoding='utf-8') as spool:
+            for line in spool:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A write cut short by a crash; everything before it is intact
+                    logger.warning(f"Skipping a damaged line in {self.spool_path}")
+        return records
+
+
+# End of HistoryWriter
+
+_writer: Optional[HistoryWriter] = None
+
+
+# --- Lifecycle ---
+async def start_writer() -> None:
+    """Create the shared history writer, replay its spool and start flushing."""
+    global _writer
+    if _writer is not None:
+        return
+    _writer = HistoryWriter()
+    await _writer.start()
+# End of start_writer
+
+
+async def stop_writer() -> None:
+    """Flush the buffer and stop the shared history writer."""
+    global _writer
+    if _writer is None:
+        return
+    writer, _writer = _writer, None
+    await writer.stop()
+# End of stop_writer
+
+
+async def record(metadata: models.Post, platforms: List[dict], history_id: Optional[str] = None) -> None:
+    """Queue a finished post's history for the next batch write."""
+    if _writer is None:
+        await start_writer()
+    try:
+        await _writer.add(build_record(metadata, platforms, history_id))
+    except Exception as error:
+        logger.error(f'Failed to record post history: {error}')
+# End of record
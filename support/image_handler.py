@@ -1,47 +1,502 @@
+import asyncio
 import io
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
 
-from PIL import Image
+from PIL import Image, ImageOps, features
 
+from support import media_cache, metrics
+from support.logger_config import logger
 
-def compress_image(content: str, mime_type: str, target_size_kb: int = 976) -> bytes:
-    max_bytes = target_size_kb * 1024
-    image = Image.open(content)
+# Pillow releases the GIL while resizing and encoding, so threads are enough
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUEUE_DEPTH = int(os.getenv("IMAGE_QUEUE_DEPTH", "16"))
 
-    # Convert to RGB (needed for JPEG)
-    if image.mode in ("RGBA", "P"):
-        image = image.convert("RGB")
+_executor: Optional[ThreadPoolExecutor] = None
+_slots: Optional[asyncio.Semaphore] = None
 
+
+# --- Media Profiles ---
+class MediaProfile(NamedTuple):
+    """Image limits a platform places on a single post."""
+    target_size_kb: int = 976
+    max_images: int = 4
+    formats: FrozenSet[str] = frozenset({"image/jpeg", "image/png"})
+
+
+# End of MediaProfile
+
+class MediaFile(NamedTuple):
+    """A source image fetched for a post, held in memory or spooled to disk."""
+    name: str
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+
+    def open(self):
+        """Return something Image.open can read, without sharing file handles."""
+        return io.BytesIO(self.data) if self.data is not None else self.path
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+
+# End of MediaFile
+
+class PreparedImage(NamedTuple):
+    """A compressed image held in memory, ready to be uploaded."""
+    name: str
+    mime_type: Optional[str]
+    data: Optional[bytes] = None
+    error: Optional[Exception] = None
+    passes: int = 0
+
+
+# End of PreparedImage
+
+class MediaUploadError(Exception):
+    """Raised when a prepared image could not be uploaded to a platform."""
+
+    def __init__(self, name: str):
+        super().__init__(f"Upload failed for {name}")
+        self.name = name
+
+
+# End of MediaUploadError
+
+# --- Compression ---
+# Pillow format names for the mime types we can re-encode
+ENCODER_FORMATS = {
+    "image/png": "PNG",
+    "image/jpeg": "JPEG",
+    "image/jpg": "JPEG",
+    "image/webp": "WEBP",
+}
+if features.check("avif"):
+    ENCODER_FORMATS["image/avif"] = "AVIF"
+LOSSY_FORMATS = {"JPEG", "WEBP", "AVIF"}
+
+# Smallest first; a platform gets the first one it accepts
+PHOTO_ENCODINGS = ("image/avif", "image/webp", "image/jpeg")
+GRAPHIC_ENCODINGS = ("image/webp", "image/png")  # Encoded losslessly
+GRAPHIC_MAX_COLORS = 256  # Previews with this many colors or fewer are treated as line art
+WEBP_METHOD = 4  # Encoder effort, 0 (fast) to 6 (small)
+
+MAX_QUALITY = 85
+MIN_QUALITY = 20
+PREVIEW_EDGE = 512  # Long edge of the preview used to probe encoder settings
+ESTIMATED_BYTES_PER_PIXEL = 0.25  # Typical photo at MAX_QUALITY, used for the first guess
+MAX_FINAL_PASSES = 4
+UNDERSHOOT_RATIO = 0.6  # A final encode under this share of the budget is retried larger
+FULL_SIZE_PROBE_RATIO = 3.0  # Predicted overshoot up to which the full image is measured before shrinking
+FAST_ENCODE_SLACK = 1.25  # How much larger a fast full-size encode may be than the budget and still fit optimized
+
+
+class CompressionResult(NamedTuple):
+    """Encoded image bytes and how many encodes it took to produce them."""
+    data: bytes
+    passes: int
+    width: int
+    height: int
+    quality: Optional[int] = None
+    probe_passes: int = 0  # Cheap encodes of the downsampled preview
+    mime_type: Optional[str] = None
+    cached: bool = False  # Served from the media cache, without compressing
+
+
+# End of CompressionResult
+
+def compress_image(content, mime_type: str, target_size_kb: int = 976,
+                   formats: Optional[Iterable[str]] = None) -> bytes:
+    return compress_image_with_stats(content, mime_type, target_size_kb, formats).data
+# End of compress_image
+
+
+def compress_image_with_stats(content, mime_type: str, target_size_kb: int = 976,
+                              formats: Optional[Iterable[str]] = None) -> CompressionResult:
+    """
+    Re-encode an image so it fits under a byte budget.
+
+    EXIF orientation is applied to the pixels, and EXIF, XMP and text
+    metadata are dropped; only the ICC color profile is kept.
+
+    Args:
+        content: Path or file object of the source image.
+        mime_type: Mime type of the source image.
+        target_size_kb: Byte budget in KB.
+        formats: Mime types the destination accepts. The smallest suitable
+            encoding among them is chosen (see choose_encoding). Without
+            it, the output keeps the source format.
+
+    Returns:
+        CompressionResult with the encoded bytes, the output mime type and
+        the number of encode passes.
+    """
+    if mime_type not in ENCODER_FORMATS:
+        raise ValueError("Unsupported image type")
+
+    image = ImageOps.exif_transpose(Image.open(content))
+    image.info = {key: value for key, value in image.info.items() if key == "icc_profile"}
+
+    if formats is None:
+        output_mime, lossless = mime_type, ENCODER_FORMATS[mime_type] not in LOSSY_FORMATS
+    else:
+        source_lossy = ENCODER_FORMATS[mime_type] in LOSSY_FORMATS
+        output_mime, lossless = choose_encoding(image, formats, source_lossy)
+    image_format = ENCODER_FORMATS[output_mime]
+    image = _to_encoder_mode(image, image_format)
+
+    result = _bisect_to_budget(image, image_format, target_size_kb * 1024, lossless, _source_size(content))
+    return result._replace(mime_type="image/jpeg" if image_format == "JPEG" else output_mime)
+# End of compress_image_with_stats
+
+
+def _source_size(content) -> Optional[int]:
+    """Byte size of a path or seekable file object, or None if it can't be told."""
+    try:
+        if isinstance(content, (str, os.PathLike)):
+            return os.path.getsize(content)
+        position = content.tell()
+        size = content.seek(0, io.SEEK_END)
+        content.seek(position)
+        return size
+    except (OSError, AttributeError, ValueError):
+        return None
+# End of _source_size
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    if image.mode not in ("RGBA", "LA", "PA") and not (image.mode == "P" and "transparency" in image.info):
+        return False
+    alpha = image.convert("RGBA").getchannel("A")
+    return alpha.getextrema()[0] < 255
+# End of _has_alpha
+
+
+def _is_graphic(image: Image.Image) -> bool:
+    """Screenshots, logos and line art: few distinct colors, which lossless codecs handle best."""
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_EDGE, PREVIEW_EDGE), Image.NEAREST)
+    return preview.convert("RGB").getcolors(GRAPHIC_MAX_COLORS) is not None
+# End of _is_graphic
+
+
+def choose_encoding(image: Image.Image, formats: Iterable[str], source_lossy: bool = False) -> Tuple[str, bool]:
+    """
+    Pick the output mime type for an image, given what the platform accepts.
+
+    Photos get the smallest lossy codec available (AVIF, then WebP, then
+    JPEG). Line art stays lossless, as does transparency when no lossy codec
+    that keeps an alpha channel is accepted. Sources that are already lossy
+    are never treated as line art, since a lossless copy of their artifacts
+    only costs bytes.
+
+    Returns:
+        The output mime type and whether it is encoded losslessly.
+    """
+    accepted = [mime for mime in formats if mime in ENCODER_FORMATS]
+    alpha = _has_alpha(image)
+
+    if not source_lossy and _is_graphic(image):
+        for mime in GRAPHIC_ENCODINGS:
+            if mime in accepted:
+                return mime, True
+
+    for mime in PHOTO_ENCODINGS:
+        if mime in accepted and not (alpha and mime == "image/jpeg" and "image/png" in accepted):
+            return mime, False
+
+    if "image/png" in accepted:
+        return "image/png", True
+    raise ValueError("No supported output format")
+# End of choose_encoding
+
+
+def _to_encoder_mode(image: Image.Image, image_format: str) -> Image.Image:
+    if image_format == "JPEG":
+        if _has_alpha(image):
+            # Flatten onto white; dropping the alpha channel would leave black behind transparent areas
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+            return background
+        return image if image.mode in ("RGB", "L") else image.convert("RGB")
+    if image.mode == "P" or image.mode not in ("RGB", "RGBA", "L", "LA"):
+        return image.convert("RGBA" if _has_alpha(image) else "RGB")
+    return image
+# End of _to_encoder_mode
+
+
+def _encode(image: Image.Image, image_format: str, quality: Optional[int], optimize: bool = True,
+            lossless: bool = False) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "WEBP":
+        if lossless:
+            image.save(buffer, format="WEBP", lossless=True, quality=80 if optimize else 0, method=WEBP_METHOD)
+        else:
+            image.save(buffer, format="WEBP", quality=quality, method=WEBP_METHOD if optimize else 0)
+    elif image_format == "AVIF":
+        image.save(buffer, format="AVIF", quality=quality, speed=6 if optimize else 10)
+    elif image_format in LOSSY_FORMATS:
+        image.save(buffer, format=image_format, optimize=optimize, quality=quality)
+    else:
+        # zlib level 6 is within a few percent of optimize=True at a fraction of the time
+        image.save(buffer, format=image_format, compress_level=6 if optimize else 1)
+    return buffer.getvalue()
+# End of _encode
+
+
+def _resize(image: Image.Image, scale: float) -> Image.Image:
+    if scale >= 1:
+        return image
+    width, height = image.size
+    return image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+# End of _resize
+
+
+def _shrink_to_budget(image: Image.Image, image_format: str, max_bytes: int,
+                      lossless: bool = False) -> CompressionResult:
     # Set initial quality/resizing parameters
-    quality = 85
+    lossy = image_format in LOSSY_FORMATS and not lossless
+    quality = MAX_QUALITY
     width, height = image.size
     scale_factor = 0.9  # Shrink by 10% each iteration
-    min_quality = 20
-
-    output = io.BytesIO()
+    passes = 0
 
     while True:
-        temp_io = io.BytesIO()
-
         # Resize if necessary
         image_resized = image.resize((int(width), int(height)), Image.LANCZOS)
-
-        if mime_type == "image/png":
-            image_resized.save(temp_io, format="PNG", optimize=True)
-        elif mime_type in ["image/jpeg", "image/jpg"]:
-            image_resized.save(temp_io, format="JPEG", optimize=True, quality=quality)
-        else:
-            raise ValueError("Unsupported image type")
-
-        size = temp_io.tell()
+        data = _encode(image_resized, image_format, quality, lossless=lossless)
+        passes += 1
 
         # Check if image meets size requirement
-        if size <= max_bytes or (quality <= min_quality and (width < 200 or height < 200)):
-            output = temp_io
-            break
+        if len(data) <= max_bytes or (quality <= MIN_QUALITY and (width < 200 or height < 200)):
+            return CompressionResult(data, passes, int(width), int(height), quality if lossy else None)
 
         # Otherwise shrink more
         width *= scale_factor
         height *= scale_factor
-        quality = max(min_quality, quality - 5)
+        quality = max(MIN_QUALITY, quality - 5)
+# End of _shrink_to_budget
+
+
+def _bisect_to_budget(image: Image.Image, image_format: str, max_bytes: int,
+                      lossless: bool = False, source_bytes: Optional[int] = None) -> CompressionResult:
+    """
+    Pick a scale and quality from a small preview, then encode the full image.
+
+    The preview predicts full-size output (bytes per pixel) but
+    overestimates detailed images such as line art. So the full image is
+    encoded as is when the source or the prediction says it fits, and
+    otherwise measured with a fast encode when the output is lossless or the
+    prediction is within FULL_SIZE_PROBE_RATIO. A close measurement is
+    followed by the real encode, and a miss sets the scale directly.
+
+    Lossy images far over budget start at a scale estimated from the pixel
+    count and the budget, with a binary search over quality on the preview.
+    A final encode that lands far under budget is retried larger.
+    """
+    lossy = image_format in LOSSY_FORMATS and not lossless
+    width, height = image.size
+    pixels = width * height
+    passes = 0
+    probe_passes = 0
+
+    # Downsampled preview to probe the encoder on
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_EDGE, PREVIEW_EDGE), Image.BILINEAR)
+    preview_pixels = preview.size[0] * preview.size[1]
+
+    def predicted_size(quality: Optional[int], at_scale: float) -> float:
+        nonlocal probe_passes
+        probe_passes += 1
+        bytes_per_pixel = len(_encode(preview, image_format, quality, optimize=False, lossless=lossless)) / preview_pixels
+        return bytes_per_pixel * pixels * at_scale * at_scale
+
+    scale = 1.0
+    quality = MAX_QUALITY if lossy else None
+    source_fits = source_bytes is not None and source_bytes <= max_bytes
+    predicted = None if source_fits else predicted_size(quality, scale)
+    measured = None
+    if predicted is not None and predicted > max_bytes and (lossless or predicted <= FULL_SIZE_PROBE_RATIO * max_bytes):
+        probe_passes += 1
+        measured = len(_encode(image, image_format, quality, optimize=False, lossless=lossless))
+    if predicted is None or predicted <= max_bytes or (measured is not None and measured <= FAST_ENCODE_SLACK * max_bytes):
+        data = _encode(image, image_format, quality, lossless=lossless)
+        passes += 1
+        if len(data) <= max_bytes:
+            return CompressionResult(data, passes, width, height, quality, probe_passes)
+        measured = len(data)
+
+    if measured is not None:
+        # The full image was measured, so scale from that at the same quality
+        scale = 0.95 * (max_bytes / measured) ** 0.5
+    else:
+        # Lossy and far over budget: estimated starting scale from the pixel count and the budget
+        scale = min(1.0, (max_bytes / (pixels * ESTIMATED_BYTES_PER_PIXEL)) ** 0.5)
+        # Highest quality whose predicted size fits the budget at this scale
+        low, high = MIN_QUALITY, MAX_QUALITY
+        best = None
+        while low <= high:
+            mid = (low + high) // 2
+            if predicted_size(mid, scale) <= max_bytes:
+                best, low = mid, mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            # Even the lowest quality is too big, so shrink further at that quality
+            quality = MIN_QUALITY
+            scale *= min(1.0, (max_bytes / predicted_size(quality, scale)) ** 0.5)
+        else:
+            quality = best
+
+    # Final encode, correcting the scale in either direction if the prediction was off
+    fitted = None
+    for _ in range(MAX_FINAL_PASSES):
+        resized = _resize(image, scale)
+        data = _encode(resized, image_format, quality, lossless=lossless)
+        passes += 1
+        if len(data) > max_bytes:
+            if fitted is not None:
+                break  # Growing overshot, so keep the last encode that fit
+            scale *= 0.95 * (max_bytes / len(data)) ** 0.5
+            continue
+
+        fitted = CompressionResult(data, passes, resized.size[0], resized.size[1], quality, probe_passes)
+        if len(data) >= UNDERSHOOT_RATIO * max_bytes:
+            break
+        grown = min(1.0, scale * 0.95 * (max_bytes / len(data)) ** 0.5)
+        if grown > scale * 1.02:
+            scale = grown
+        elif lossy and quality < MAX_QUALITY:
+            quality = MAX_QUALITY
+        else:
+            break
+
+    if fitted is None:
+        # Fall back to the step-down loop from the current size
+        result = _shrink_to_budget(resized, image_format, max_bytes, lossless)
+        return result._replace(passes=passes + result.passes, probe_passes=probe_passes)
+    return fitted._replace(passes=passes)
+# End of _bisect_to_budget
+
+
+# --- Executor ---
+def start_executor(workers: int = IMAGE_WORKERS, queue_depth: int = IMAGE_QUEUE_DEPTH) -> None:
+    """
+    Start the worker pool used for image processing.
+
+    Args:
+        workers: Number of worker threads.
+        queue_depth: Jobs allowed to wait for a worker before callers are held back.
+    """
+    global _executor, _slots
+    if _executor is not None:
+        return
+    _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+    _slots = asyncio.Semaphore(workers + queue_depth)
+    logger.info(f"Image executor started with {workers} workers and queue depth {queue_depth}")
+# End of start_executor
+
+
+async def shutdown_executor() -> None:
+    """Let queued image jobs finish, then stop the worker pool."""
+    global _executor, _slots
+    if _executor is None:
+        return
+    executor, _executor, _slots = _executor, None, None
+    await asyncio.to_thread(executor.shutdown, wait=True)
+    logger.info("Image executor stopped")
+# End of shutdown_executor
+
+
+async def run_in_executor(func: Callable, *args):
+    """
+    Run blocking image work on the worker pool.
+
+    Waits for a free slot when the pool and its queue are full, so a burst
+    of posts is held back here instead of piling up unbounded work.
+    """
+    if _executor is None:
+        start_executor()
+    executor, slots = _executor, _slots
+    async with slots:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+# End of run_in_executor
+
+
+def compress_cached(media: MediaFile, mime_type: str, target_size_kb: int,
+                    formats: FrozenSet[str]) -> CompressionResult:
+    """
+    compress_image_with_stats behind the on-disk media cache.
+
+    The key is the source's content hash plus the profile, so a re-post or
+    retry of the same image skips compression. Cache hits report 0 passes.
+    """
+    cache = media_cache.cache
+    if not cache.enabled:
+        return compress_image_with_stats(media.open(), mime_type, target_size_kb, formats)
+
+    key = media_cache.cache_key(media_cache.content_hash(media.data, media.path), target_size_kb, formats)
+    cached = cache.get(key)
+    if cached is not None:
+        return CompressionResult(cached.data, 0, 0, 0, mime_type=cached.mime_type, cached=True)
+
+    result = compress_image_with_stats(media.open(), mime_type, target_size_kb, formats)
+    cache.put(key, result.data, result.mime_type)
+    return result
+# End of compress_cached
+
+
+async def _prepare_one(media: MediaFile, target_size_kb: int, formats: FrozenSet[str]) -> PreparedImage:
+    mime_type, _ = mimetypes.guess_type(media.name)
+    try:
+        started = time.perf_counter()
+        result = await run_in_executor(compress_cached, media, mime_type, target_size_kb, formats)
+        logger.debug(f'Compressed {media.name} to {len(result.data)} bytes of {result.mime_type} '
+                     f'in {result.passes} passes (+{result.probe_passes} preview) '
+                     f'in {(time.perf_counter() - started) * 1000:.0f} ms')
+        if not result.cached:
+            metrics.COMPRESSION_BYTES.labels('in').inc(media.size)
+            metrics.COMPRESSION_BYTES.labels('out').inc(len(result.data))
+        return PreparedImage(media.name, result.mime_type, result.data, passes=result.passes)
+    except Exception as error:
+        logger.error(f'Failed to compress image {media.name}: {error}')
+        return PreparedImage(media.name, mime_type, error=error)
+# End of _prepare_one
+
+
+async def prepare_media(media: List[MediaFile],
+                        profiles: Iterable[MediaProfile]) -> Dict[MediaProfile, List[PreparedImage]]:
+    """
+    Compress a post's images once for every distinct platform size limit and format set.
+
+    Args:
+        media: Source images, in post order.
+        profiles: Media profiles of the platforms the post is going to.
+
+    Returns:
+        Mapping of each profile to its list of PreparedImage objects.
+    """
+    profiles = set(profiles)
+
+    # Work out how many images each distinct size limit and format set actually needs
+    needed: Dict[Tuple[int, FrozenSet[str]], int] = {}
+    for profile in profiles:
+        target = (profile.target_size_kb, profile.formats)
+        needed[target] = max(needed.get(target, 0), profile.max_images)
+
+    keys = [(index, target)
+            for target, count in needed.items()
+            for index in range(min(count, len(media)))]
+    results = await asyncio.gather(*(_prepare_one(media[index], *target) for index, target in keys))
+    compressed = dict(zip(keys, results))
 
-    return output.getvalue()
+    return {
+        profile: [compressed[(index, (profile.target_size_kb, profile.formats))]
+                  for index in range(min(profile.max_images, len(media)))]
+        for profile in profiles
+    }
+# End of prepare_media
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from support.logger_config import log_context, logger
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "data/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+JOB_SHUTDOWN_GRACE = float(os.getenv("JOB_SHUTDOWN_GRACE", "60"))  # Seconds running jobs get to finish on shutdown
+
+
+# --- Job Model ---
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: str  # queued, running, done or failed
+    payload: Dict[str, Any]
+    progress: Dict[str, Any] = {}
+    result: Optional[Any] = None
+    created_at: float
+    updated_at: float
+
+
+# End of Job
+
+# Handlers receive the payload, a callback that stores progress on the job, and the
+# progress stored by an earlier run that was interrupted (empty on the first run)
+ProgressCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+JobHandler = Callable[[Dict[str, Any], ProgressCallback, Dict[str, Any]], Awaitable[Any]]
+
+
+# --- Storage ---
+class JobStore(ABC):
+    """
+    Persistence for background jobs.
+
+    SQLiteJobStore is the local default. A Postgres or Redis backed store only
+    has to implement these methods to be swapped in through create_store.
+    """
+
+    @abstractmethod
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> Job: ...
+
+    @abstractmethod
+    async def claim(self) -> Optional[Job]:
+        """Atomically move the oldest queued job to running and return it."""
+
+    @abstractmethod
+    async def set_progress(self, job_id: str, progress: Dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    async def finish(self, job_id: str, status: str, result: Any = None) -> None: ...
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[Job]: ...
+
+    @abstractmethod
+    async def requeue_running(self) -> int:
+        """Put jobs left running by a previous process back on the queue."""
+
+    async def close(self) -> None:
+        pass
+
+
+# End of JobStore
+
+class SQLiteJobStore(JobStore):
+    """Job store backed by a local SQLite file, accessed from worker threads."""
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                progress TEXT NOT NULL DEFAULT '{}',
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created_at)")
+
+    async def _run(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        def run():
+            with self._lock:
+                return self._db.execute(sql, params).fetchall()
+        return await asyncio.to_thread(run)
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> Job:
+        return Job(
+            id=row['id'], kind=row['kind'], status=row['status'],
+            payload=json.loads(row['payload']), progress=json.loads(row['progress']),
+            result=json.loads(row['result']) if row['result'] is not None else None,
+            created_at=row['created_at'], updated_at=row['updated_at'],
+        )
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> Job:
+        now = time.time()
+        rows = await self._run(
+            "INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?) RETURNING *",
+            (uuid.uuid4().hex, kind, json.dumps(payload), now, now))
+        return self._to_job(rows[0])
+
+    async def claim(self) -> Optional[Job]:
+        rows = await self._run(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ("
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) RETURNING *",
+            (time.time(),))
+        return self._to_job(rows[0]) if rows else None
+
+    async def set_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+        await self._run("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                        (json.dumps(progress), time.time(), job_id))
+
+    async def finish(self, job_id: str, status: str, result: Any = None) -> None:
+        # The payload can hold account credentials, so it is not kept once the job is over
+        await self._run("UPDATE jobs SET status = ?, result = ?, payload = '{}', updated_at = ? WHERE id = ?",
+                        (status, json.dumps(result, default=str), time.time(), job_id))
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        rows = await self._run("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._to_job(rows[0]) if rows else None
+
+    async def requeue_running(self) -> int:
+        rows = await self._run("UPDATE jobs SET status = 'queued', updated_at = ? "
+                               "WHERE status = 'running' RETURNING id", (time.time(),))
+        return len(rows)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# End of SQLiteJobStore
+
+def create_store() -> JobStore:
+    return SQLiteJobStore(JOB_DB_PATH)
+# End of create_store
+
+
+# --- Queue ---
+class JobQueue:
+    """A pool of asyncio workers that run handlers for jobs in a JobStore."""
+
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    async def submit(self, kind: str, payload: Dict[str, Any]) -> Job:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        job = await self.store.enqueue(kind, payload)
+        self._wakeup.set()
+        return job
+
+    async def start(self) -> None:
+        requeued = await self.store.requeue_running()
+        if requeued:
+            logger.warning(f"Requeued {requeued} jobs left running by a previous process")
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self, grace: float = JOB_SHUTDOWN_GRACE) -> None:
+        """
+        Stop claiming jobs and give running ones up to grace seconds to finish.
+
+        Jobs still running after that are cancelled and requeued on the next
+        start, where handlers get the progress they had stored.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=grace)
+            if pending:
+                logger.warning(f"Cancelling {len(pending)} workers whose jobs were still running after {grace:.0f}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.store.close()
+
+    async def _worker(self, number: int) -> None:
+        while not self._stopping:
+            job = await self.store.claim()
+            if job is None:
+                self._wakeup.clear()
+                if self._stopping:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Job) -> None:
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            await self.store.finish(job.id, 'failed', {'error': f"Unknown job kind '{job.kind}'"})
+            return
+
+        async def progress(update: Dict[str, Any]) -> None:
+            await self.store.set_progress(job.id, update)
+
+        with log_context(job_id=job.id):
+            try:
+                if job.progress:
+                    logger.info(f"Resuming job {job.id} ({job.kind}) from its stored progress")
+                result = await handler(job.payload, progress, job.progress)
+                await self.store.finish(job.id, 'done', result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.error(f"Job {job.id} ({job.kind}) failed: {error}")
+                await self.store.finish(job.id, 'failed', {'error': str(error)})
+
+
+# End of JobQueue
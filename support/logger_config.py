@@ -1,22 +1,184 @@
+import atexit
+import contextlib
+import contextvars
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Size at which the log file rotates
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))  # Rotated files kept next to the log file
+LOG_CONSOLE_FORMAT = os.getenv("LOG_CONSOLE_FORMAT", "text")  # 'text' or 'json'
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "200"))  # Records per level per window, 0 for no limit
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "60"))  # Seconds
+
+# --- Context ---
+# Fields attached to every record logged inside log_context, e.g. by a job or a platform
+CONTEXT_FIELDS = ('post_id', 'job_id', 'platform')
+_context = {name: contextvars.ContextVar(f"log_{name}", default=None) for name in CONTEXT_FIELDS}
+_context_started: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("log_started", default=None)
+
+
+@contextlib.contextmanager
+def log_context(**fields) -> Iterator[None]:
+    """
+    Tag every record logged inside the block, in this task and tasks it starts.
+
+    Records also get duration_ms, the time since the innermost log_context
+    was entered, unless they pass their own through extra.
+    """
+    tokens = [(_context[name], _context[name].set(value)) for name, value in fields.items()]
+    tokens.append((_context_started, _context_started.set(time.monotonic())))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+# End of log_context
+
+
+class ContextFilter(logging.Filter):
+    """Copy the log_context fields onto a record, on the thread that logged it."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, var in _context.items():
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        started = _context_started.get()
+        if getattr(record, 'duration_ms', None) is None and started is not None:
+            record.duration_ms = round((time.monotonic() - started) * 1000, 1)
+        return True
+
+
+# End of ContextFilter
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most limit records of each level through per window.
+
+    The rest are dropped and counted, and the first record let through in
+    the next window carries the count as suppressed.
+    """
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._windows: Dict[int, Tuple[float, int, int]] = {}  # level -> (window start, passed, dropped)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            started, passed, dropped = self._windows.get(record.levelno, (now, 0, 0))
+            if now - started >= self.window:
+                if dropped:
+                    record.suppressed = dropped
+                started, passed, dropped = now, 0, 0
+            if passed >= self.limit:
+                self._windows[record.levelno] = (started, passed, dropped + 1)
+                return False
+            self._windows[record.levelno] = (started, passed + 1, dropped)
+        return True
+
+
+# End of RateLimitFilter
+
+# --- Formatting ---
+def _fields(record: logging.LogRecord) -> Dict:
+    fields = {name: getattr(record, name, None) for name in (*CONTEXT_FIELDS, 'duration_ms', 'suppressed')}
+    return {name: value for name, value in fields.items() if value is not None}
+# End of _fields
+
+
+class TextFormatter(logging.Formatter):
+    """The usual one-line format, with any context fields appended."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        message = super().formatMessage(record)
+        fields = _fields(record)
+        if fields:
+            message += ' [' + ' '.join(f"{name}={value}" for name, value in fields.items()) + ']'
+        return message
+
+
+# End of TextFormatter
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for the log file and log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# End of JsonFormatter
+
+# --- Handlers ---
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the listener thread, which does all the formatting I/O.
+
+    The message and any traceback are rendered here, while the arguments
+    are still current, but kept apart so the JSON output has both fields.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+# End of BackgroundHandler
 
 # Create a logger instance
 logger = logging.getLogger("Loftly API")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
-# Add a console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
+# Attach the handlers once, even if the module is imported again
+if not logger.handlers:
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(JsonFormatter() if LOG_CONSOLE_FORMAT == 'json' else TextFormatter())
 
-# Set a format
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
+    os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
 
-# File handler
-file_handler = logging.FileHandler("logs/app.log")
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    # Loggers on the event loop only enqueue; a thread writes to the console and the file
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = BackgroundHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+    logger.addHandler(queue_handler)
 
-# Attach the handler (avoid duplicates)
-if not logger.handlers:
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
\ No newline at end of file
+    listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler)
+    listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(listener.stop)
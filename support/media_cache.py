@@ -0,0 +1,180 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from support import metrics
+from support.logger_config import logger
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "data/media_cache")
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "256"))  # 0 disables the cache
+
+# Bumped whenever encoder settings change, so stale outputs are never served
+CACHE_VERSION = "1"
+
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/avif": ".avif",
+}
+MIME_TYPES = {extension: mime for mime, extension in EXTENSIONS.items()}
+
+
+class CachedMedia(NamedTuple):
+    data: bytes
+    mime_type: str
+
+
+# End of CachedMedia
+
+# --- Hashing ---
+def content_hash(data: Optional[bytes] = None, path: Optional[str] = None) -> str:
+    """SHA-256 of a file's bytes, read in chunks when it is on disk."""
+    digest = hashlib.sha256()
+    if data is not None:
+        digest.update(data)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+# End of content_hash
+
+
+def cache_key(source_hash: str, target_size_kb: int, formats: Iterable[str]) -> str:
+    """Key for one source image compressed for one profile."""
+    profile = f"{target_size_kb}:{','.join(sorted(formats))}"
+    return hashlib.sha256(f"{CACHE_VERSION}|{source_hash}|{profile}".encode()).hexdigest()
+# End of cache_key
+
+
+# --- Disk Cache ---
+class MediaCache:
+    """
+    Compressed images on local disk, keyed by content hash and profile.
+
+    File modification times record recency: a hit touches the file, and once
+    the directory grows past max_bytes the least recently used files go
+    first. Safe to use from the image worker threads.
+    """
+
+    def __init__(self, directory: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[str, int, float]] = {}  # key -> (file name, size, last used)
+        self._size = 0
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[CachedMedia]:
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            name, size, _ = entry
+            self._entries[key] = (name, size, time.time())
+
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._size -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return CachedMedia(data, MIME_TYPES[os.path.splitext(name)[1]])
+
+    def put(self, key: str, data: bytes, mime_type: str) -> None:
+        extension = EXTENSIONS.get(mime_type)
+        if extension is None or len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._load()
+
+        name = key + extension
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as error:
+            logger.warning(f"Could not write media cache entry {name}: {error}")
+            return
+
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (name, len(data), time.time())
+            self._size += len(data)
+            self._evict()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _load(self) -> None:
+        """Index what is already on disk, once. Called with the lock held."""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in os.scandir(self.directory):
+            key, extension = os.path.splitext(entry.name)
+            if extension == ".tmp":
+                os.remove(entry.path)
+                continue
+            if extension not in MIME_TYPES or not entry.is_file():
+                continue
+            stat = entry.stat()
+            self._entries[key] = (entry.name, stat.st_size, stat.st_mtime)
+            self._size += stat.st_size
+        self._evict()
+
+    def _evict(self) -> None:
+        """Drop least recently used files until under max_bytes. Called with the lock held."""
+        if self._size <= self.max_bytes:
+            return
+        for key, (name, size, _) in sorted(self._entries.items(), key=lambda item: item[1][2]):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logger.warning(f"Could not evict media cache entry {name}: {error}")
+                continue
+            del self._entries[key]
+            self._size -= size
+
+
+# End of MediaCache
+
+cache = MediaCache()
+metrics.register_cache("media", cache.stats)
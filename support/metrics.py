@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+import functools
+import hmac
+import os
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))  # Seconds between event-loop lag probes
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Bearer token /metrics requires; empty disables the endpoint
+
+# Upstream calls range from a cached lookup to a video upload
+SLOW_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# --- Series ---
+HTTP_REQUEST_SECONDS = Histogram(
+    "loftly_http_request_duration_seconds", "Time to respond to an API request",
+    ["method", "route", "status"], buckets=SLOW_BUCKETS)
+POST_PHASE_SECONDS = Histogram(
+    "loftly_post_phase_duration_seconds", "Time spent in each phase of publishing a post",
+    ["phase"], buckets=SLOW_BUCKETS)
+PLATFORM_PHASE_SECONDS = Histogram(
+    "loftly_platform_phase_duration_seconds", "Time spent in each step of posting to a platform",
+    ["platform", "phase", "outcome"], buckets=SLOW_BUCKETS)
+DATABASE_CALL_SECONDS = Histogram(
+    "loftly_database_call_duration_seconds", "Time taken by each support.database function",
+    ["function", "outcome"], buckets=SLOW_BUCKETS)
+COMPRESSION_BYTES = Counter(
+    "loftly_image_compression_bytes", "Image bytes into and out of compression",
+    ["direction"])
+RETRIES = Counter(
+    "loftly_upstream_retries", "Upstream calls retried after a transient failure",
+    ["target"])
+LOOP_LAG_SECONDS = Histogram(
+    "loftly_event_loop_lag_seconds", "How late the event loop woke a sleeping probe",
+    buckets=LAG_BUCKETS)
+LOOP_LAG_CURRENT = Gauge(
+    "loftly_event_loop_lag_current_seconds", "Event-loop lag at the latest probe")
+
+
+# --- Timing ---
+@contextlib.contextmanager
+def timer(histogram: Histogram, outcome: bool = False, **labels) -> Iterator[None]:
+    """
+    Observe how long the block took.
+
+    With outcome=True the histogram's outcome label is set to 'ok', or to
+    'error' if the block raised.
+    """
+    result = 'ok'
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        result = 'error'
+        raise
+    finally:
+        if outcome:
+            labels['outcome'] = result
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+# End of timer
+
+
+def timed_database_call(func: Callable) -> Callable:
+    """Record an async support.database function in DATABASE_CALL_SECONDS."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timer(DATABASE_CALL_SECONDS, outcome=True, function=func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+# End of timed_database_call
+
+
+# --- Caches ---
+class CacheCollector:
+    """
+    Hit and miss counters, and the hit ratio, of every registered cache.
+
+    Caches keep their own counts, so they are read at scrape time instead
+    of being mirrored into Prometheus counters on every lookup.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, name: str, stats: Callable[[], dict]) -> None:
+        self._caches[name] = stats
+
+    def collect(self):
+        hits = CounterMetricFamily("loftly_cache_hits", "Cache lookups that found an entry", labels=["cache"])
+        misses = CounterMetricFamily("loftly_cache_misses", "Cache lookups that found nothing", labels=["cache"])
+        ratio = GaugeMetricFamily("loftly_cache_hit_ratio", "Share of cache lookups that hit, since startup",
+                                  labels=["cache"])
+        for name, stats in self._caches.items():
+            counts = stats()
+            hits.add_metric([name], counts['hits'])
+            misses.add_metric([name], counts['misses'])
+            ratio.add_metric([name], counts['hit_rate'])
+        yield from (hits, misses, ratio)
+
+
+# End of CacheCollector
+
+_caches = CacheCollector()
+REGISTRY.register(_caches)
+
+
+def register_cache(name: str, stats: Callable[[], dict]) -> None:
+    """Export a cache whose stats() returns hits, misses and hit_rate."""
+    _caches.register(name, stats)
+# End of register_cache
+
+
+# --- Event Loop Lag ---
+class LoopLagMonitor:
+    """Sleeps LOOP_LAG_INTERVAL at a time and records how late the loop wakes it."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            LOOP_LAG_CURRENT.set(lag)
+
+
+# End of LoopLagMonitor
+
+loop_lag = LoopLagMonitor()
+
+
+# --- Exposition ---
+def render() -> tuple:
+    """The current metrics in the Prometheus text format, and their content type."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+# End of render
+
+
+def is_authorized(authorization: Optional[str]) -> bool:
+    """Whether an Authorization header carries METRICS_TOKEN as a bearer token."""
+    scheme, _, token = (authorization or '').partition(' ')
+    return bool(METRICS_TOKEN) and scheme.lower() == 'bearer' and hmac.compare_digest(token, METRICS_TOKEN)
+# End of is_authorized
@@ -100,6 +100,7 @@ class Post(BaseModel):
     supabase_jwt: Optional[str] = None
     supabase_refresh_jwt: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    publish_at: Optional[datetime] = Field(None, description="Publish later at this time, UTC unless it has an offset")
 
 
 # End of Post
@@ -0,0 +1,175 @@
+import asyncio
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from fastapi import Request
+from pyinstrument import Profiler
+
+from support.logger_config import logger
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")  # Requests with this X-Profile header are profiled; empty disables
+PROFILE_HEADER = "X-Profile"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # Share of all requests profiled at random
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))  # Seconds between stack samples
+PROFILE_DIR = os.getenv("PROFILE_DIR", "logs/profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))  # Newest profiles kept in PROFILE_DIR
+LOOP_WATCHDOG_MS = float(os.getenv("LOOP_WATCHDOG_MS", "0"))  # Block length that gets logged, 0 disables
+LOOP_WATCHDOG_FRAMES = 30  # Innermost frames of a blocked loop's stack that get logged
+
+# Frames from these files are the app's own code, as opposed to SDKs and the standard library
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+_profiling = threading.Lock()  # One profile at a time, so samples are not shared between requests
+
+
+# --- Request Profiling ---
+def should_profile(request: Request) -> bool:
+    """Whether to profile a request: it carries the admin token, or it was sampled."""
+    token = request.headers.get(PROFILE_HEADER)
+    if token and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+# End of should_profile
+
+
+def _save_profile(profiler: Profiler, name: str) -> str:
+    """Write the profile as HTML and drop the oldest ones past PROFILE_KEEP. Returns the file name."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    file_name = f"{name}.html"
+    with open(os.path.join(PROFILE_DIR, file_name), 'w', encoding='utf-8') as f:
+        f.write(profiler.output_html())
+
+    profiles = sorted(entry for entry in os.listdir(PROFILE_DIR) if entry.endswith('.html'))
+    for old in profiles[:max(0, len(profiles) - PROFILE_KEEP)]:
+        os.remove(os.path.join(PROFILE_DIR, old))
+    return file_name
+# End of _save_profile
+
+
+async def profile_request(request: Request, call_next):
+    """
+    Run a request under a sampling profiler.
+
+    With async_mode, only time spent on this request's behalf is sampled,
+    including awaits, even while other requests share the loop. The text
+    summary is logged and the full profile saved as HTML in PROFILE_DIR;
+    requests that asked with the header get its name in X-Profile-Id. A
+    profile that cannot be rendered or saved is logged and skipped; the
+    response goes out either way.
+    """
+    if not _profiling.acquire(blocking=False):
+        logger.info(f"Not profiling {request.method} {request.url.path}: another profile is running")
+        return await call_next(request)
+
+    file_name = None
+    try:
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode='enabled')
+        profiler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            profiler.stop()
+
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', request.url.path).strip('-') or 'root'
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{request.method.lower()}-{slug}"
+        try:
+            # Rendering walks every sample, so keep it off the loop
+            summary = await asyncio.to_thread(profiler.output_text)
+            file_name = await asyncio.to_thread(_save_profile, profiler, name)
+            logger.info(f"Profile of {request.method} {request.url.path} saved as {file_name}:\n{summary}")
+        except Exception as error:
+            logger.error(f"Failed to save the profile of {request.method} {request.url.path}: {error}")
+    finally:
+        _profiling.release()
+
+    if file_name is not None and request.headers.get(PROFILE_HEADER):
+        response.headers['X-Profile-Id'] = file_name
+    return response
+# End of profile_request
+
+
+# --- Loop Watchdog ---
+def _culprit(frame) -> str:
+    """module.function of the innermost app frame on a stack, e.g. database.load_images."""
+    innermost = frame
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(APP_ROOT) and os.sep + 'site-packages' + os.sep not in path:
+            module = os.path.splitext(os.path.basename(path))[0]
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return f"{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_code.co_name}" if innermost else "unknown"
+# End of _culprit
+
+
+class LoopWatchdog:
+    """
+    Logs where the event loop is stuck when it does not run for threshold seconds.
+
+    A task on the loop updates a heartbeat every threshold/4. A thread checks
+    it just as often, and when it is older than the threshold, logs the loop
+    thread's current stack with the app function at fault. Each block is
+    reported once, then again with its total length when the loop resumes.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Loop watchdog reporting blocks over {self.threshold * 1000:.0f} ms")
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _beat(self) -> None:
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self) -> None:
+        reported: Optional[float] = None  # Heartbeat of the block already logged
+        culprit = ""
+        while not self._stopped.wait(self.threshold / 4):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+            if reported is not None and heartbeat != reported:
+                logger.warning(f"Event loop resumed after {(heartbeat - reported) * 1000:.0f} ms blocked in {culprit}")
+                reported = None
+            if reported is None and stalled >= self.threshold:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                culprit = _culprit(frame)
+                stack = ''.join(traceback.format_stack(frame, LOOP_WATCHDOG_FRAMES))
+                logger.warning(f"Event loop blocked for {stalled * 1000:.0f} ms in {culprit}:\n{stack}")
+                reported = heartbeat
+
+
+# End of LoopWatchdog
+
+watchdog = LoopWatchdog(LOOP_WATCHDOG_MS / 1000) if LOOP_WATCHDOG_MS > 0 else None
@@ -0,0 +1,220 @@
+import asyncio
+import uuid
+from typing import Any, Dict, List, NamedTuple, Optional
+
+# Importing the platform modules registers their adapters
+from platforms import base, bluesky, lemmyapi, mastodonapi, pixelfedapi  # noqa: F401
+from support import database, history, image_handler, metrics, models, resilience, video_handler
+from support.jobs import ProgressCallback
+from support.logger_config import log_context, logger
+
+
+class PostMedia(NamedTuple):
+    """
+    A post's media, downloaded ahead of publishing by prefetch_media.
+
+    The source images are spooled to disk and their compressed versions are
+    in the media cache. The storage copies are kept until the post is out.
+    """
+    files: List[image_handler.MediaFile]
+    video: Optional[video_handler.VideoFile] = None
+    videos: Optional[Dict[video_handler.VideoProfile, video_handler.PreparedVideo]] = None
+
+
+# End of PostMedia
+
+# --- Media ---
+def _is_video(metadata: models.Post) -> bool:
+    return metadata.type == models.PostType.VIDEO and bool(metadata.video_filename)
+# End of _is_video
+
+
+def _adapters(metadata: models.Post) -> List[Optional[base.PlatformAdapter]]:
+    return [base.get_adapter(account.platform) for account in metadata.connected_accounts or []]
+# End of _adapters
+
+
+async def prefetch_media(metadata: models.Post) -> Optional[PostMedia]:
+    """
+    Download a post's media and fit it to its platforms ahead of publishing.
+
+    Images are compressed only to warm the media cache, so nothing but file
+    paths is held until the post goes out. Returns None if the post has no
+    media or no supported platform.
+    """
+    adapters = [adapter for adapter in _adapters(metadata) if adapter is not None]
+    if not adapters:
+        return None
+
+    if _is_video(metadata):
+        video = await database.load_video(metadata.video_filename, metadata.user_id, remove=False)
+        if video is None:
+            return None
+        profiles = {adapter.capabilities.video_profile for adapter in adapters if adapter.capabilities.video_profile}
+        videos = await video_handler.prepare_video(video, profiles) if profiles else {}
+        return PostMedia([], video, videos)
+
+    if metadata.media_filenames:
+        files = await database.load_images(metadata.media_filenames, metadata.user_id,
+                                           remove=False, spool_threshold_kb=0)
+        profiles = {adapter.capabilities.media_profile for adapter in adapters if adapter.capabilities.media_profile}
+        if files and profiles:
+            await image_handler.prepare_media(files, profiles)
+        return PostMedia(files)
+
+    return None
+# End of prefetch_media
+
+
+def discard_media(media: PostMedia) -> None:
+    """Delete the local files of prefetched media that will not be published."""
+    database.delete_images(media.files)
+    if media.video is not None:
+        video_handler.delete_files([media.video, *(media.videos or {}).values()])
+# End of discard_media
+
+
+# --- Publishing Pipeline ---
+async def publish_post(metadata: models.Post, progress: Optional[ProgressCallback] = None,
+                       prefetched: Optional[PostMedia] = None, resumed: Optional[Dict[str, Any]] = None) -> List:
+    """
+    Download, compress and publish a post to every connected account, then record its history.
+
+    Args:
+        metadata: The post to publish.
+        progress: Optional callback that receives the post's stage and
+            per-platform status whenever either changes.
+        prefetched: Media already fetched by prefetch_media. Either way, the
+            storage copies are only deleted once the post is out, so an
+            interrupted attempt can download them again.
+        resumed: Progress reported by an earlier, interrupted attempt at
+            this post. Destinations it posted to successfully are not posted
+            to again, their results are reused, and its history_id keeps the
+            post from being recorded twice.
+
+    Returns:
+        A flat list of BuildPostResponse dicts, one per destination.
+    """
+    accounts = metadata.connected_accounts or []
+    is_video = _is_video(metadata)
+    deadline = resilience.Deadline(resilience.VIDEO_POST_DEADLINE if is_video else resilience.POST_DEADLINE)
+    state: Dict[str, Any] = {
+        'stage': 'downloading',
+        'platforms': [{'platform': account.platform, 'handle': account.handle,
+                       'instance': account.instance, 'status': 'pending'} for account in accounts],
+        'results': {},  # Results of the accounts posted to at least once, by index, for resuming
+        'history_id': (resumed or {}).get('history_id') or str(uuid.uuid4()),
+    }
+    if resumed:
+        # The payload is unchanged between attempts, so accounts and their destinations keep their index
+        state['results'] = dict(resumed.get('results', {}))
+        for index in state['results']:
+            state['platforms'][int(index)] = resumed['platforms'][int(index)]
+    finished = {int(index) for index, results in state['results'].items()
+                if all(result.get('status') == 'success' for result in results)}
+    if resumed:
+        logger.info(f"Resuming post after {len(finished)} of {len(accounts)} accounts were posted to")
+    adapters = [None if index in finished else adapter for index, adapter in enumerate(_adapters(metadata))]
+
+    async def report(stage: Optional[str] = None) -> None:
+        if stage:
+            state['stage'] = stage
+        if progress is not None:
+            await progress(state)
+
+    await report()
+    media_files = []
+    video = None
+    videos = {}
+    if prefetched is not None:
+        media_files, video, videos = prefetched.files, prefetched.video, prefetched.videos or {}
+    elif not any(adapters):
+        pass  # Every account was posted to by an earlier attempt, or none is supported
+    elif is_video:
+        with metrics.timer(metrics.POST_PHASE_SECONDS, phase='download'):
+            video = await database.load_video(metadata.video_filename, metadata.user_id, remove=False)
+    elif metadata.media_filenames:
+        with metrics.timer(metrics.POST_PHASE_SECONDS, phase='download'):
+            media_files = await database.load_images(metadata.media_filenames, metadata.user_id, remove=False)
+
+    posted = {index: state['results'][str(index)] for index in finished}
+    for index, (account, adapter) in enumerate(zip(accounts, adapters)):
+        if adapter is None and index not in posted:
+            logger.warning(f"Skipping account on unsupported platform '{account.platform}'")
+
+    video_missing = is_video and video is None and any(adapters)
+    if video_missing:
+        # Posting the text alone would report success for a post that lost its video
+        message = f"Failed to download video {metadata.video_filename}"
+        for index, adapter in enumerate(adapters):
+            if adapter is not None:
+                state['platforms'][index].update(status='error', message=message)
+                posted[index] = [models.BuildPostResponse(accounts[index], 'error', message)]
+        adapters = [None] * len(adapters)
+
+    if any(adapters):
+        # Compress each image, or fit the video, once per distinct platform capability before fanning out
+        media = {}
+        if video is not None:
+            await report('transcoding')
+            video_profiles = {adapter.capabilities.video_profile for adapter in adapters
+                              if adapter and adapter.capabilities.video_profile}
+            missing = video_profiles - videos.keys()
+            if missing:
+                with metrics.timer(metrics.POST_PHASE_SECONDS, phase='transcode'):
+                    videos = {**videos, **await video_handler.prepare_video(video, missing)}
+        elif media_files:
+            await report('compressing')
+            profiles = {adapter.capabilities.media_profile for adapter in adapters
+                        if adapter and adapter.capabilities.media_profile}
+            if profiles:
+                with metrics.timer(metrics.POST_PHASE_SECONDS, phase='compress'):
+                    media = await image_handler.prepare_media(media_files, profiles)
+
+        async def tracked(index: int, adapter: base.PlatformAdapter, account: models.ConnectedAccount) -> List:
+            with log_context(platform=account.platform):
+                results = await adapter.run(metadata, account, media.get(adapter.capabilities.media_profile, []),
+                                            deadline, videos.get(adapter.capabilities.video_profile),
+                                            previous=state['results'].get(str(index)))
+            statuses = {r.get('status') for r in results}
+            status = statuses.pop() if len(statuses) == 1 else 'partial' if statuses else 'error'
+            state['platforms'][index].update(status=status, message='; '.join(r.get('message') or '' for r in results))
+            if any(r.get('status') == 'success' for r in results):
+                # Partial results too, so a retry skips the destinations that were posted to
+                state['results'][str(index)] = results
+            await report()
+            return results
+
+        await report('publishing')
+        pending = [index for index, adapter in enumerate(adapters) if adapter is not None]
+        with metrics.timer(metrics.POST_PHASE_SECONDS, phase='publish'):
+            posted.update(zip(pending, await asyncio.gather(*(tracked(index, adapters[index], accounts[index])
+                                                              for index in pending))))
+
+    # One flat list of results in account order, whatever number of destinations each platform posted to
+    response = [result for index in sorted(posted) for result in posted[index]]
+
+    if media_files:
+        database.delete_images(media_files)
+    if video is not None:
+        video_handler.delete_files([video, *videos.values()])
+
+    await report('recording')
+    with metrics.timer(metrics.POST_PHASE_SECONDS, phase='history'):
+        await history.record(metadata, response, state['history_id'])
+
+    # Only now is the post out for good, so a retry never finds its media gone
+    if not is_video:
+        await database.remove_media('images', metadata.user_id, metadata.media_filenames or [])
+    elif not video_missing:
+        await database.remove_media('videos', metadata.user_id, [metadata.video_filename])
+
+    await report('done')
+    return response
+# End of publish_post
+
+
+async def run_publish_job(payload: Dict[str, Any], progress: ProgressCallback, resumed: Dict[str, Any]) -> List:
+    """Job handler for posts submitted with background=true."""
+    return await publish_post(models.Post.model_validate(payload), progress, resumed=resumed)
+# End of run_publish_job
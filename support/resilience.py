@@ -0,0 +1,222 @@
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from support import metrics
+from support.logger_config import logger
+
+T = TypeVar("T")
+
+POST_DEADLINE = float(os.getenv("POST_DEADLINE", "60"))  # Seconds a whole post may take
+VIDEO_POST_DEADLINE = float(os.getenv("VIDEO_POST_DEADLINE", "900"))  # Transcoding and processing included
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+
+
+# --- Errors ---
+class DeadlineExceeded(TimeoutError):
+    """The post-level deadline ran out before the call could finish."""
+
+
+# End of DeadlineExceeded
+
+class CircuitOpenError(Exception):
+    """The host has failed too often recently, so calls fail fast instead."""
+
+    def __init__(self, host: str):
+        super().__init__(f"{host} is unavailable")
+        self.host = host
+
+
+# End of CircuitOpenError
+
+# --- Deadline ---
+class Deadline:
+    """An absolute point in time that every call made for a post must finish by."""
+
+    def __init__(self, seconds: float = POST_DEADLINE):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, timeout: float) -> float:
+        """The smaller of a per-call timeout and the time left, raising if none is left."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Post deadline exceeded")
+        return min(timeout, remaining)
+
+
+# End of Deadline
+
+# --- Retries ---
+class RetryBudget:
+    """
+    Caps retries to a fraction of calls, so a struggling platform is not hit
+    with a retry storm. Every call earns ``ratio`` of a token and every retry
+    spends a whole one.
+    """
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def record_call(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# End of RetryBudget
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, limited by attempts and a shared RetryBudget."""
+
+    def __init__(self, retries: int = 2, base_delay: float = 0.5, max_delay: float = 8.0,
+                 budget: Optional[RetryBudget] = None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# End of RetryPolicy
+
+NO_RETRY = RetryPolicy(retries=0)
+
+
+# --- Circuit Breaker ---
+class CircuitBreaker:
+    """
+    Per-host breaker. After ``failures`` transient failures in a row it opens
+    and rejects calls for ``reset_after`` seconds, then lets a single trial
+    call through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, host: str, failures: int = BREAKER_FAILURES, reset_after: float = BREAKER_RESET):
+        self.host = host
+        self.failure_threshold = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        """Give up a trial that ended without an answer, e.g. cancelled, so another can run."""
+        self.trial_running = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit opened for {self.host} after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+# End of CircuitBreaker
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(host: str) -> CircuitBreaker:
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+# End of breaker_for
+
+
+# --- Calls ---
+async def call(func: Callable[..., Awaitable[T]], *args, deadline: Deadline, timeout: float,
+               policy: RetryPolicy = NO_RETRY, breaker: Optional[CircuitBreaker] = None,
+               is_transient: Callable[[BaseException], bool] = lambda error: False, target: str = 'other',
+               retry_timeouts: bool = True, **kwargs) -> T:
+    """
+    Await ``func(*args, **kwargs)`` within a timeout, retrying transient failures.
+
+    Each attempt gets the smaller of ``timeout`` and what is left of the
+    deadline. Timeouts and errors that ``is_transient`` accepts count against
+    the host's breaker and are retried with backoff while the policy, the
+    retry budget and the deadline all allow it. Anything else is raised as is.
+    Retries are counted per ``target``, e.g. the platform. With
+    ``retry_timeouts=False`` a timed-out attempt is not retried, for calls
+    that keep running once abandoned, such as blocking calls on a thread.
+    """
+    attempt = 0
+    while True:
+        trial = breaker is not None and breaker.state == 'half-open'
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(breaker.host)
+
+        policy.budget.record_call()
+        attempt_timeout = deadline.budget(timeout)
+        try:
+            async with asyncio.timeout(attempt_timeout):
+                result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # A cancelled trial says nothing about the host, but must not hold the breaker half-open for good
+            if trial:
+                breaker.release_trial()
+            raise
+        except Exception as error:
+            transient = isinstance(error, TimeoutError) or is_transient(error)
+            if breaker is not None and transient:
+                breaker.record_failure()
+            elif breaker is not None:
+                breaker.record_success()  # The host answered, the request itself was bad
+            if isinstance(error, TimeoutError) and deadline.expired:
+                raise DeadlineExceeded("Post deadline exceeded") from error
+            if not transient or attempt >= policy.retries or (isinstance(error, TimeoutError) and not retry_timeouts):
+                raise
+
+            delay = policy.backoff(attempt)
+            if delay >= deadline.remaining() or not policy.budget.try_spend():
+                raise
+            attempt += 1
+            metrics.RETRIES.labels(target).inc()
+            logger.warning(f"Retrying in {delay:.2f}s after attempt {attempt} failed: {type(error).__name__}: {error}")
+            await asyncio.sleep(delay)
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
+# End of call
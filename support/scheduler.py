@@ -0,0 +1,362 @@
+import asyncio
+import copy
+import math
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+from support import database, models, publisher
+from support.logger_config import log_context, logger
+
+# Timer wheel: one slot per tick, so one revolution covers SCHEDULER_HORIZON by default
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "1"))
+SCHEDULER_WHEEL_SLOTS = int(os.getenv("SCHEDULER_WHEEL_SLOTS", "3600"))
+
+# Only posts due within the horizon are held in memory; the rest are loaded as it moves on
+SCHEDULER_HORIZON = float(os.getenv("SCHEDULER_HORIZON", "3600"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))  # Scheduled posts publishing at once
+
+# Media is fetched at a point spread over the window before each post, not all at once
+SCHEDULER_PREFETCH_WINDOW = float(os.getenv("SCHEDULER_PREFETCH_WINDOW", "300"))
+SCHEDULER_PREFETCH_LEAD = 60.0  # Prefetching always starts at least this long before the post
+SCHEDULER_PREFETCH_CONCURRENCY = int(os.getenv("SCHEDULER_PREFETCH_CONCURRENCY", "2"))
+
+# A post left publishing this long was abandoned by a stopped machine; longer than any post deadline
+SCHEDULER_STALE_AFTER = float(os.getenv("SCHEDULER_STALE_AFTER", "1800"))
+SCHEDULER_SHUTDOWN_GRACE = float(os.getenv("SCHEDULER_SHUTDOWN_GRACE", "60"))  # Seconds posts in flight get to finish
+SCHEDULER_RETRY_DELAY = 30.0  # Seconds before retrying a claim that failed to reach the database
+
+
+# --- Timer Wheel ---
+class TimerWheel:
+    """
+    A hashed timing wheel of keyed timers on the wall clock.
+
+    Adding and cancelling a timer is O(1), and each tick only visits the one
+    slot whose time has come. Timers more than one revolution away carry a
+    round count, which each pass of their slot counts down. Ticks missed while
+    the loop was blocked or the machine was paused are caught up, so a timer
+    fires late rather than never.
+    """
+
+    def __init__(self, callback: Callable[[Hashable], None], tick: float = SCHEDULER_TICK,
+                 slots: int = SCHEDULER_WHEEL_SLOTS):
+        self.callback = callback
+        self.tick = tick
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(max(1, slots))]
+        self._where: Dict[Hashable, int] = {}
+        self._cursor = 0
+        self._next = time.time() + tick  # When the slot under the cursor fires
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """Fire callback(key) at the first tick at or after when, replacing any timer with that key."""
+        self.cancel(key)
+        ticks = max(0, math.ceil((when - self._next) / self.tick))
+        rounds, offset = divmod(ticks, len(self._slots))
+        slot = (self._cursor + offset) % len(self._slots)
+        self._slots[slot][key] = rounds
+        self._where[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _advance(self) -> List[Hashable]:
+        """Move the cursor one slot on and return the keys that are due."""
+        slot = self._slots[self._cursor]
+        due = [key for key, rounds in slot.items() if rounds == 0]
+        for key in due:
+            del slot[key]
+            del self._where[key]
+        for key in slot:
+            slot[key] -= 1
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        self._next += self.tick
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(max(0.0, self._next - time.time()))
+            while self._next <= time.time():
+                for key in self._advance():
+                    try:
+                        self.callback(key)
+                    except Exception as error:
+                        logger.error(f"Timer {key} failed: {error}")
+
+
+# End of TimerWheel
+
+# --- Scheduler ---
+def _timestamp(value) -> float:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+# End of _timestamp
+
+
+def _outcome(results: List[dict]) -> str:
+    statuses = [result.get('status') for result in results]
+    if statuses and all(status == 'success' for status in statuses):
+        return 'published'
+    return 'partial' if 'success' in statuses else 'failed'
+# End of _outcome
+
+
+class PostScheduler:
+    """
+    Publishes scheduled posts at their time, from the scheduled_posts table.
+
+    Posts due within SCHEDULER_HORIZON are loaded into a TimerWheel, with a
+    publish timer and, for posts with media, a prefetch timer spread over the
+    SCHEDULER_PREFETCH_WINDOW before it. The horizon is reloaded every half
+    horizon, so the database sees one indexed range query per interval
+    rather than a poll per post. A post is claimed in the database before it
+    is published, so several machines can share the table, and at most
+    SCHEDULER_CONCURRENCY scheduled posts publish at once.
+
+    Each account a post goes out to is saved on its row. A post abandoned by
+    a stopped machine is rescheduled after SCHEDULER_STALE_AFTER and resumed
+    from there, so no account gets it twice.
+    """
+
+    def __init__(self):
+        self.wheel = TimerWheel(self._fire)
+        self._posts: Dict[str, models.Post] = {}
+        self._prefetched: Dict[str, publisher.PostMedia] = {}
+        self._publish_slots = asyncio.Semaphore(max(1, SCHEDULER_CONCURRENCY))
+        self._prefetch_slots = asyncio.Semaphore(max(1, SCHEDULER_PREFETCH_CONCURRENCY))
+        self._tasks: Set[asyncio.Task] = set()
+        self._publishing: Set[asyncio.Task] = set()
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self._requeue_stale()
+        self.wheel.start()
+        self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self, grace: float = SCHEDULER_SHUTDOWN_GRACE) -> None:
+        """
+        Stop the timers and give posts in flight up to grace seconds to finish.
+
+        Posts still publishing after that are cancelled, then rescheduled after
+        SCHEDULER_STALE_AFTER and resumed from the accounts they reached.
+        """
+        if self._refresher is not None:
+            self._refresher.cancel()
+        await self.wheel.stop()
+        if self._publishing:
+            _, pending = await asyncio.wait(self._publishing, timeout=grace)
+            if pending:
+                logger.warning(f"Cancelling {len(pending)} scheduled posts still publishing after {grace:.0f}s")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *filter(None, [self._refresher]), return_exceptions=True)
+        self._refresher = None
+        for media in self._prefetched.values():
+            publisher.discard_media(media)
+        self._prefetched.clear()
+        self._posts.clear()
+
+    async def schedule(self, metadata: models.Post) -> dict:
+        """Store a post for later and start its timers if it is due within the horizon."""
+        publish_at = metadata.publish_at
+        if publish_at.tzinfo is None:
+            publish_at = publish_at.replace(tzinfo=timezone.utc)
+        row = await database.create_scheduled_post(metadata.user_id, publish_at,
+                                                   metadata.model_dump(mode='json'))
+        if publish_at.timestamp() < time.time() + SCHEDULER_HORIZON:
+            self._track(row['id'], publish_at.timestamp(), metadata)
+        return row
+
+    async def cancel(self, post_id: str) -> bool:
+        """Cancel a post that has not started publishing."""
+        if not await database.cancel_scheduled_post(post_id):
+            return False
+        self._untrack(post_id)
+        return True
+
+    def stats(self) -> dict:
+        return {'timers': len(self.wheel), 'posts': len(self._posts), 'prefetched': len(self._prefetched),
+                'in_flight': len(self._tasks)}
+
+    # Timers
+    def _track(self, post_id: str, publish_at: float, metadata: models.Post) -> None:
+        self._posts[post_id] = metadata
+        self.wheel.schedule((post_id, 'publish'), publish_at)
+        if metadata.media_filenames or metadata.video_filename:
+            # A stable point in the window, so a burst of posts in one slot is fetched over several minutes
+            spread = SCHEDULER_PREFETCH_WINDOW - SCHEDULER_PREFETCH_LEAD
+            offset = zlib.crc32(post_id.encode()) % max(1, int(spread))
+            prefetch_at = publish_at - SCHEDULER_PREFETCH_WINDOW + offset
+            if prefetch_at > time.time():
+                self.wheel.schedule((post_id, 'prefetch'), prefetch_at)
+
+    def _untrack(self, post_id: str) -> None:
+        self.wheel.cancel((post_id, 'publish'))
+        self.wheel.cancel((post_id, 'prefetch'))
+        self._posts.pop(post_id, None)
+        media = self._prefetched.pop(post_id, None)
+        if media is not None:
+            publisher.discard_media(media)
+
+    def _fire(self, key) -> None:
+        post_id, action = key
+        work = self._prefetch(post_id) if action == 'prefetch' else self._publish(post_id)
+        task = asyncio.create_task(work)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if action == 'publish':
+            self._publishing.add(task)
+            task.add_done_callback(self._publishing.discard)
+
+    async def _requeue_stale(self) -> None:
+        stale_before = datetime.now(timezone.utc) - timedelta(seconds=SCHEDULER_STALE_AFTER)
+        requeued = await database.requeue_stale_scheduled_posts(stale_before)
+        if requeued:
+            logger.warning(f"Rescheduled {requeued} posts left publishing by a stopped machine")
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                # Also on every refresh, as a machine woken mid-post may have started before the post went stale
+                await self._requeue_stale()
+                await self._refresh()
+            except Exception as error:
+                logger.error(f"Failed to load scheduled posts: {error}")
+            await asyncio.sleep(SCHEDULER_HORIZON / 2)
+
+    async def _refresh(self) -> None:
+        """Track every pending post due within the horizon, overdue ones included."""
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=SCHEDULER_HORIZON)
+        rows = await database.get_upcoming_scheduled_posts(horizon)
+        added = 0
+        for row in rows:
+            if row['id'] in self._posts:
+                continue
+            try:
+                metadata = models.Post.model_validate(row['payload'])
+            except ValueError as error:
+                logger.error(f"Skipping scheduled post {row['id']} with an invalid payload: {error}")
+                continue
+            self._track(row['id'], _timestamp(row['publish_at']), metadata)
+            added += 1
+        if added:
+            logger.info(f"Loaded {added} scheduled posts due before {horizon.isoformat()}")
+
+    # Work
+    async def _prefetch(self, post_id: str) -> None:
+        metadata = self._posts.get(post_id)
+        if metadata is None:
+            return
+        try:
+            async with self._prefetch_slots:
+                with log_context(post_id=post_id):
+                    media = await publisher.prefetch_media(metadata)
+        except Exception as error:
+            # Publishing downloads the media itself when the prefetch failed
+            logger.error(f"Failed to prefetch media of scheduled post {post_id}: {error}")
+            return
+        if media is None:
+            return
+        if post_id in self._posts:
+            self._prefetched[post_id] = media
+        else:
+            publisher.discard_media(media)  # Cancelled while it was fetching
+
+    async def _publish(self, post_id: str) -> None:
+        async with self._publish_slots:
+            try:
+                row = await database.claim_scheduled_post(post_id)
+            except Exception as error:
+                # The post is still 'scheduled' in the table, so try again shortly
+                logger.error(f"Failed to claim scheduled post {post_id}, retrying: {error}")
+                if post_id in self._posts:
+                    self.wheel.schedule((post_id, 'publish'), time.time() + SCHEDULER_RETRY_DELAY)
+                return
+
+            self.wheel.cancel((post_id, 'prefetch'))
+            self._posts.pop(post_id, None)
+            media = self._prefetched.pop(post_id, None)
+            if row is None:
+                # Cancelled, or already claimed by another machine
+                if media is not None:
+                    publisher.discard_media(media)
+                return
+
+            saved = copy.deepcopy(row.get('progress') or {})
+
+            async def progress(state: dict) -> None:
+                # Only newly reached accounts are worth a write, or a history id not stored yet once
+                # history is about to be written; stages are not shown for scheduled posts
+                nonlocal saved
+                if state['results'] != saved.get('results', {}) or (
+                        state['stage'] == 'recording' and state.get('history_id') != saved.get('history_id')):
+                    saved = copy.deepcopy(state)
+                    await database.save_scheduled_progress(post_id, state)
+
+            with log_context(post_id=post_id):
+                lateness = time.time() - _timestamp(row['publish_at'])
+                logger.info(f"Publishing scheduled post {post_id} ({lateness:.1f}s after its time)")
+                try:
+                    results = await publisher.publish_post(models.Post.model_validate(row['payload']),
+                                                           progress, prefetched=media, resumed=row.get('progress'))
+                    await database.finish_scheduled_post(post_id, _outcome(results), results)
+                except Exception as error:
+                    logger.error(f"Scheduled post {post_id} failed: {error}")
+                    await database.finish_scheduled_post(post_id, 'failed', {'error': str(error)})
+
+
+# End of PostScheduler
+
+_scheduler: Optional[PostScheduler] = None
+
+
+# --- Lifecycle ---
+async def start_scheduler() -> PostScheduler:
+    """Create the shared scheduler, reschedule abandoned posts and start the timers."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = PostScheduler()
+        await _scheduler.start()
+    return _scheduler
+# End of start_scheduler
+
+
+async def stop_scheduler() -> None:
+    global _scheduler
+    if _scheduler is None:
+        return
+    scheduler, _scheduler = _scheduler, None
+    await scheduler.stop()
+# End of stop_scheduler
+
+
+def get_scheduler() -> PostScheduler:
+    if _scheduler is None:
+        raise RuntimeError("The post scheduler is not running")
+    return _scheduler
+# End of get_scheduler
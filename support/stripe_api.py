@@ -1,17 +1,35 @@
+import asyncio
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Set
 
 import stripe
 from fastapi import Request, Header, HTTPException, APIRouter
 
 from support import database, models
+from support.cache import KeyedLock
+from support.jobs import JobQueue, ProgressCallback
 from support.logger_config import logger
 
 stripe_router = APIRouter()
 
 stripe.api_key = os.getenv("STRIPE_API_KEY")
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
 stripe_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 FRONTEND_BASE_URL = os.getenv("FRONTEND_BASE_URL", "http://localhost:9000")
+STRIPE_SWEEP_INTERVAL = float(os.getenv("STRIPE_SWEEP_INTERVAL", "60"))  # Seconds between checks for stranded events
+STRIPE_SWEEP_AFTER = 30.0  # Seconds an event may stay pending before its job is assumed lost
+
+SUBSCRIPTION_EVENTS = {
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+}
+
+# Subscriptions with a job queued that has not started; a burst of events shares the job
+_queued: Set[str] = set()
+_subscription_locks = KeyedLock()
+_sweeper: Optional[asyncio.Task] = None
 
 
 # -- API Endpoints for Stripe Integration --
@@ -24,7 +42,7 @@ async def create_checkout_session(request: Request):
         raise HTTPException(status_code=404, detail="Missing required parameters")
 
     try:
-        customer_id = database.create_or_fetch_customer(user_id)
+        customer_id = await database.create_or_fetch_customer(user_id)
 
         session = stripe.checkout.Session.create(
             customer=customer_id,
@@ -56,6 +74,13 @@ async def create_customer_portal_session(request: models.PortalSessionRequest):
 
 @stripe_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
+    """
+    Verify a Stripe event, store it as pending and queue a job to apply it.
+
+    The response goes back once the event is stored in stripe_events, so it
+    survives the machine. The subscription and account limits are updated
+    by run_subscription_job, or by the sweeper if that job is lost.
+    """
     payload = await request.body()
 
     try:
@@ -64,37 +89,161 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         logger.error("Invalid Stripe webhook payload or signature")
         raise HTTPException(status_code=400, detail="Invalid payload or signature")
 
-    event_type = event.get("type")
-    sub = event["data"]["object"]
-    customer_id = sub.get("customer")
+    if event.get("type") not in SUBSCRIPTION_EVENTS:
+        return {"status": "ignored"}
 
-    # Load customer data
-    res = database.supabase.table("subscriptions").select().eq("stripe_customer_id", customer_id).execute()
-    if not res.data:
-        logger.warning(f"No subscription found for customer_id: {customer_id}")
+    try:
+        update = subscription_update(event)
+    except (KeyError, IndexError, TypeError) as error:
+        logger.error(f"Malformed Stripe event {event.get('id')}: {error}")
+        raise HTTPException(status_code=400, detail="Malformed subscription event")
+
+    # A 404 makes Stripe retry, e.g. when the event beats the row created at checkout
+    if await database.get_subscription_by_customer(update["customer_id"]) is None:
+        logger.warning(f"No subscription found for customer_id: {update['customer_id']}")
         raise HTTPException(status_code=404, detail="No subscription found")
 
-    row_id = res.data[0]["id"]
-    user_id = res.data[0].get("user_id")
+    if not await database.record_stripe_event(event["id"], event["type"], update):
+        logger.info(f"Skipping duplicate Stripe event {event['id']}")
+        return {"status": "duplicate"}
 
-    # Handle the event
-    if event_type in ["customer.subscription.created", "customer.subscription.updated"]:
-        status = sub["status"]
-        price_id = sub["items"]["data"][0]["price"]["id"]
-        ends_at = sub["items"]["data"][0]["current_period_end"]
-        ends_at_datetime = datetime.utcfromtimestamp(ends_at)
-        plan = sub["plan"]["metadata"]["tier"]
+    try:
+        await queue_subscription(request.app.state.job_queue, update["subscription_id"])
+    except Exception as error:
+        # The event is stored as pending, so the sweeper still applies it
+        logger.error(f"Error queueing Stripe event {event['id']}: {error}")
+    return {"status": "queued"}
+# End of stripe_webhook
 
-        if event_type == "customer.subscription.updated" and status == "canceled":
-            return {"status": "canceled plan"}
 
-        database.update_subscription(row_id, plan, status, price_id, ends_at_datetime)
-        if event_type == "customer.subscription.updated":
-            database.update_user_limits(user_id, plan)
+# -- Subscription Worker --
+def subscription_update(event) -> Dict[str, Any]:
+    """Reduce a customer.subscription.* event to the state the worker applies."""
+    sub = event["data"]["object"]
+    update = {
+        "event_id": event["id"],
+        "type": event["type"],
+        "created": event["created"],
+        "customer_id": sub["customer"],
+        "subscription_id": sub["id"],
+    }
+    if event["type"] != "customer.subscription.deleted":
+        item = sub["items"]["data"][0]
+        update.update(
+            status=sub["status"],
+            price_id=item["price"]["id"],
+            ends_at=item["current_period_end"],
+            plan=sub["plan"]["metadata"]["tier"],
+        )
+    return update
+# End of subscription_update
 
-    elif event_type == "customer.subscription.deleted":
-        database.update_subscription(row_id, 'free', 'cancelled', 0, None)
-        database.update_user_limits(user_id)
 
-    return {"status": "success"}
-# End of stripe_webhook
+async def queue_subscription(job_queue: JobQueue, subscription_id: str) -> None:
+    """Queue a job for a subscription's pending events, unless one is already waiting."""
+    if subscription_id in _queued:
+        return
+    _queued.add(subscription_id)
+    try:
+        await job_queue.submit('stripe_subscription', {"subscription_id": subscription_id})
+    except Exception:
+        _queued.discard(subscription_id)
+        raise
+# End of queue_subscription
+
+
+async def run_subscription_job(payload: Dict[str, Any], progress: ProgressCallback,
+                               resumed: Dict[str, Any]) -> dict:
+    """
+    Job handler that applies the newest pending state of a subscription.
+
+    Every event that arrived before the job started is read from
+    stripe_events, but only the newest state is written; the rest are
+    marked done along with it. Stale states, e.g. from a job that raced a
+    newer one on another machine, are refused by update_subscription's
+    ordering check. If applying fails, the events stay pending for the sweeper.
+    """
+    key = payload["subscription_id"]
+    # Started: later events need a job of their own
+    _queued.discard(key)
+    async with _subscription_locks(key):
+        events = await database.get_pending_stripe_events(key)
+        if not events:
+            return {"status": "nothing pending"}
+        result = await apply_subscription_update(events[-1]["payload"])
+        await database.finish_stripe_events([event["id"] for event in events], result["status"])
+        return {**result, "events": len(events)}
+# End of run_subscription_job
+
+
+async def apply_subscription_update(update: Dict[str, Any]) -> dict:
+    subscription = await database.get_subscription_by_customer(update["customer_id"])
+    if not subscription:
+        logger.warning(f"No subscription found for customer_id: {update['customer_id']}")
+        return {"status": "no subscription", "event_id": update["event_id"]}
+
+    row_id = subscription["id"]
+    user_id = subscription.get("user_id")
+    event_type = update["type"]
+
+    if event_type == "customer.subscription.deleted":
+        if not await database.update_subscription(row_id, 'free', 'cancelled', 0, None, update["created"]):
+            return {"status": "stale", "event_id": update["event_id"]}
+        await database.update_user_limits(user_id)
+        return {"status": "success", "event_id": update["event_id"]}
+
+    if event_type == "customer.subscription.updated" and update["status"] == "canceled":
+        return {"status": "canceled plan", "event_id": update["event_id"]}
+
+    ends_at_datetime = datetime.utcfromtimestamp(update["ends_at"])
+    if not await database.update_subscription(row_id, update["plan"], update["status"], update["price_id"],
+                                              ends_at_datetime, update["created"]):
+        return {"status": "stale", "event_id": update["event_id"]}
+    if event_type == "customer.subscription.updated":
+        await database.update_user_limits(user_id, update["plan"])
+
+    return {"status": "success", "event_id": update["event_id"]}
+# End of apply_subscription_update
+
+
+# -- Sweeper --
+async def sweep_pending_events(job_queue: JobQueue, received_before: datetime) -> int:
+    """Queue a job for every subscription with events pending since before the given time."""
+    subscriptions = await database.get_pending_stripe_subscriptions(received_before)
+    for subscription_id in subscriptions:
+        await queue_subscription(job_queue, subscription_id)
+    return len(subscriptions)
+# End of sweep_pending_events
+
+
+async def _sweep_loop(job_queue: JobQueue) -> None:
+    # Events pending at startup lost their jobs with the previous machine
+    received_before = datetime.now(timezone.utc)
+    while True:
+        try:
+            queued = await sweep_pending_events(job_queue, received_before)
+            if queued:
+                logger.warning(f"Queued {queued} subscriptions with Stripe events left pending")
+        except Exception as error:
+            logger.error(f"Failed to sweep pending Stripe events: {error}")
+        await asyncio.sleep(STRIPE_SWEEP_INTERVAL)
+        received_before = datetime.now(timezone.utc) - timedelta(seconds=STRIPE_SWEEP_AFTER)
+# End of _sweep_loop
+
+
+def start_sweeper(job_queue: JobQueue) -> None:
+    """Apply events left pending by a previous machine, then keep checking for stranded ones."""
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep_loop(job_queue))
+# End of start_sweeper
+
+
+async def stop_sweeper() -> None:
+    global _sweeper
+    if _sweeper is None:
+        return
+    sweeper, _sweeper = _sweeper, None
+    sweeper.cancel()
+    await asyncio.gather(sweeper, return_exceptions=True)
+# End of stop_sweeper
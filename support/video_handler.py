@@ -0,0 +1,236 @@
+import asyncio
+import mimetypes
+import os
+import tempfile
+import uuid
+from typing import AsyncIterator, Dict, FrozenSet, Iterable, NamedTuple, Optional, Tuple, Union
+
+import aiofiles
+import httpx
+
+from support.logger_config import logger
+
+VIDEO_FORMATS = frozenset({"video/mp4", "video/webm", "video/quicktime"})
+VIDEO_CHUNK_SIZE = int(os.getenv("VIDEO_CHUNK_KB", "256")) * 1024
+VIDEO_UPLOAD_TIMEOUT = float(os.getenv("VIDEO_UPLOAD_TIMEOUT", "300"))
+VIDEO_POLL_INTERVAL = float(os.getenv("VIDEO_POLL_INTERVAL", "2"))
+TEMP_VIDEO_DIR = "../temp_videos"
+
+# ffmpeg is memory hungry, so the 1 GB VM transcodes one video at a time by default
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", "ffprobe")
+VIDEO_TRANSCODE_WORKERS = int(os.getenv("VIDEO_TRANSCODE_WORKERS", "1"))
+VIDEO_TRANSCODE_TIMEOUT = float(os.getenv("VIDEO_TRANSCODE_TIMEOUT", "300"))
+VIDEO_MAX_HEIGHT = int(os.getenv("VIDEO_MAX_HEIGHT", "720"))
+VIDEO_AUDIO_KBPS = 128
+MIN_VIDEO_KBPS = 150  # Below this a transcode is not worth watching
+SIZE_HEADROOM = 0.92  # Share of the size limit the bitrate targets, for container overhead
+
+_http: Optional[httpx.AsyncClient] = None
+_transcode_slots: Optional[asyncio.Semaphore] = None
+
+
+# --- Video Files ---
+class VideoProfile(NamedTuple):
+    """Video limits a platform places on a single post."""
+    max_size_kb: int
+    formats: FrozenSet[str] = VIDEO_FORMATS
+
+
+# End of VideoProfile
+
+class VideoFile(NamedTuple):
+    """A video spooled to local disk, so it never has to fit in memory."""
+    name: str
+    path: str
+    mime_type: str
+    size: int
+
+
+# End of VideoFile
+
+class PreparedVideo(NamedTuple):
+    """A video that fits a VideoProfile, or the reason it could not be made to."""
+    name: str
+    path: Optional[str]
+    mime_type: Optional[str]
+    size: int = 0
+    error: Optional[Exception] = None
+    transcoded: bool = False
+
+
+# End of PreparedVideo
+
+def guess_mime_type(name: str) -> str:
+    mime_type, _ = mimetypes.guess_type(name)
+    return mime_type if mime_type in VIDEO_FORMATS else "video/mp4"
+# End of guess_mime_type
+
+
+def temp_path(name: str) -> str:
+    os.makedirs(TEMP_VIDEO_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=TEMP_VIDEO_DIR, suffix=f"-{os.path.basename(name)}")
+    os.close(fd)
+    return path
+# End of temp_path
+
+
+async def read_chunks(path: str, chunk_size: int = VIDEO_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Yield a file's bytes chunk by chunk, for streaming request bodies."""
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+# End of read_chunks
+
+
+def multipart_body(video: Union[VideoFile, PreparedVideo], field: str,
+                   fields: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], AsyncIterator[bytes]]:
+    """
+    Build a multipart/form-data upload of a video that streams the file with read_chunks.
+
+    httpx reads multipart files through sync file objects, on the event
+    loop, so video uploads build their form themselves.
+
+    Returns:
+        The Content-Type and Content-Length headers, and the body stream.
+    """
+    boundary = uuid.uuid4().hex
+    file_name = os.path.basename(video.name).replace('"', '%22')
+    head = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                    for name, value in (fields or {}).items())
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{file_name}"\r\n'
+             f'Content-Type: {video.mime_type}\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    async def body() -> AsyncIterator[bytes]:
+        yield head
+        async for chunk in read_chunks(video.path):
+            yield chunk
+        yield tail
+
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}',
+               'Content-Length': str(len(head) + video.size + len(tail))}
+    return headers, body()
+# End of multipart_body
+
+
+def delete_files(videos: Iterable) -> None:
+    """Remove the local copies of downloaded and transcoded videos."""
+    for path in {video.path for video in videos if video is not None and video.path}:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            logger.error(f"Warning: Could not delete {path}: {error}")
+# End of delete_files
+
+
+# --- Shared HTTP Client ---
+def get_http_client() -> httpx.AsyncClient:
+    """The client used to stream videos from storage and to platforms without an SDK upload path."""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(timeout=httpx.Timeout(VIDEO_UPLOAD_TIMEOUT, connect=10),
+                                  follow_redirects=True)
+    return _http
+# End of get_http_client
+
+
+async def close() -> None:
+    global _http
+    if _http is not None:
+        client, _http = _http, None
+        await client.aclose()
+# End of close
+
+
+# --- Transcoding ---
+async def _run(*args: str, timeout: float) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(args[0])} exited with {process.returncode}: "
+                           f"{stderr.decode(errors='replace')[-300:]}")
+    return stdout
+# End of _run
+
+
+async def probe_duration(path: str) -> float:
+    """Return a video's duration in seconds."""
+    output = await _run(FFPROBE_PATH, "-v", "error", "-show_entries", "format=duration",
+                        "-of", "default=noprint_wrappers=1:nokey=1", path, timeout=30)
+    return float(output.strip())
+# End of probe_duration
+
+
+async def transcode(video: VideoFile, max_size_kb: int) -> VideoFile:
+    """
+    Re-encode a video to H.264/AAC MP4 that fits in max_size_kb.
+
+    The video bitrate is derived from the duration so the output lands just
+    under the limit, and frames taller than VIDEO_MAX_HEIGHT are scaled down.
+    At most VIDEO_TRANSCODE_WORKERS ffmpeg processes run at once.
+    """
+    global _transcode_slots
+    if _transcode_slots is None:
+        _transcode_slots = asyncio.Semaphore(max(1, VIDEO_TRANSCODE_WORKERS))
+
+    duration = await probe_duration(video.path)
+    total_kbps = max_size_kb * 8 * 1.024 * SIZE_HEADROOM / max(duration, 1)
+    video_kbps = int(total_kbps - VIDEO_AUDIO_KBPS)
+    if video_kbps < MIN_VIDEO_KBPS:
+        raise ValueError(f"{video.name} is too long to fit in {max_size_kb} KB")
+
+    name = os.path.splitext(video.name)[0] + ".mp4"
+    output = temp_path(name)
+    try:
+        async with _transcode_slots:
+            await _run(FFMPEG_PATH, "-y", "-v", "error", "-i", video.path,
+                       "-vf", f"scale=-2:'min({VIDEO_MAX_HEIGHT},ih)'",
+                       "-c:v", "libx264", "-preset", "veryfast", "-threads", "2",
+                       "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+                       "-c:a", "aac", "-b:a", f"{VIDEO_AUDIO_KBPS}k",
+                       "-movflags", "+faststart", output,
+                       timeout=VIDEO_TRANSCODE_TIMEOUT)
+        size = os.path.getsize(output)
+        if size > max_size_kb * 1024:
+            raise ValueError(f"{video.name} is still {size // 1024} KB after transcoding")
+    except BaseException:
+        delete_files([VideoFile(name, output, "video/mp4", 0)])
+        raise
+
+    logger.info(f"Transcoded {video.name} from {video.size // 1024} KB to {size // 1024} KB at {video_kbps} kbps")
+    return VideoFile(name, output, "video/mp4", size)
+# End of transcode
+
+
+async def prepare_video(video: VideoFile, profiles: Iterable[VideoProfile]) -> Dict[VideoProfile, PreparedVideo]:
+    """
+    Make the video fit every distinct platform profile.
+
+    Profiles the original already satisfies share it as is; the rest get one
+    transcode each. A failed transcode is returned as a PreparedVideo with
+    the error set, so only the platforms that needed it fail.
+    """
+    async def prepare(profile: VideoProfile) -> PreparedVideo:
+        if video.size <= profile.max_size_kb * 1024 and video.mime_type in profile.formats:
+            return PreparedVideo(video.name, video.path, video.mime_type, video.size)
+        try:
+            result = await transcode(video, profile.max_size_kb)
+            return PreparedVideo(result.name, result.path, result.mime_type, result.size, transcoded=True)
+        except Exception as error:
+            logger.error(f"Failed to prepare video {video.name} for {profile.max_size_kb} KB: "
+                         f"{type(error).__name__}: {error}")
+            return PreparedVideo(video.name, None, None, error=error)
+
+    unique = list(dict.fromkeys(profiles))
+    results = await asyncio.gather(*(prepare(profile) for profile in unique))
+    return dict(zip(unique, results))
+# End of prepare_video
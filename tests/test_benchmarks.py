@@ -0,0 +1,41 @@
+import json
+
+import stripe
+
+from benchmarks import fakes, scenarios, stats
+from benchmarks.load import is_degraded
+from benchmarks.run import cache_delta
+
+
+def test_summary_uses_nearest_rank_percentiles():
+    summary = stats.summarize([i / 1000 for i in range(100, 0, -1)], scale=1000)
+    assert (summary['count'], summary['p50'], summary['p95'], summary['p99'], summary['max']) == (100, 50, 95, 99, 100)
+    assert stats.summarize([])['count'] == 0
+# End of test_summary_uses_nearest_rank_percentiles
+
+
+def test_fake_postgrest_filters():
+    row = {'id': 'evt_1', 'status': 'pending', 'received_at': '2026-10-18T10:00:00+00:00'}
+    assert fakes.row_matches(row, {'status': 'eq.pending', 'id': 'in.(evt_1,evt_2)'})
+    assert not fakes.row_matches(row, {'id': 'in.("evt_2")'})
+    assert not fakes.row_matches(row, {'status': 'neq.pending'})
+    assert fakes.row_matches(row, {'received_at': 'lt.2026-10-18T10:00:01+00:00'})
+    assert not fakes.row_matches(row, {'received_at': 'gt.2026-10-18T10:00:01+00:00'})
+# End of test_fake_postgrest_filters
+
+
+def test_webhook_scenario_passes_signature_verification():
+    payload = json.dumps({'id': 'evt_1', 'object': 'event', 'type': 'customer.subscription.updated'}).encode()
+    event = stripe.Webhook.construct_event(payload, scenarios.sign_webhook(payload), scenarios.WEBHOOK_SECRET)
+    assert event['id'] == 'evt_1'
+# End of test_webhook_scenario_passes_signature_verification
+
+
+def test_degraded_responses_and_cache_deltas():
+    assert is_degraded([{'status': 'success'}, {'status': 'error'}])
+    assert is_degraded({'status': 'error', 'message': 'Failed'})
+    assert not is_degraded([{'status': 'success'}])
+
+    delta = cache_delta({'media': {'hits': 5, 'misses': 5}}, {'media': {'hits': 8, 'misses': 6}})
+    assert delta['media'] == {'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+# End of test_degraded_responses_and_cache_deltas
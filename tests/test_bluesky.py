@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import warnings
+
+import httpx
+from atproto_client.exceptions import BadRequestError, NetworkError
+from atproto_client.models.common import XrpcError
+from atproto_client.request import AsyncRequest, Response
+
+from benchmarks import fakes
+from platforms import bluesky
+from platforms.base import PlatformError, PublishContext
+from support import models, video_handler
+
+
+def test_login_fetches_the_profile_send_post_needs(monkeypatch):
+    # The fake PDS answers in-process, through the client bluesky.get_client builds
+    transport = httpx.ASGITransport(fakes.bluesky_app(fakes.Faults()))
+    monkeypatch.setattr(bluesky, 'AsyncRequest', functools.partial(AsyncRequest, transport=transport))
+    monkeypatch.setattr(bluesky, 'BLUESKY_BASE_URL', 'http://bluesky.test/xrpc')
+    account = models.ConnectedAccount(platform='bluesky', handle='alice.bsky.social', app_password='secret')
+
+    async def main():
+        client = await bluesky.get_client(account)
+        try:
+            # send_post takes the repo DID from client.me, which only a login that fetches the profile sets
+            assert client.me is not None
+            assert client.me.did == 'did:plc:alice'
+        finally:
+            await bluesky.close()
+
+    asyncio.run(main())
+# End of test_login_fetches_the_profile_send_post_needs
+
+
+def test_only_session_errors_drop_the_cached_session(monkeypatch):
+    transport = httpx.ASGITransport(fakes.bluesky_app(fakes.Faults()))
+    monkeypatch.setattr(bluesky, 'AsyncRequest', functools.partial(AsyncRequest, transport=transport))
+    monkeypatch.setattr(bluesky, 'BLUESKY_BASE_URL', 'http://bluesky.test/xrpc')
+    account = models.ConnectedAccount(platform='bluesky', handle='alice.bsky.social', app_password='secret')
+    context = PublishContext(models.Post(message='hi'), account)
+    expired = BadRequestError(Response(success=False, status_code=400, headers={},
+                                       content=XrpcError(error='ExpiredToken', message='Token has expired')))
+
+    async def main():
+        try:
+            client = await bluesky.get_client(account)
+            # Timeouts, outages and media errors say nothing about the session
+            for error in [TimeoutError(), NetworkError(), PlatformError('Upload failed for a.png')]:
+                bluesky.adapter.on_failure(context, error)
+                assert await bluesky.get_client(account) is client
+
+            bluesky.adapter.on_failure(context, expired)
+            assert await bluesky.get_client(account) is not client
+        finally:
+            await bluesky.close()
+
+    asyncio.run(main())
+# End of test_only_session_errors_drop_the_cached_session
+
+
+def test_video_upload_streams_the_file_as_the_blob(monkeypatch, tmp_path):
+    transport = httpx.ASGITransport(fakes.bluesky_app(fakes.Faults()))
+    monkeypatch.setattr(bluesky, 'AsyncRequest', functools.partial(AsyncRequest, transport=transport))
+    monkeypatch.setattr(bluesky, 'BLUESKY_BASE_URL', 'http://bluesky.test/xrpc')
+    monkeypatch.setattr(video_handler, 'VIDEO_CHUNK_SIZE', 1024)
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'frames' * 1000)
+    account = models.ConnectedAccount(platform='bluesky', handle='alice.bsky.social', app_password='secret')
+    context = PublishContext(models.Post(message='hi'), account,
+                             video=video_handler.PreparedVideo('clip.mp4', str(path), 'video/mp4', 6000))
+
+    async def main():
+        try:
+            context.client = await bluesky.get_client(account)
+            return await bluesky.adapter.upload_video(context)
+        finally:
+            await bluesky.close()
+
+    with warnings.catch_warnings():
+        # Streaming the body through data= only works by way of httpx's deprecated path
+        warnings.simplefilter('error', DeprecationWarning)
+        blob = asyncio.run(main())
+    assert (blob.mime_type, blob.size) == ('video/mp4', 6000)
+# End of test_video_upload_streams_the_file_as_the_blob
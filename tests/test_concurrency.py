@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from support.concurrency import gather_limited
+
+
+def test_results_keep_their_order_within_the_limit():
+    running, peak = [0], [0]
+
+    async def upload(index):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        # Later uploads finish first
+        await asyncio.sleep(0.01 * (5 - index))
+        running[0] -= 1
+        return f'media-{index}'
+
+    async def main():
+        return await gather_limited([upload(index) for index in range(5)], 2)
+
+    assert asyncio.run(main()) == [f'media-{index}' for index in range(5)]
+    assert peak[0] == 2
+# End of test_results_keep_their_order_within_the_limit
+
+
+def test_first_failure_cancels_its_siblings():
+    started, cancelled = [], []
+
+    async def upload(index):
+        started.append(index)
+        try:
+            if index == 1:
+                raise ValueError('upload failed')
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+
+    async def main():
+        with pytest.raises(ValueError):
+            await gather_limited([upload(index) for index in range(6)], 2)
+
+    asyncio.run(main())
+    # Uploads already running are cancelled, and the rest of the queue never starts
+    assert len(started) < 6
+    assert sorted(cancelled) == [index for index in started if index != 1]
+# End of test_first_failure_cancels_its_siblings
@@ -0,0 +1,284 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import stripe
+
+from support import database
+
+
+class FakeBucket:
+    """Storage with virtual folders: a folder is listed only while some file is under it."""
+
+    def __init__(self, paths):
+        self.paths = set(paths)
+
+    async def list(self, path, options):
+        await asyncio.sleep(0)
+        prefix = path + '/'
+        children = {}
+        for file_path in self.paths:
+            if file_path.startswith(prefix):
+                name, _, rest = file_path[len(prefix):].partition('/')
+                children[name] = None if rest else {'size': 1}
+        names = sorted(children)[options['offset']:options['offset'] + options['limit']]
+        return [{'name': name, 'metadata': children[name]} for name in names]
+
+    async def remove(self, batch):
+        await asyncio.sleep(0)
+        self.paths.difference_update(batch)
+
+
+# End of FakeBucket
+
+def test_delete_folder_removes_files_while_parent_still_paging(monkeypatch):
+    paths = [f"user/{folder:02d}/file.jpg" for folder in range(12)] + ["user/top.jpg"]
+    bucket = FakeBucket(paths)
+    client = SimpleNamespace(storage=SimpleNamespace(from_=lambda name: bucket))
+
+    async def connect():
+        return client
+
+    monkeypatch.setattr(database, 'connect', connect)
+    monkeypatch.setattr(database, 'STORAGE_LIST_PAGE_SIZE', 2)
+    monkeypatch.setattr(database, 'STORAGE_REMOVE_BATCH', 1)
+
+    removed = asyncio.run(database.delete_folder('images', 'user'))
+    assert bucket.paths == set()
+    assert removed == len(paths)
+# End of test_delete_folder_removes_files_while_parent_still_paging
+
+
+def test_delete_user_retry_treats_a_deleted_customer_as_done(monkeypatch):
+    customers, deleted_users = {'cus_1'}, []
+    folders_fail = [True]
+
+    async def delete_folder(bucket_name, folder_path):
+        if folders_fail[0]:
+            raise RuntimeError('storage unavailable')
+        return 1
+
+    async def delete_customer(customer_id):
+        if customer_id not in customers:
+            raise stripe.InvalidRequestError('No such customer: cus_1', 'id', code='resource_missing')
+        customers.discard(customer_id)
+
+    async def delete_auth_user(user_id):
+        deleted_users.append(user_id)
+
+    async def get_subscription_by_user(user_id, fresh=False):
+        return {'user_id': user_id, 'stripe_customer_id': 'cus_1'}
+
+    async def connect():
+        return SimpleNamespace(auth=SimpleNamespace(admin=SimpleNamespace(delete_user=delete_auth_user)))
+
+    monkeypatch.setattr(database, 'connect', connect)
+    monkeypatch.setattr(database, 'delete_folder', delete_folder)
+    monkeypatch.setattr(database, 'get_subscription_by_user', get_subscription_by_user)
+    monkeypatch.setattr(stripe.Customer, 'delete_async', delete_customer)
+
+    async def main():
+        # The customer goes while the storage deletes fail, then the retry finds it missing
+        first = await database.delete_user('user-1')
+        folders_fail[0] = False
+        return first, await database.delete_user('user-1')
+
+    first, retry = asyncio.run(main())
+    assert first['status'] == 'error' and customers == set()
+    assert retry['status'] == 'User deleted successfully'
+    assert deleted_users == ['user-1']
+# End of test_delete_user_retry_treats_a_deleted_customer_as_done
+
+
+class FakeSubscriptions:
+    """The subscriptions table, for select().eq() and update().eq() chains."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.selects = 0
+
+    def table(self, name):
+        return self
+
+    def select(self, *columns):
+        self.selects += 1
+        self._update = None
+        return self
+
+    def update(self, values):
+        self._update = values
+        return self
+
+    def eq(self, column, value):
+        self._match = (column, value)
+        return self
+
+    async def execute(self):
+        column, value = self._match
+        rows = [row for row in self.rows if row[column] == value]
+        for row in rows:
+            row.update(self._update or {})
+        return SimpleNamespace(data=[dict(row) for row in rows])
+
+
+# End of FakeSubscriptions
+
+def test_customer_created_elsewhere_is_not_created_again(monkeypatch):
+    row = {'user_id': 'user-1', 'email': 'a@example.com', 'stripe_customer_id': None}
+    table = FakeSubscriptions([row])
+    created = []
+
+    async def connect():
+        return table
+
+    async def create_customer(**kwargs):
+        created.append(kwargs)
+        return SimpleNamespace(id='cus_new')
+
+    monkeypatch.setattr(database, 'connect', connect)
+    monkeypatch.setattr(stripe.Customer, 'create_async', create_customer)
+    database.invalidate_subscription([row])
+
+    async def main():
+        # This machine caches the row before another one gives the user a customer
+        await database.get_subscription_by_user('user-1')
+        row['stripe_customer_id'] = 'cus_elsewhere'
+        return await database.create_or_fetch_customer('user-1')
+
+    assert asyncio.run(main()) == 'cus_elsewhere'
+    assert created == []
+    database.invalidate_subscription([row])
+# End of test_customer_created_elsewhere_is_not_created_again
+
+
+def test_connect_shares_one_client_until_closed(monkeypatch):
+    created, closed = [], []
+
+    async def acreate_client(url, key):
+        async def aclose():
+            closed.append(client)
+
+        client = SimpleNamespace(postgrest=SimpleNamespace(aclose=aclose))
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(database, 'acreate_client', acreate_client)
+    monkeypatch.setattr(database, 'supabase', None)
+
+    async def main():
+        first, second = await database.connect(), await database.connect()
+        await database.close()
+        return first, second, await database.connect()
+
+    first, second, reopened = asyncio.run(main())
+    assert first is second and closed == [first]
+    assert reopened is not first and len(created) == 2
+# End of test_connect_shares_one_client_until_closed
+
+
+def test_concurrent_reads_overlap_their_round_trips(monkeypatch):
+    rows = [{'user_id': f'user-{index}', 'stripe_customer_id': None} for index in range(3)]
+    table = FakeSubscriptions(rows)
+    waiting = []
+
+    class SlowQuery:
+        def __init__(self, column, value):
+            self.match = (column, value)
+
+        async def execute(self):
+            # Each read only finishes once every read has started
+            waiting.append(self)
+            while len(waiting) < len(rows):
+                await asyncio.sleep(0)
+            table._match, table._update = self.match, None
+            return await FakeSubscriptions.execute(table)
+
+    monkeypatch.setattr(table, 'eq', lambda column, value: SlowQuery(column, value))
+
+    async def connect():
+        return table
+
+    monkeypatch.setattr(database, 'connect', connect)
+
+    async def main():
+        reads = (database.get_subscription_by_user(row['user_id'], fresh=True) for row in rows)
+        return await asyncio.wait_for(asyncio.gather(*reads), timeout=5)
+
+    assert asyncio.run(main()) == rows
+    database.invalidate_subscription(rows)
+# End of test_concurrent_reads_overlap_their_round_trips
+
+
+class FakeImageBucket:
+    """The images bucket: one flat folder, with downloads that can fail and a concurrency count."""
+
+    def __init__(self, files, failing=()):
+        self.files = files
+        self.failing = set(failing)
+        self.running = self.peak = 0
+        self.removed = []
+
+    async def list(self, path):
+        return [{'name': os.path.basename(name)} for name in self.files]
+
+    async def download(self, path):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if path in self.failing:
+            raise RuntimeError('download failed')
+        return self.files[path]
+
+    async def remove(self, paths):
+        self.removed.append(paths)
+
+
+# End of FakeImageBucket
+
+def test_load_images_fetches_concurrently_in_post_order(monkeypatch, tmp_path):
+    files = {f'user/{index}.jpg': bytes([index]) * (index + 1) * 1024 for index in range(6)}
+    bucket = FakeImageBucket(files, failing={'user/4.jpg'})
+
+    async def connect():
+        return SimpleNamespace(storage=SimpleNamespace(from_=lambda name: bucket))
+
+    monkeypatch.setattr(database, 'connect', connect)
+    monkeypatch.setattr(database, 'MEDIA_FETCH_CONCURRENCY', 2)
+    monkeypatch.setattr(database, 'TEMP_IMAGES_DIR', str(tmp_path))
+
+    names = ['5.jpg', 'missing.jpg', '0.jpg', '4.jpg', '2.jpg']
+    media = asyncio.run(database.load_images(names, 'user', spool_threshold_kb=4))
+    assert [item.name for item in media] == ['5.jpg', '0.jpg', '2.jpg']
+    assert bucket.peak == 2
+    # Files over the threshold wait on disk, the rest stay in memory
+    assert media[0].data is None and open(media[0].path, 'rb').read() == files['user/5.jpg']
+    assert media[1].data == files['user/0.jpg'] and media[1].path is None
+    # Only what was downloaded is removed, in one call
+    assert bucket.removed == [['user/5.jpg', 'user/0.jpg', 'user/2.jpg']]
+# End of test_load_images_fetches_concurrently_in_post_order
+
+
+def test_update_user_limits_is_one_rpc(monkeypatch):
+    calls = []
+
+    class Client:
+        def rpc(self, name, params):
+            calls.append((name, params))
+            return self
+
+        async def execute(self):
+            if calls[-1][1]['p_plan'] == 'broken':
+                raise RuntimeError('plan not found')
+            return SimpleNamespace(data=2)
+
+    async def connect():
+        return Client()
+
+    monkeypatch.setattr(database, 'connect', connect)
+
+    result = asyncio.run(database.update_user_limits('user-1'))
+    assert calls == [('enforce_account_limit', {'p_user_id': 'user-1', 'p_plan': 'free'})]
+    assert result == {'status': 'User downgraded successfully', 'plan': 'free', 'disabled': 2}
+    assert asyncio.run(database.update_user_limits('user-1', 'broken'))['status'] == 'error'
+# End of test_update_user_limits_is_one_rpc
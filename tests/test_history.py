@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+from support import database, history, models
+
+
+class FakeHistoryTable:
+    """record_post_history: skips history ids it has stored, and fails while failing is set."""
+
+    def __init__(self, monkeypatch):
+        self.stored = {}
+        self.failing = False
+        monkeypatch.setattr(database, 'record_post_history', self.record)
+
+    async def record(self, records):
+        if self.failing:
+            raise RuntimeError('database unavailable')
+        new = [record for record in records if record['history_id'] not in self.stored]
+        self.stored.update((record['history_id'], record) for record in new)
+        return len(new)
+
+
+# End of FakeHistoryTable
+
+def spooled(path) -> list:
+    if not path.exists():
+        return []
+    return [json.loads(line)['history_id'] for line in path.read_text().splitlines()]
+# End of spooled
+
+
+def post_record(history_id: str) -> dict:
+    return history.build_record(models.Post(message=history_id, user_id='user'),
+                                [{'platform': 'mastodon', 'status': 'success'}], history_id)
+# End of post_record
+
+
+def test_failed_flush_keeps_records_spooled_for_the_next_start(monkeypatch, tmp_path):
+    table = FakeHistoryTable(monkeypatch)
+    spool = tmp_path / 'history.jsonl'
+    table.failing = True
+
+    async def first_run():
+        writer = history.HistoryWriter(str(spool), batch_size=10, interval=60)
+        await writer.start()
+        await writer.add(post_record('a'))
+        await writer.add(post_record('b'))
+        await writer.stop()
+
+    asyncio.run(first_run())
+    assert spooled(spool) == ['a', 'b'] and table.stored == {}
+
+    table.failing = False
+
+    async def second_run():
+        writer = history.HistoryWriter(str(spool), batch_size=10, interval=60)
+        await writer.start()
+        await writer.stop()
+
+    asyncio.run(second_run())
+    assert sorted(table.stored) == ['a', 'b']
+    assert spooled(spool) == []
+# End of test_failed_flush_keeps_records_spooled_for_the_next_start
+
+
+def test_flush_drops_only_the_batches_that_were_stored(monkeypatch, tmp_path):
+    spool = tmp_path / 'history.jsonl'
+    batches = []
+
+    async def record(records):
+        batches.append([record['history_id'] for record in records])
+        if len(batches) == 2:
+            raise RuntimeError('database unavailable')
+        return len(records)
+
+    monkeypatch.setattr(database, 'record_post_history', record)
+
+    async def main():
+        writer = history.HistoryWriter(str(spool), batch_size=2, interval=60)
+        for history_id in 'abc':
+            await writer.add(post_record(history_id))
+        assert not await writer.flush()
+        return len(writer)
+
+    assert asyncio.run(main()) == 1
+    assert batches == [['a', 'b'], ['c']]
+    assert spooled(spool) == ['c']
+# End of test_flush_drops_only_the_batches_that_were_stored
+
+
+def test_replayed_record_is_stored_once(monkeypatch, tmp_path):
+    table = FakeHistoryTable(monkeypatch)
+    spool = tmp_path / 'history.jsonl'
+
+    async def main():
+        # A crash after the batch was stored but before the spool was rewritten replays it
+        writer = history.HistoryWriter(str(spool), batch_size=10, interval=60)
+        await writer.add(post_record('a'))
+        await writer.flush()
+        spool.write_text(json.dumps(post_record('a')) + '\n')
+        await writer.start()
+        await writer.stop()
+
+    asyncio.run(main())
+    assert list(table.stored) == ['a']
+# End of test_replayed_record_is_stored_once
+
+
+def test_records_get_a_fresh_history_id_unless_given_one():
+    post = models.Post(message='hi', user_id='user')
+    platforms = [{'platform': 'mastodon', 'status': 'success'}]
+
+    assert history.build_record(post, platforms, 'job-1')['history_id'] == 'job-1'
+    assert history.build_record(post, platforms)['history_id'] != history.build_record(post, platforms)['history_id']
+# End of test_records_get_a_fresh_history_id_unless_given_one
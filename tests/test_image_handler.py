@@ -0,0 +1,186 @@
+import asyncio
+import io
+import random
+import threading
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from support import image_handler, media_cache, metrics
+from support.image_handler import compress_image_with_stats
+
+
+def line_art(size: int) -> bytes:
+    """Thin black lines on white, which the preview overestimates once downscaled."""
+    rng = random.Random(1)
+    image = Image.new('RGB', (size, size), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        draw.line([(rng.randrange(size), rng.randrange(size)) for _ in range(2)], fill='black', width=2)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+# End of line_art
+
+
+def photo(width: int, height: int, quality: int) -> bytes:
+    """Smooth noise saved as a JPEG, standing in for a photo."""
+    image = Image.effect_noise((width, height), 64).convert('RGB').filter(ImageFilter.GaussianBlur(2))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+# End of photo
+
+
+def test_line_art_that_fits_keeps_full_size():
+    data = line_art(1500)
+    budget_kb = len(data) // 1024 + 100
+    result = compress_image_with_stats(io.BytesIO(data), 'image/png', budget_kb, {'image/png'})
+    assert (result.width, result.height) == (1500, 1500)
+    assert len(result.data) <= budget_kb * 1024
+# End of test_line_art_that_fits_keeps_full_size
+
+
+def test_photo_under_budget_keeps_full_size():
+    data = photo(1500, 1000, 85)
+    budget_kb = len(data) * 2 // 1024
+    result = compress_image_with_stats(io.BytesIO(data), 'image/jpeg', budget_kb, {'image/jpeg'})
+    assert (result.width, result.height) == (1500, 1000)
+    assert result.quality == image_handler.MAX_QUALITY
+# End of test_photo_under_budget_keeps_full_size
+
+
+def test_photo_over_budget_fits_without_undershooting():
+    data = photo(3000, 2000, 95)
+    budget_kb = len(data) // 3 // 1024
+    result = compress_image_with_stats(io.BytesIO(data), 'image/jpeg', budget_kb, {'image/jpeg'})
+    assert image_handler.UNDERSHOOT_RATIO * budget_kb * 1024 <= len(result.data) <= budget_kb * 1024
+# End of test_photo_over_budget_fits_without_undershooting
+
+
+def test_quality_never_exceeds_max_quality(monkeypatch):
+    monkeypatch.setattr(image_handler, 'MAX_QUALITY', 60)
+    data = photo(1500, 1000, 95)
+    result = compress_image_with_stats(io.BytesIO(data), 'image/jpeg', len(data) * 2 // 1024, {'image/jpeg'})
+    assert result.quality == 60
+# End of test_quality_never_exceeds_max_quality
+
+
+def test_tight_budgets_stay_within_the_quality_floor_and_pass_limit():
+    data = photo(3000, 2000, 95)
+    for budget_kb in (30, 120, len(data) // 8 // 1024):
+        result = compress_image_with_stats(io.BytesIO(data), 'image/jpeg', budget_kb, {'image/jpeg'})
+        assert len(result.data) <= budget_kb * 1024
+        assert image_handler.MIN_QUALITY <= result.quality <= image_handler.MAX_QUALITY
+        # At most one full-size encode before the final passes
+        assert result.passes <= 1 + image_handler.MAX_FINAL_PASSES
+# End of test_tight_budgets_stay_within_the_quality_floor_and_pass_limit
+
+
+def test_preview_is_capped_at_preview_edge(monkeypatch):
+    sizes = []
+    encode = image_handler._encode
+
+    def recording_encode(image, *args, **kwargs):
+        sizes.append(max(image.size))
+        return encode(image, *args, **kwargs)
+
+    monkeypatch.setattr(image_handler, '_encode', recording_encode)
+    monkeypatch.setattr(image_handler, 'PREVIEW_EDGE', 256)
+    data = photo(3000, 2000, 95)
+    result = compress_image_with_stats(io.BytesIO(data), 'image/jpeg', 30, {'image/jpeg'})
+    # Every probe ran on the preview, and only the final passes on the image itself
+    assert sizes.count(256) == result.probe_passes
+    assert len(sizes) == result.probe_passes + result.passes
+# End of test_preview_is_capped_at_preview_edge
+
+
+def test_compression_bytes_skip_media_cache_hits(monkeypatch, tmp_path):
+    monkeypatch.setattr(media_cache, 'cache', media_cache.MediaCache(str(tmp_path)))
+    data = photo(800, 600, 95)
+    media = image_handler.MediaFile('photo.jpg', data)
+    compressed_in = metrics.COMPRESSION_BYTES.labels('in')
+
+    async def main():
+        # The second call is served from the media cache, with nothing compressed
+        for _ in range(2):
+            await image_handler._prepare_one(media, len(data) // 2 // 1024, frozenset({'image/jpeg'}))
+
+    before = compressed_in._value.get()
+    asyncio.run(main())
+    assert compressed_in._value.get() - before == len(data)
+# End of test_compression_bytes_skip_media_cache_hits
+
+
+def test_image_work_runs_on_the_pool_and_bursts_wait_for_a_slot():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return threading.current_thread().name
+
+    async def main():
+        await image_handler.shutdown_executor()
+        image_handler.start_executor(workers=2, queue_depth=1)
+        queued, ticks = [], 0
+        try:
+            jobs = asyncio.gather(*(image_handler.run_in_executor(work) for _ in range(8)))
+            while not jobs.done():
+                # The loop keeps running while the images are worked on
+                ticks += 1
+                queued.append(image_handler._executor._work_queue.qsize())
+                await asyncio.sleep(0.01)
+            names = await jobs
+        finally:
+            await image_handler.shutdown_executor()
+        return names, queued, ticks
+
+    names, queued, ticks = asyncio.run(main())
+    assert all(name.startswith('image') for name in names)
+    assert peak[0] == 2
+    assert max(queued) <= 1
+    assert ticks >= 10
+# End of test_image_work_runs_on_the_pool_and_bursts_wait_for_a_slot
+
+
+def test_choose_encoding_picks_the_smallest_accepted_codec():
+    noisy = Image.open(io.BytesIO(photo(400, 300, 90)))
+    drawing = Image.open(io.BytesIO(line_art(400)))
+    faded = Image.effect_noise((400, 300), 64).convert('RGBA')
+    faded.putalpha(128)
+    choose = image_handler.choose_encoding
+
+    assert choose(noisy, {'image/jpeg', 'image/webp'}, source_lossy=True) == ('image/webp', False)
+    assert choose(noisy, {'image/jpeg', 'image/png'}, source_lossy=True) == ('image/jpeg', False)
+    if 'image/avif' in image_handler.ENCODER_FORMATS:
+        assert choose(noisy, {'image/jpeg', 'image/webp', 'image/avif'}, source_lossy=True) == ('image/avif', False)
+    # Line art stays lossless, unless the source was lossy already
+    assert choose(drawing, {'image/jpeg', 'image/png'}) == ('image/png', True)
+    assert choose(drawing, {'image/jpeg', 'image/png', 'image/webp'}) == ('image/webp', True)
+    assert choose(drawing, {'image/jpeg', 'image/png'}, source_lossy=True) == ('image/jpeg', False)
+    # Transparency is kept when the platform takes a format that can carry it
+    assert choose(faded, {'image/jpeg', 'image/png'}) == ('image/png', True)
+    assert choose(faded, {'image/jpeg'}) == ('image/jpeg', False)
+# End of test_choose_encoding_picks_the_smallest_accepted_codec
+
+
+def test_webp_output_is_upright_and_has_no_metadata():
+    source = Image.effect_noise((400, 200), 64).convert('RGB')
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+    exif[0x010F] = 'Camera maker'
+    buffer = io.BytesIO()
+    source.save(buffer, 'WEBP', exif=exif.tobytes(), xmp=b'<x:xmpmeta/>')
+
+    result = compress_image_with_stats(io.BytesIO(buffer.getvalue()), 'image/webp', 500, {'image/jpeg', 'image/webp'})
+    output = Image.open(io.BytesIO(result.data))
+    assert result.mime_type == 'image/webp' and output.format == 'WEBP'
+    assert output.size == (200, 400)
+    assert not output.getexif() and 'xmp' not in output.info
+# End of test_webp_output_is_upright_and_has_no_metadata
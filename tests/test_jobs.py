@@ -0,0 +1,77 @@
+import asyncio
+
+from support.jobs import JobQueue, SQLiteJobStore
+
+
+def test_queued_job_survives_a_restart(tmp_path):
+    async def main():
+        store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+        job = await store.enqueue('stripe_subscription', {'subscription_id': 'sub_1'})
+
+        # A new store, as after a restart, claims the job once
+        await store.close()
+        store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+        claimed = await store.claim()
+        assert (claimed.id, claimed.payload) == (job.id, {'subscription_id': 'sub_1'})
+        assert await store.claim() is None
+        await store.close()
+
+    asyncio.run(main())
+# End of test_queued_job_survives_a_restart
+
+
+def test_stop_lets_running_jobs_finish(tmp_path):
+    async def main():
+        queue = JobQueue(SQLiteJobStore(str(tmp_path / "jobs.db")), workers=1)
+        started = asyncio.Event()
+
+        async def handler(payload, progress, resumed):
+            started.set()
+            await asyncio.sleep(0.2)
+            return 'finished'
+
+        queue.register('slow', handler)
+        await queue.start()
+        job = await queue.submit('slow', {})
+        await started.wait()
+        await queue.stop(grace=5)
+
+        store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+        finished = await store.get(job.id)
+        assert (finished.status, finished.result) == ('done', 'finished')
+        await store.close()
+
+    asyncio.run(main())
+# End of test_stop_lets_running_jobs_finish
+
+
+def test_job_cancelled_past_grace_resumes_from_progress(tmp_path):
+    async def main():
+        seen = []
+
+        async def handler(payload, progress, resumed):
+            seen.append(resumed)
+            await progress({'step': 1})
+            await asyncio.sleep(0 if resumed else 60)
+            return resumed
+
+        queue = JobQueue(SQLiteJobStore(str(tmp_path / "jobs.db")), workers=1)
+        queue.register('slow', handler)
+        await queue.start()
+        job = await queue.submit('slow', {})
+        while not seen:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        await queue.stop(grace=0.1)
+
+        # The next process picks the job up again, with what it had stored
+        queue = JobQueue(SQLiteJobStore(str(tmp_path / "jobs.db")), workers=1)
+        queue.register('slow', handler)
+        await queue.start()
+        while len(seen) < 2 or (await queue.store.get(job.id)).status != 'done':
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        assert seen == [{}, {'step': 1}]
+
+    asyncio.run(main())
+# End of test_job_cancelled_past_grace_resumes_from_progress
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+import pytest
+
+from support import logger_config
+from support.logger_config import BackgroundHandler, ContextFilter, JsonFormatter, RateLimitFilter, log_context
+
+
+class Pipeline:
+    """The app's logging setup on its own logger, writing to a small rotating file."""
+
+    def __init__(self, path, rate_limit: int = 3):
+        self.path = path
+        self.file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=2000, backupCount=2, encoding='utf-8')
+        self.file_handler.setFormatter(JsonFormatter())
+        log_queue = queue.SimpleQueue()
+        self.handler = BackgroundHandler(log_queue)
+        self.handler.addFilter(ContextFilter())
+        self.handler.addFilter(RateLimitFilter(limit=rate_limit, window=0.2))
+        self.listener = logging.handlers.QueueListener(log_queue, self.file_handler)
+        self.listener.start()
+        self.stopped = False
+
+        self.log = logging.getLogger(f'test pipeline {path}')
+        self.log.setLevel(logging.DEBUG)
+        self.log.propagate = False
+        self.log.addHandler(self.handler)
+
+    def stop(self) -> None:
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+            self.log.removeHandler(self.handler)
+            self.file_handler.close()
+
+    def records(self) -> list:
+        """Stop the listener, so everything queued is written, and read back every file, oldest first."""
+        self.stop()
+        files = sorted(self.path.parent.glob(self.path.name + '*'), reverse=True)
+        return [json.loads(line) for file in files for line in file.read_text().splitlines()]
+
+
+# End of Pipeline
+
+@pytest.fixture
+def pipeline(tmp_path):
+    pipelines = []
+
+    def build(**kwargs) -> Pipeline:
+        pipelines.append(Pipeline(tmp_path / 'app.log', **kwargs))
+        return pipelines[-1]
+
+    yield build
+    for item in pipelines:
+        item.stop()
+# End of pipeline
+
+
+def test_records_are_json_with_the_context_of_the_task_that_logged_them(pipeline):
+    logs = pipeline()
+    log = logs.log
+
+    async def publish(platform):
+        with log_context(platform=platform):
+            log.info(f'posted to {platform}')
+
+    async def main():
+        with log_context(post_id='post-1', job_id='job-1'):
+            await asyncio.gather(publish('mastodon'), publish('bluesky'))
+        try:
+            raise ValueError('bad token')
+        except ValueError:
+            log.exception('upload failed')
+
+    asyncio.run(main())
+    first, second, failure = logs.records()
+    assert first['message'] == 'posted to mastodon' and first['platform'] == 'mastodon'
+    assert second['platform'] == 'bluesky' and second['post_id'] == 'post-1' and second['job_id'] == 'job-1'
+    assert first['duration_ms'] >= 0 and first['level'] == 'INFO'
+    assert 'platform' not in failure and 'ValueError: bad token' in failure['exception']
+# End of test_records_are_json_with_the_context_of_the_task_that_logged_them
+
+
+def test_each_level_is_rate_limited_and_reports_what_it_dropped(pipeline):
+    logs = pipeline()
+    log = logs.log
+
+    for index in range(10):
+        log.error(f'instance down {index}')
+    log.info('still running')
+    time.sleep(0.25)
+    log.error('instance back')
+
+    logged = logs.records()
+    assert [entry['message'] for entry in logged] == [
+        'instance down 0', 'instance down 1', 'instance down 2', 'still running', 'instance back']
+    assert logged[-1]['suppressed'] == 7
+# End of test_each_level_is_rate_limited_and_reports_what_it_dropped
+
+
+def test_log_file_rotates_at_its_size_limit(pipeline, tmp_path):
+    logs = pipeline(rate_limit=0)
+
+    for index in range(100):
+        logs.log.debug(f'line {index:03d} ' + 'x' * 50)
+
+    logged = logs.records()
+    # Two backups are kept, so only the most recent lines survive
+    assert sorted(file.name for file in tmp_path.iterdir()) == ['app.log', 'app.log.1', 'app.log.2']
+    assert all(file.stat().st_size <= 2000 for file in tmp_path.iterdir())
+    assert len(logged) < 100 and logged[-1]['message'].startswith('line 099')
+# End of test_log_file_rotates_at_its_size_limit
+
+
+def test_app_logger_only_enqueues():
+    assert [type(handler) for handler in logger_config.logger.handlers] == [BackgroundHandler]
+# End of test_app_logger_only_enqueues
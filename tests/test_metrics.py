@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import main
+from support import metrics
+
+
+def test_metrics_need_the_token(monkeypatch):
+    client = TestClient(main.app)
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'scrape-secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+    assert response.status_code == 200
+    assert 'loftly_http_request_duration_seconds' in response.text
+# End of test_metrics_need_the_token
+
+
+def test_failed_request_is_recorded_as_a_500():
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/boom', 'headers': [], 'query_string': b''})
+    series = metrics.HTTP_REQUEST_SECONDS.labels('GET', 'unmatched', 500)
+
+    async def call_next(request):
+        raise RuntimeError('handler failed')
+
+    before = series._sum.get()
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.record_request_metrics(request, call_next))
+    assert series._sum.get() > before
+# End of test_failed_request_is_recorded_as_a_500
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import httpx
+
+from platforms import base, lemmyapi, mastodon_pool, mastodonapi
+from support import image_handler, models, video_handler
+
+
+class FlakyAdapter(base.PlatformAdapter):
+    """Uploads through the media id cache, then fails to publish while failing is set."""
+
+    name = 'flaky'
+    capabilities = base.Capabilities(max_images=4, max_image_kb=976)
+    media_id_ttl = 3600
+    media_ids_single_use = False
+    unpublished_media_id_ttl = 0.05
+
+    def __init__(self):
+        self.uploads = 0
+        self.failing = True
+
+    async def authenticate(self, context):
+        return None
+
+    async def upload_media(self, context):
+        async def upload():
+            self.uploads += 1
+            return f"blob-{self.uploads}"
+        return [await self.upload_cached(context, image.data, upload) for image in context.media]
+
+    async def publish(self, context):
+        if self.failing:
+            raise base.PlatformError("publish failed")
+        return [models.BuildPostResponse(context.account, 'success', 'Successfully posted')]
+
+
+# End of FlakyAdapter
+
+def test_failed_run_keeps_fresh_uploads_only_briefly():
+    adapter = FlakyAdapter()
+    account = models.ConnectedAccount(platform='flaky', handle='alice')
+    media = [image_handler.PreparedImage('photo.jpg', 'image/jpeg', b'pixels')]
+
+    async def main():
+        # A quick retry after a failed run reuses the upload
+        await adapter.run(models.Post(message='hi'), account, media)
+        adapter.failing = False
+        await adapter.run(models.Post(message='hi'), account, media)
+        assert adapter.uploads == 1
+
+        # A later one sends the image again, as the platform may have discarded it
+        other = [image_handler.PreparedImage('other.jpg', 'image/jpeg', b'other pixels')]
+        adapter.failing = True
+        await adapter.run(models.Post(message='hi'), account, other)
+        await asyncio.sleep(0.1)
+        adapter.failing = False
+        results = await adapter.run(models.Post(message='hi'), account, other)
+        assert adapter.uploads == 3
+        assert results[0]['status'] == 'success'
+
+    asyncio.run(main())
+# End of test_failed_run_keeps_fresh_uploads_only_briefly
+
+
+def test_mastodon_video_upload_streams_the_file_as_a_form(monkeypatch, tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'frames' * 1000)
+    uploads = []
+
+    async def handler(request):
+        uploads.append((request.headers['content-type'], await request.aread()))
+        return httpx.Response(200, json={'id': '7', 'url': 'https://mastodon.test/media/7'})
+
+    monkeypatch.setattr(video_handler, 'get_http_client',
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    context = base.PublishContext(models.Post(message='hi'), models.ConnectedAccount(platform='mastodon'),
+                                  video=video_handler.PreparedVideo('clip.mp4', str(path), 'video/mp4', 6000))
+    context.client = SimpleNamespace(api_base_url='https://mastodon.test')
+
+    assert asyncio.run(mastodonapi.adapter.upload_video(context)) == '7'
+    content_type, body = uploads[0]
+    assert content_type.startswith('multipart/form-data; boundary=')
+    assert b'filename="clip.mp4"\r\nContent-Type: video/mp4\r\n\r\n' + b'frames' * 1000 + b'\r\n--' in body
+# End of test_mastodon_video_upload_streams_the_file_as_a_form
+
+
+def test_accounts_without_a_handle_do_not_share_uploads():
+    adapter = FlakyAdapter()
+    adapter.failing = False
+    media = [image_handler.PreparedImage('photo.jpg', 'image/jpeg', b'pixels')]
+    first = models.ConnectedAccount(platform='flaky', instance='social.test', access_token='token-1')
+    second = models.ConnectedAccount(platform='flaky', instance='social.test', access_token='token-2')
+
+    async def main():
+        await adapter.run(models.Post(message='hi'), first, media)
+        await adapter.run(models.Post(message='hi'), second, media)
+        await adapter.run(models.Post(message='hi'), first, media)
+
+    asyncio.run(main())
+    assert adapter.uploads == 2
+# End of test_accounts_without_a_handle_do_not_share_uploads
+
+
+def test_published_upload_gets_its_full_reuse_window_back():
+    adapter = FlakyAdapter()
+    account = models.ConnectedAccount(platform='flaky', handle='carol')
+    media = [image_handler.PreparedImage('photo.jpg', 'image/jpeg', b'carol pixels')]
+
+    async def main():
+        # The failed run shortens the window, then a post that uses the upload restores it
+        await adapter.run(models.Post(message='hi'), account, media)
+        adapter.failing = False
+        await adapter.run(models.Post(message='hi'), account, media)
+        await asyncio.sleep(0.1)
+        await adapter.run(models.Post(message='hi'), account, media)
+
+    asyncio.run(main())
+    assert adapter.uploads == 1
+# End of test_published_upload_gets_its_full_reuse_window_back
+
+
+def test_mastodon_client_is_rebuilt_once_its_session_is_evicted(monkeypatch):
+    monkeypatch.setattr(mastodon_pool, 'Mastodon', lambda session, **kwargs: SimpleNamespace(session=session))
+    mastodon_pool.close()
+
+    first = mastodon_pool.get_client('https://social.test', 'token')
+    assert mastodon_pool.get_client('https://social.test', 'token') is first
+
+    mastodon_pool._sessions.pop('social.test')
+    rebuilt = mastodon_pool.get_client('https://social.test', 'token')
+    assert rebuilt is not first
+    assert rebuilt.session is mastodon_pool._sessions.get('social.test')
+    mastodon_pool.close()
+# End of test_mastodon_client_is_rebuilt_once_its_session_is_evicted
+
+
+def test_mastodon_image_upload_is_not_retried_after_a_timeout(monkeypatch):
+    monkeypatch.setattr(mastodonapi.adapter, 'timeout', 0.05)
+    uploads = []
+
+    def media_post(**kwargs):
+        uploads.append(kwargs['description'])
+        time.sleep(0.2)  # The blocking upload outlives its timeout in the worker thread
+        return {'id': '1'}
+
+    account = models.ConnectedAccount(platform='mastodon', instance='https://slow.test', access_token='t')
+    context = base.PublishContext(models.Post(message='hi'), account,
+                                  [image_handler.PreparedImage('photo.jpg', 'image/jpeg', b'slow pixels')])
+    context.client = SimpleNamespace(media_post=media_post)
+
+    async def main():
+        try:
+            await mastodonapi.adapter.upload_media(context)
+        except TimeoutError:
+            pass
+
+    asyncio.run(main())
+    assert uploads == ['photo.jpg']
+# End of test_mastodon_image_upload_is_not_retried_after_a_timeout
+
+
+def test_lemmy_posts_to_communities_concurrently_within_the_instance_limit(monkeypatch):
+    instance = 'lemmy.concurrency.test'
+    in_flight = [0, 0]
+
+    async def handler(request):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        community_id = json.loads(request.content)['community_id']
+        if community_id == 3:
+            return httpx.Response(500)
+        return httpx.Response(200, json={'post_view': {'post': {'id': community_id * 10}}})
+
+    client = httpx.AsyncClient(base_url=f'https://{instance}', transport=httpx.MockTransport(handler))
+    monkeypatch.setitem(lemmyapi._clients, instance, client)
+    monkeypatch.setitem(lemmyapi._instance_slots, instance, asyncio.Semaphore(2))
+    account = models.ConnectedAccount(platform='lemmy', handle='me', access_token='token', lemmy_communities=[
+        models.LemmyCommunity(community_id=index, community_name=f'c{index}', instance=instance)
+        for index in range(1, 7)])
+
+    results = asyncio.run(lemmyapi.LemmyAdapter().run(models.Post(message='hi'), account))
+    assert in_flight[1] == 2
+    # Every community gets its own result, in the account's order
+    assert [result['status'] for result in results] == ['success', 'success', 'error', 'success', 'success', 'success']
+    assert results[1]['post_url'] == f'https://{instance}/post/20'
+# End of test_lemmy_posts_to_communities_concurrently_within_the_instance_limit
+
+
+def test_every_platform_module_registers_its_adapter():
+    from platforms import bluesky, pixelfedapi
+
+    for module in (bluesky, lemmyapi, mastodonapi, pixelfedapi):
+        assert base.get_adapter(module.adapter.name) is module.adapter
+    assert base.get_adapter('myspace') is None and base.get_adapter(None) is None
+# End of test_every_platform_module_registers_its_adapter
+
+
+class RecordingAdapter(base.PlatformAdapter):
+    """Records the lifecycle steps it runs, and raises error at the publish step if set."""
+
+    name = 'recording'
+    display_name = 'Recording'
+    capabilities = base.Capabilities(max_images=2, max_image_kb=100, requires_media=True)
+
+    def __init__(self):
+        self.steps = []
+        self.error = None
+
+    async def authenticate(self, context):
+        self.steps.append('authenticate')
+
+    async def upload_media(self, context):
+        self.steps.append('upload_media')
+        return [image.name for image in context.media]
+
+    async def publish(self, context):
+        self.steps.append('publish')
+        if self.error is not None:
+            raise self.error
+        return [models.BuildPostResponse(context.account, 'success', ','.join(context.uploaded))]
+
+
+# End of RecordingAdapter
+
+def test_registered_adapter_runs_the_lifecycle_and_always_returns_a_list(monkeypatch):
+    monkeypatch.setitem(base._adapters, 'recording', RecordingAdapter())
+    adapter = base.get_adapter('recording')
+    account = models.ConnectedAccount(platform='recording', handle='alice')
+    post = models.Post(message='hi')
+    media = [image_handler.PreparedImage(f'{index}.jpg', 'image/jpeg', b'pixels') for index in range(3)]
+
+    async def main():
+        # Images beyond the capability are dropped before anything is sent
+        results = [await adapter.run(post, account, media)]
+        assert adapter.steps == ['authenticate', 'upload_media', 'publish']
+        adapter.error = base.PlatformError('Status rejected')
+        results.append(await adapter.run(post, account, media))
+        adapter.error = KeyError('id')
+        results.append(await adapter.run(post, account, media))
+        adapter.steps.clear()
+        results.append(await adapter.run(post, account, []))
+        return results
+
+    ok, rejected, unexpected, no_media = asyncio.run(main())
+    assert [(result['status'], result['message']) for result in ok] == [('success', '0.jpg,1.jpg')]
+    assert [result['message'] for result in rejected] == ['Status rejected']
+    assert [result['message'] for result in unexpected] == ['Failed to post: hi to Recording']
+    assert [result['message'] for result in no_media] == ['Recording requires at least one image.']
+    assert adapter.steps == []
+# End of test_registered_adapter_runs_the_lifecycle_and_always_returns_a_list
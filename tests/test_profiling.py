@@ -0,0 +1,41 @@
+import asyncio
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from support import profiling
+
+
+def make_request(headers=()) -> Request:
+    return Request({'type': 'http', 'method': 'GET', 'path': '/health', 'query_string': b'',
+                    'headers': [(name.lower().encode(), value.encode()) for name, value in headers]})
+# End of make_request
+
+
+async def ok(request):
+    return Response('ok')
+# End of ok
+
+
+def test_profile_is_saved_and_named_in_the_response(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+
+    response = asyncio.run(profiling.profile_request(make_request([('X-Profile', 'token')]), ok))
+    assert response.body == b'ok'
+    assert (tmp_path / response.headers['X-Profile-Id']).exists()
+# End of test_profile_is_saved_and_named_in_the_response
+
+
+def test_failed_profile_save_still_returns_the_response(monkeypatch):
+    def save_profile(profiler, name):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(profiling, '_save_profile', save_profile)
+
+    response = asyncio.run(profiling.profile_request(make_request([('X-Profile', 'token')]), ok))
+    assert response.body == b'ok'
+    assert 'X-Profile-Id' not in response.headers
+    # The lock is released, so the next request can be profiled
+    assert profiling._profiling.acquire(blocking=False)
+    profiling._profiling.release()
+# End of test_failed_profile_save_still_returns_the_response
@@ -0,0 +1,151 @@
+import asyncio
+
+from platforms import base, lemmyapi
+from support import database, history, models, publisher
+
+
+class FakeAdapter:
+    """Records the accounts it posts to and succeeds for each."""
+
+    capabilities = base.Capabilities()
+
+    def __init__(self, posted):
+        self.posted = posted
+
+    async def run(self, metadata, account, media, deadline, video=None, previous=None):
+        self.posted.append(account.handle)
+        return [{'platform': account.platform, 'status': 'success', 'message': 'Successfully posted',
+                 'handle': account.handle}]
+
+
+# End of FakeAdapter
+
+def test_resumed_publish_skips_accounts_already_posted_to(monkeypatch):
+    posted, recorded, reports = [], [], []
+    monkeypatch.setattr(publisher, '_adapters', lambda metadata: [FakeAdapter(posted)] * 2)
+
+    async def record(metadata, platforms, history_id=None):
+        recorded.append(platforms)
+
+    async def progress(state):
+        reports.append(state)
+
+    monkeypatch.setattr(history, 'record', record)
+    post = models.Post(message='hi', connected_accounts=[
+        models.ConnectedAccount(platform='mastodon', handle='first'),
+        models.ConnectedAccount(platform='bluesky', handle='second')])
+
+    # An earlier attempt posted to the first account before it was interrupted
+    first = [{'platform': 'mastodon', 'status': 'success', 'message': 'Successfully posted', 'handle': 'first'}]
+    resumed = {
+        'stage': 'publishing',
+        'platforms': [{'platform': 'mastodon', 'handle': 'first', 'instance': None, 'status': 'success'},
+                      {'platform': 'bluesky', 'handle': 'second', 'instance': None, 'status': 'pending'}],
+        'results': {'0': first},
+    }
+
+    async def main():
+        return await publisher.publish_post(post, progress, resumed=resumed)
+
+    response = asyncio.run(main())
+    assert posted == ['second']
+    assert [result['handle'] for result in response] == ['first', 'second']
+    assert [p['status'] for p in reports[-1]['platforms']] == ['success', 'success']
+    assert recorded == [response]
+# End of test_resumed_publish_skips_accounts_already_posted_to
+
+
+def test_resumed_partial_account_only_posts_to_the_missed_destinations(monkeypatch):
+    sent, recorded = [], []
+    adapter = lemmyapi.LemmyAdapter()
+
+    async def post_to_community(context, community):
+        sent.append(community.community_name)
+        return models.BuildPostResponse(context.account, 'success', f'Successfully posted to {community.community_name}')
+
+    async def record(metadata, platforms, history_id=None):
+        recorded.append(history_id)
+
+    monkeypatch.setattr(adapter, 'post_to_community', post_to_community)
+    monkeypatch.setattr(publisher, '_adapters', lambda metadata: [adapter])
+    monkeypatch.setattr(history, 'record', record)
+    account = models.ConnectedAccount(platform='lemmy', handle='me', lemmy_communities=[
+        models.LemmyCommunity(community_id=1, community_name='one', instance='lemmy.test'),
+        models.LemmyCommunity(community_id=2, community_name='two', instance='lemmy.test')])
+    post = models.Post(message='hi', connected_accounts=[account])
+
+    # The first community got the post, the second timed out
+    first = models.BuildPostResponse(account, 'success', 'Successfully posted to one')
+    resumed = {
+        'stage': 'publishing',
+        'platforms': [{'platform': 'lemmy', 'handle': 'me', 'instance': None, 'status': 'partial'}],
+        'results': {'0': [first, models.BuildPostResponse(account, 'error', 'Timed out posting to two')]},
+        'history_id': 'first-attempt',
+    }
+
+    async def main():
+        return await publisher.publish_post(post, resumed=resumed)
+
+    response = asyncio.run(main())
+    assert sent == ['two']
+    assert [result['status'] for result in response] == ['success', 'success']
+    assert recorded == ['first-attempt']
+# End of test_resumed_partial_account_only_posts_to_the_missed_destinations
+
+
+def test_storage_media_is_kept_until_the_post_is_recorded(monkeypatch):
+    events = []
+    monkeypatch.setattr(publisher, '_adapters', lambda metadata: [FakeAdapter([])])
+
+    async def load_images(names, folder, remove=True, spool_threshold_kb=0):
+        events.append(('load', remove))
+        return []
+
+    async def remove_media(bucket, folder, names):
+        events.append(('remove', bucket, names))
+
+    async def record(metadata, platforms, history_id=None):
+        events.append(('record',))
+
+    monkeypatch.setattr(database, 'load_images', load_images)
+    monkeypatch.setattr(database, 'remove_media', remove_media)
+    monkeypatch.setattr(history, 'record', record)
+    post = models.Post(message='hi', media_filenames=['a.png'], user_id='user',
+                       connected_accounts=[models.ConnectedAccount(platform='mastodon', handle='me')])
+
+    async def main():
+        await publisher.publish_post(post)
+
+    asyncio.run(main())
+    assert events == [('load', False), ('record',), ('remove', 'images', ['a.png'])]
+# End of test_storage_media_is_kept_until_the_post_is_recorded
+
+
+def test_video_post_fails_when_the_video_cannot_be_downloaded(monkeypatch):
+    posted, removed = [], []
+    monkeypatch.setattr(publisher, '_adapters', lambda metadata: [FakeAdapter(posted)])
+
+    async def load_video(name, folder, remove=True):
+        return None
+
+    async def remove_media(bucket, folder, names):
+        removed.append(names)
+
+    async def record(metadata, platforms, history_id=None):
+        pass
+
+    monkeypatch.setattr(database, 'load_video', load_video)
+    monkeypatch.setattr(database, 'remove_media', remove_media)
+    monkeypatch.setattr(history, 'record', record)
+    post = models.Post(message='hi', type=models.PostType.VIDEO, video_filename='clip.mp4', user_id='user',
+                       connected_accounts=[models.ConnectedAccount(platform='mastodon', handle='me')])
+
+    async def main():
+        return await publisher.publish_post(post)
+
+    response = asyncio.run(main())
+    # Not posted as text only, and the video is kept in storage for a retry
+    assert posted == [] and removed == []
+    assert [(result['status'], result['message']) for result in response] == [
+        ('error', 'Failed to download video clip.mp4')]
+# End of test_video_post_fails_when_the_video_cannot_be_downloaded
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from support import resilience
+from support.concurrency import gather_limited
+
+
+def half_open_breaker() -> resilience.CircuitBreaker:
+    breaker = resilience.CircuitBreaker("test.example", failures=1, reset_after=0.01)
+    breaker.record_failure()
+    breaker.opened_at = time.monotonic() - 1
+    assert breaker.state == 'half-open'
+    return breaker
+# End of half_open_breaker
+
+
+def test_cancelled_trial_releases_half_open_breaker():
+    breaker = half_open_breaker()
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def main():
+        deadline = resilience.Deadline(30)
+        calls = [resilience.call(slow, deadline=deadline, timeout=30, breaker=breaker) for _ in range(2)]
+        # The second call is rejected while the first holds the trial, which cancels the trial
+        try:
+            await gather_limited(calls, 2)
+        except resilience.CircuitOpenError:
+            pass
+
+    asyncio.run(main())
+    assert breaker.state == 'half-open'
+    assert not breaker.trial_running
+    assert breaker.allow()
+# End of test_cancelled_trial_releases_half_open_breaker
+
+
+def test_successful_trial_closes_breaker():
+    breaker = half_open_breaker()
+
+    async def ok():
+        return 'ok'
+
+    result = asyncio.run(resilience.call(ok, deadline=resilience.Deadline(30), timeout=30, breaker=breaker))
+    assert result == 'ok'
+    assert breaker.state == 'closed'
+# End of test_successful_trial_closes_breaker
+
+
+def test_timeouts_are_retried_only_when_allowed():
+    attempts = []
+
+    async def slow():
+        attempts.append(1)
+        await asyncio.sleep(10)
+
+    async def main(retry_timeouts):
+        policy = resilience.RetryPolicy(retries=2, base_delay=0.001)
+        try:
+            await resilience.call(slow, deadline=resilience.Deadline(30), timeout=0.01, policy=policy,
+                                  retry_timeouts=retry_timeouts)
+        except TimeoutError:
+            pass
+
+    asyncio.run(main(True))
+    assert len(attempts) == 3
+    attempts.clear()
+    # An upload that keeps running in its thread must not be sent twice
+    asyncio.run(main(False))
+    assert len(attempts) == 1
+# End of test_timeouts_are_retried_only_when_allowed
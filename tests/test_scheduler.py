@@ -0,0 +1,219 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from support import database, models, publisher, scheduler
+from support.scheduler import PostScheduler, TimerWheel
+
+
+# --- Timer Wheel ---
+def test_timer_fires_at_first_tick_at_or_after_its_time():
+    wheel = TimerWheel(lambda key: None, tick=1, slots=4)
+    start = wheel._next
+    wheel.schedule('soon', start + 0.5)
+    wheel.schedule('later', start + 5)  # More than one revolution away
+
+    fired = {}
+    for tick in range(8):
+        for key in wheel._advance():
+            fired[key] = tick
+    assert fired == {'soon': 1, 'later': 5}
+    assert len(wheel) == 0
+# End of test_timer_fires_at_first_tick_at_or_after_its_time
+
+
+def test_rescheduling_replaces_and_cancel_removes():
+    wheel = TimerWheel(lambda key: None, tick=1, slots=4)
+    wheel.schedule('post', wheel._next + 3)
+    wheel.schedule('post', wheel._next)
+    wheel.schedule('gone', wheel._next)
+    assert wheel.cancel('gone')
+    assert not wheel.cancel('gone')
+    assert wheel._advance() == ['post']
+    assert 'post' not in wheel
+# End of test_rescheduling_replaces_and_cancel_removes
+
+
+def test_running_wheel_catches_up_missed_ticks():
+    async def main():
+        fired = []
+        wheel = TimerWheel(fired.append, tick=0.01, slots=8)
+        wheel.schedule('a', time.time() + 0.02)
+        wheel.schedule('b', time.time() + 0.2)  # Several revolutions away
+        wheel.start()
+        time.sleep(0.05)  # A blocked loop: the ticks it missed still fire
+        await asyncio.sleep(0.3)
+        await wheel.stop()
+        assert fired == ['a', 'b']
+
+    asyncio.run(main())
+# End of test_running_wheel_catches_up_missed_ticks
+
+
+# --- Scheduler ---
+class FakeTable:
+    """The scheduled_posts calls PostScheduler makes, on one in-memory row."""
+
+    def __init__(self, monkeypatch, row):
+        self.row = row
+        self.saved = []
+        self.requeued_before = []
+        monkeypatch.setattr(database, 'claim_scheduled_post', self.claim)
+        monkeypatch.setattr(database, 'save_scheduled_progress', self.save)
+        monkeypatch.setattr(database, 'finish_scheduled_post', self.finish)
+        monkeypatch.setattr(database, 'requeue_stale_scheduled_posts', self.requeue)
+        monkeypatch.setattr(database, 'get_upcoming_scheduled_posts', self.upcoming)
+
+    async def claim(self, post_id):
+        if self.row['status'] != 'scheduled':
+            return None
+        self.row['status'] = 'publishing'
+        return dict(self.row)
+
+    async def save(self, post_id, progress):
+        self.saved.append(progress)
+
+    async def finish(self, post_id, status, result):
+        self.row.update(status=status, result=result)
+
+    async def requeue(self, older_than):
+        self.requeued_before.append(older_than)
+        return 0
+
+    async def upcoming(self, before):
+        return []
+
+
+# End of FakeTable
+
+def post_row(**changes) -> dict:
+    payload = models.Post(message='hi', connected_accounts=[models.ConnectedAccount(platform='mastodon')])
+    return {'id': 'post-1', 'status': 'scheduled', 'publish_at': datetime.now(timezone.utc).isoformat(),
+            'payload': payload.model_dump(mode='json'), 'progress': None, **changes}
+# End of post_row
+
+
+def test_claimed_post_resumes_from_saved_progress(monkeypatch):
+    progress = {'results': {'0': [{'status': 'success'}]}}
+    table = FakeTable(monkeypatch, post_row(progress=progress))
+    calls = []
+
+    async def publish_post(metadata, progress=None, prefetched=None, resumed=None):
+        calls.append(resumed)
+        return [{'status': 'success'}]
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+    asyncio.run(PostScheduler()._publish('post-1'))
+    assert calls == [progress]
+    assert table.row['status'] == 'published'
+# End of test_claimed_post_resumes_from_saved_progress
+
+
+def test_post_claimed_elsewhere_is_not_published(monkeypatch):
+    table = FakeTable(monkeypatch, post_row(status='publishing'))
+    calls = []
+
+    async def publish_post(*args, **kwargs):
+        calls.append(args)
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+    asyncio.run(PostScheduler()._publish('post-1'))
+    assert calls == []
+    assert table.row['status'] == 'publishing'
+# End of test_post_claimed_elsewhere_is_not_published
+
+
+def test_progress_is_saved_only_when_an_account_is_reached(monkeypatch):
+    table = FakeTable(monkeypatch, post_row())
+
+    async def publish_post(metadata, progress=None, prefetched=None, resumed=None):
+        state = {'stage': 'publishing', 'results': {}}
+        await progress(state)
+        state['results']['0'] = [{'status': 'success'}]
+        await progress(state)
+        state['stage'] = 'recording'
+        await progress(state)
+        return [{'status': 'success'}]
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+    asyncio.run(PostScheduler()._publish('post-1'))
+    assert [saved['results'] for saved in table.saved] == [{'0': [{'status': 'success'}]}]
+# End of test_progress_is_saved_only_when_an_account_is_reached
+
+
+def test_history_id_is_saved_before_history_when_no_account_was_reached(monkeypatch):
+    table = FakeTable(monkeypatch, post_row())
+
+    async def publish_post(metadata, progress=None, prefetched=None, resumed=None):
+        state = {'stage': 'publishing', 'results': {}, 'history_id': 'history-1'}
+        await progress(state)
+        state['stage'] = 'recording'
+        await progress(state)
+        state['stage'] = 'done'
+        await progress(state)
+        return [{'status': 'error'}]
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+    asyncio.run(PostScheduler()._publish('post-1'))
+    assert [saved['history_id'] for saved in table.saved] == ['history-1']
+# End of test_history_id_is_saved_before_history_when_no_account_was_reached
+
+
+def test_start_and_refresh_requeue_stale_posts(monkeypatch):
+    table = FakeTable(monkeypatch, post_row())
+    monkeypatch.setattr(scheduler, 'SCHEDULER_HORIZON', 0.02)
+
+    async def main():
+        posts = PostScheduler()
+        await posts.start()
+        await asyncio.sleep(0.05)
+        await posts.stop()
+
+    asyncio.run(main())
+    # Once at start, then again by the refresh loop
+    assert len(table.requeued_before) >= 2
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=scheduler.SCHEDULER_STALE_AFTER)
+    assert abs((table.requeued_before[0] - cutoff).total_seconds()) < 5
+# End of test_start_and_refresh_requeue_stale_posts
+
+
+def test_stop_lets_posts_in_flight_finish(monkeypatch):
+    table = FakeTable(monkeypatch, post_row())
+
+    async def publish_post(metadata, progress=None, prefetched=None, resumed=None):
+        await asyncio.sleep(0.1)
+        return [{'status': 'success'}]
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+
+    async def main():
+        posts = PostScheduler()
+        await posts.start()
+        posts._fire(('post-1', 'publish'))
+        await asyncio.sleep(0.01)
+        await posts.stop(grace=5)
+
+    asyncio.run(main())
+    assert table.row['status'] == 'published'
+# End of test_stop_lets_posts_in_flight_finish
+
+
+def test_stop_cancels_posts_past_the_grace_period(monkeypatch):
+    table = FakeTable(monkeypatch, post_row())
+
+    async def publish_post(metadata, progress=None, prefetched=None, resumed=None):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(publisher, 'publish_post', publish_post)
+
+    async def main():
+        posts = PostScheduler()
+        await posts.start()
+        posts._fire(('post-1', 'publish'))
+        await asyncio.sleep(0.01)
+        await posts.stop(grace=0.05)
+
+    asyncio.run(main())
+    # Left publishing, to be rescheduled and resumed once stale
+    assert table.row['status'] == 'publishing'
+# End of test_stop_cancels_posts_past_the_grace_period
@@ -0,0 +1,157 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+import stripe
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from support import database, stripe_api
+
+
+def event(event_id: str, created: int, status: str = 'active') -> dict:
+    return {
+        'id': event_id, 'type': 'customer.subscription.updated', 'created': created,
+        'data': {'object': {
+            'id': 'sub_1', 'customer': 'cus_1', 'status': status,
+            'items': {'data': [{'price': {'id': 'price_1'}, 'current_period_end': 1_900_000_000}]},
+            'plan': {'metadata': {'tier': 'pro'}},
+        }},
+    }
+# End of event
+
+
+class FakeQueue:
+    def __init__(self):
+        self.submitted = []
+
+    async def submit(self, kind, payload):
+        self.submitted.append(payload)
+
+
+# End of FakeQueue
+
+@pytest.fixture
+def events(monkeypatch):
+    """stripe_events and subscriptions in memory, with the database calls the Stripe code makes."""
+    table = {}
+    applied = []
+    monkeypatch.setattr(stripe_api, '_queued', set())
+
+    async def record(event_id, event_type, update):
+        if event_id in table:
+            return False
+        table[event_id] = {'id': event_id, 'created': update['created'], 'payload': update, 'status': 'pending'}
+        return True
+
+    async def pending(subscription_id):
+        rows = [row for row in table.values() if row['status'] == 'pending']
+        return sorted(rows, key=lambda row: row['created'])
+
+    async def finish(event_ids, result):
+        for event_id in event_ids:
+            table[event_id].update(status='done', result=result)
+
+    async def subscription(customer_id):
+        return {'id': 1, 'user_id': 'user_1'} if customer_id == 'cus_1' else None
+
+    async def update_subscription(row_id, plan, status, price_id, ends_at, created):
+        applied.append(created)
+        return True
+
+    async def update_user_limits(user_id, plan='free'):
+        pass
+
+    monkeypatch.setattr(database, 'record_stripe_event', record)
+    monkeypatch.setattr(database, 'get_pending_stripe_events', pending)
+    monkeypatch.setattr(database, 'finish_stripe_events', finish)
+    monkeypatch.setattr(database, 'get_subscription_by_customer', subscription)
+    monkeypatch.setattr(database, 'update_subscription', update_subscription)
+    monkeypatch.setattr(database, 'update_user_limits', update_user_limits)
+    return SimpleNamespace(table=table, applied=applied)
+# End of events
+
+
+def webhook_client(monkeypatch, queue) -> TestClient:
+    monkeypatch.setattr(stripe.Webhook, 'construct_event', lambda payload, signature, secret: json.loads(payload))
+    app = FastAPI()
+    app.include_router(stripe_api.stripe_router)
+    app.state.job_queue = queue
+    return TestClient(app)
+# End of webhook_client
+
+
+def test_webhook_stores_events_and_queues_one_job_per_subscription(monkeypatch, events):
+    queue = FakeQueue()
+    client = webhook_client(monkeypatch, queue)
+    for number in range(3):
+        response = client.post('/webhook/stripe', json=event(f"evt_{number}", 100 + number))
+        assert response.json() == {'status': 'queued'}
+    assert client.post('/webhook/stripe', json=event('evt_0', 100)).json() == {'status': 'duplicate'}
+
+    assert [row['status'] for row in events.table.values()] == ['pending'] * 3
+    assert queue.submitted == [{'subscription_id': 'sub_1'}]
+# End of test_webhook_stores_events_and_queues_one_job_per_subscription
+
+
+def test_webhook_without_subscription_is_retryable(monkeypatch, events):
+    client = webhook_client(monkeypatch, FakeQueue())
+    unknown = event('evt_1', 100)
+    unknown['data']['object']['customer'] = 'cus_unknown'
+    assert client.post('/webhook/stripe', json=unknown).status_code == 404
+    # Not recorded, so Stripe's retry is processed
+    assert events.table == {}
+# End of test_webhook_without_subscription_is_retryable
+
+
+def test_job_applies_newest_pending_state_and_finishes_all(events):
+    async def main():
+        for number, created in enumerate((105, 100, 103)):
+            update = stripe_api.subscription_update(event(f"evt_{number}", created))
+            await database.record_stripe_event(update['event_id'], update['type'], update)
+        return await stripe_api.run_subscription_job({'subscription_id': 'sub_1'}, None, {})
+
+    result = asyncio.run(main())
+    assert result == {'status': 'success', 'event_id': 'evt_0', 'events': 3}
+    assert events.applied == [105]
+    assert {row['status'] for row in events.table.values()} == {'done'}
+# End of test_job_applies_newest_pending_state_and_finishes_all
+
+
+def test_failed_job_leaves_events_pending_for_the_sweeper(monkeypatch, events):
+    async def failing(*args):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(database, 'update_subscription', failing)
+
+    async def main():
+        update = stripe_api.subscription_update(event('evt_1', 100))
+        await database.record_stripe_event(update['event_id'], update['type'], update)
+        with pytest.raises(RuntimeError):
+            await stripe_api.run_subscription_job({'subscription_id': 'sub_1'}, None, {})
+
+    asyncio.run(main())
+    assert events.table['evt_1']['status'] == 'pending'
+# End of test_failed_job_leaves_events_pending_for_the_sweeper
+
+
+def test_sweep_queues_stranded_subscriptions_once(monkeypatch):
+    monkeypatch.setattr(stripe_api, '_queued', set())
+
+    async def stranded(received_before):
+        return ['sub_1', 'sub_2']
+
+    monkeypatch.setattr(database, 'get_pending_stripe_subscriptions', stranded)
+    queue = FakeQueue()
+
+    async def main():
+        now = datetime.now(timezone.utc)
+        assert await stripe_api.sweep_pending_events(queue, now) == 2
+        # Still waiting to start, so a second sweep adds nothing
+        await stripe_api.sweep_pending_events(queue, now)
+
+    asyncio.run(main())
+    assert queue.submitted == [{'subscription_id': 'sub_1'}, {'subscription_id': 'sub_2'}]
+# End of test_sweep_queues_stranded_subscriptions_once
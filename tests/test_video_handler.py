@@ -0,0 +1,111 @@
+import asyncio
+import email.parser
+import email.policy
+import os
+
+import pytest
+
+from support import video_handler
+from support.video_handler import PreparedVideo, VideoFile, VideoProfile
+
+
+def make_video(tmp_path, size: int, name: str = 'clip.mov', mime_type: str = 'video/quicktime') -> VideoFile:
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return VideoFile(name, str(path), mime_type, size)
+# End of make_video
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch, tmp_path):
+    """Stands in for ffprobe and ffmpeg: a 10 second video, encoded to output_size bytes."""
+    calls = {'output_size': 1024, 'ffmpeg': []}
+    monkeypatch.setattr(video_handler, 'TEMP_VIDEO_DIR', str(tmp_path / 'temp'))
+
+    async def run(*args, timeout):
+        if args[0] == video_handler.FFPROBE_PATH:
+            return b'10.0\n'
+        calls['ffmpeg'].append(args)
+        with open(args[-1], 'wb') as output:
+            output.write(b'\0' * calls['output_size'])
+        return b''
+
+    monkeypatch.setattr(video_handler, '_run', run)
+    return calls
+# End of ffmpeg
+
+
+def test_transcode_targets_a_bitrate_that_fits(tmp_path, ffmpeg):
+    video = make_video(tmp_path, 4096)
+
+    result = asyncio.run(video_handler.transcode(video, max_size_kb=2048))
+    args = ffmpeg['ffmpeg'][0]
+    # 2048 KB over 10 seconds, less headroom and the audio track
+    expected = int(2048 * 8 * 1.024 * video_handler.SIZE_HEADROOM / 10 - video_handler.VIDEO_AUDIO_KBPS)
+    assert args[args.index('-b:v') + 1] == f'{expected}k'
+    assert (result.name, result.mime_type, result.size) == ('clip.mp4', 'video/mp4', 1024)
+    assert os.path.exists(result.path)
+# End of test_transcode_targets_a_bitrate_that_fits
+
+
+def test_transcode_refuses_a_video_too_long_for_the_limit(tmp_path, ffmpeg):
+    video = make_video(tmp_path, 4096)
+
+    with pytest.raises(ValueError):
+        asyncio.run(video_handler.transcode(video, max_size_kb=100))
+    assert ffmpeg['ffmpeg'] == []
+# End of test_transcode_refuses_a_video_too_long_for_the_limit
+
+
+def test_transcode_output_over_the_limit_is_deleted(tmp_path, ffmpeg):
+    video = make_video(tmp_path, 4096)
+    ffmpeg['output_size'] = 3 * 1024 * 1024
+
+    with pytest.raises(ValueError):
+        asyncio.run(video_handler.transcode(video, max_size_kb=2048))
+    assert os.listdir(video_handler.TEMP_VIDEO_DIR) == []
+# End of test_transcode_output_over_the_limit_is_deleted
+
+
+def test_prepare_video_shares_the_original_and_transcodes_once_per_profile(tmp_path, ffmpeg):
+    video = make_video(tmp_path, 4096, 'clip.mp4', 'video/mp4')
+    fits = VideoProfile(max_size_kb=8)
+    smaller = VideoProfile(max_size_kb=2048, formats=frozenset({'video/webm'}))
+
+    prepared = asyncio.run(video_handler.prepare_video(video, [fits, smaller, smaller]))
+    assert prepared[fits] == PreparedVideo('clip.mp4', video.path, 'video/mp4', 4096)
+    assert prepared[smaller].transcoded and prepared[smaller].path != video.path
+    assert len(ffmpeg['ffmpeg']) == 1
+# End of test_prepare_video_shares_the_original_and_transcodes_once_per_profile
+
+
+def test_failed_transcode_only_fails_its_profile(tmp_path, ffmpeg):
+    video = make_video(tmp_path, 4096, 'clip.mp4', 'video/mp4')
+    fits, too_small = VideoProfile(max_size_kb=8), VideoProfile(max_size_kb=1)
+
+    prepared = asyncio.run(video_handler.prepare_video(video, [fits, too_small]))
+    assert prepared[fits].error is None
+    assert isinstance(prepared[too_small].error, ValueError) and prepared[too_small].path is None
+# End of test_failed_transcode_only_fails_its_profile
+
+
+def test_multipart_body_streams_a_parseable_form(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_handler, 'VIDEO_CHUNK_SIZE', 1000)
+    video = make_video(tmp_path, 5000, 'my "clip".mp4', 'video/mp4')
+
+    headers, body = video_handler.multipart_body(video, 'file', {'description': 'A clip'})
+
+    async def read():
+        return b''.join([chunk async for chunk in body])
+
+    data = asyncio.run(read())
+    assert int(headers['Content-Length']) == len(data)
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode() + data)
+    description, upload = message.iter_parts()
+    assert description.get_param('name', header='content-disposition') == 'description'
+    assert description.get_content() == 'A clip'
+    assert upload.get_filename() == 'my %22clip%22.mp4'
+    assert upload.get_content_type() == 'video/mp4'
+    assert upload.get_content() == open(video.path, 'rb').read()
+# End of test_multipart_body_streams_a_parseable_form